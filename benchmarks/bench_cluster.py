@@ -0,0 +1,135 @@
+# benchmarks/bench_cluster.py - пропускная способность обработки обновлений в зависимости от числа воркеров
+#
+# Супервизор раздает воркерам команды /stats от разных пользователей, воркеры
+# обрабатывают их настоящими обработчиками бота: подписка проверяется через
+# заглушку Bot API, статистика читается из отдельной базы --database на сервере
+# из настроек DB_* (база DB_NAME не принимается: /stats создает пользователей).
+# Замер заканчивается, когда заглушка получила ответ на каждое обновление.
+import argparse
+import asyncio
+import json
+import os
+import time
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from benchmarks.fake_telegram import FakeTelegramServer
+from bot.cluster import Supervisor
+from bot.config import get_config
+from bot.db.database import execute_query, create_tables
+
+FAKE_TOKEN = '123456:FAKE-TOKEN-FOR-BENCHMARKS'
+
+# Синтетические пользователи, как в bench_record_answer: get_user_stats создает
+# их в базе, после замера они удаляются
+BENCH_USER_BASE = 9_000_000_000_000
+
+
+async def serve_bench_worker(channel):
+    """Воркер бенчмарка: обработчики бота с ботом, подключенным к заглушке"""
+    from bot.handlers import register_handlers
+    from bot.update_pool import get_update_pool
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(os.environ['TELEGRAM_API_URL']))
+    bot = Bot(token=FAKE_TOKEN, session=session)
+    dp = Dispatcher()
+    register_handlers(dp)
+    dp.update.outer_middleware(get_update_pool())
+
+    try:
+        await channel.serve(bot, dp)
+    finally:
+        await bot.session.close()
+
+
+def make_update(n, user_id):
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'Bench'}
+    return {
+        'update_id': n,
+        'message': {
+            'message_id': n,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': user,
+            'text': '/stats',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    }
+
+
+def cleanup(user_base):
+    """Удаляет всех синтетических пользователей"""
+    execute_query('DELETE FROM user_answered_questions WHERE user_id >= %s', (user_base,))
+    execute_query('DELETE FROM daily_progress WHERE user_id >= %s', (user_base,))
+    execute_query('DELETE FROM users WHERE user_id >= %s', (user_base,))
+
+
+async def run(workers, server, args):
+    supervisor = Supervisor(serve_bench_worker, workers)
+    await supervisor.start()
+
+    try:
+        await asyncio.wait_for(supervisor.all_ready.wait(), timeout=120)
+        server.reset_stats()
+
+        started = time.perf_counter()
+        for n in range(1, args.updates + 1):
+            await supervisor.route(make_update(n, BENCH_USER_BASE + n % args.users))
+
+        # Каждое обновление заканчивается отправкой ответа пользователю
+        while server.completed['sendMessage'] < args.updates:
+            await asyncio.sleep(0.02)
+        elapsed = time.perf_counter() - started
+
+        return {
+            'workers': workers,
+            'updates': args.updates,
+            'elapsed_s': round(elapsed, 3),
+            'updates_per_s': round(args.updates / elapsed, 1),
+            'routed': supervisor.stats()['routed'],
+        }
+    finally:
+        await supervisor.stop()
+
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(description='Масштабирование обработки обновлений по процессам')
+    parser.add_argument('--workers', default='1,2,4', help='число воркеров через запятую')
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.02, help='задержка заглушки Bot API, секунд')
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--database', required=True,
+                        help='отдельная база для замеров (не DB_NAME из настроек)')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    config = get_config()
+    if args.database == config.DB_NAME:
+        raise SystemExit(f'База {args.database} указана в DB_NAME: замер создает пользователей, '
+                         f'запустите его на отдельной базе')
+    config.DB_NAME = args.database
+    create_tables()
+
+    server = FakeTelegramServer(port=args.port, latency=args.latency, seed=1)
+    await server.start()
+    # Воркеры запускаются через spawn и наследуют окружение (load_dotenv его не перезаписывает)
+    os.environ['TELEGRAM_API_URL'] = server.url
+    os.environ['DB_NAME'] = args.database
+
+    results = []
+    try:
+        for workers in [int(x) for x in args.workers.split(',') if x]:
+            result = await run(workers, server, args)
+            results.append(result)
+            print(json.dumps(result, ensure_ascii=False) if args.json else
+                  f"{workers} воркер(ов): {result['updates_per_s']} обновлений/с "
+                  f"({result['updates']} за {result['elapsed_s']} с)")
+    finally:
+        await server.stop()
+        cleanup(BENCH_USER_BASE)
+    return results
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
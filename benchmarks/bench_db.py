@@ -0,0 +1,227 @@
+# benchmarks/bench_db.py - микробенчмарки функций БД и выборки вопросов на разных объемах данных
+#
+# Работает только с отдельной базой из --database на сервере из настроек DB_*
+# (например, mysql в docker) и отказывается запускаться на базе DB_NAME:
+# load_questions_from_fs перезагружает вопросы, а reset_daily_progress_if_needed
+# удаляет прогресс за прошлые дни у всех пользователей.
+#
+# Для каждого объема (--sizes) база дополняется синтетическими пользователями
+# с ID от BENCH_USER_BASE, их отвеченными вопросами и прогрессом, после замеров
+# они удаляются. Результаты пишутся в JSON (--output); с --baseline медиана каждой
+# функции сравнивается с прошлым запуском, и при замедлении больше --max-regression
+# процентов скрипт завершается с кодом 1.
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from bot.config import get_config
+from bot.db.database import (
+    execute_query, create_tables, drop_cached, get_user_stats, get_questions_by_topic,
+    update_user_daily_progress, get_user_answered_questions_count, load_questions_from_fs,
+    reset_daily_progress_if_needed
+)
+
+BENCH_USER_BASE = 9_100_000_000_000
+
+# Строк в одном executemany при заполнении базы
+SEED_CHUNK = 10_000
+
+TOPICS = ['typography', 'coloristics', 'composition', 'ux_principles', 'ui_patterns']
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def summarize(function, size, latencies):
+    return {
+        'function': function,
+        'size': size,
+        'calls': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 3),
+    }
+
+
+def timed(call, *args):
+    started = time.perf_counter()
+    call(*args)
+    return time.perf_counter() - started
+
+
+def insert_chunked(query, rows):
+    for start in range(0, len(rows), SEED_CHUNK):
+        execute_query(query, rows[start:start + SEED_CHUNK], many=True)
+
+
+def seed(user_base, start, end, question_ids, answered_per_user, rng):
+    """Добавляет пользователей [start, end) с отвеченными вопросами"""
+    for chunk_start in range(start, end, SEED_CHUNK):
+        chunk = range(chunk_start, min(end, chunk_start + SEED_CHUNK))
+        insert_chunked(
+            'INSERT IGNORE INTO users (user_id, username, total_correct, current_topic) VALUES (%s, %s, %s, %s)',
+            [(user_base + i, 'bench', rng.randrange(50), rng.choice(TOPICS)) for i in chunk]
+        )
+        answered = []
+        for i in chunk:
+            for question_id in rng.sample(question_ids, min(answered_per_user, len(question_ids))):
+                answered.append((user_base + i, question_id))
+        insert_chunked('INSERT IGNORE INTO user_answered_questions (user_id, question_id) VALUES (%s, %s)', answered)
+
+
+def seed_stale_progress(user_base, size):
+    """Прогресс за вчера у всех синтетических пользователей - работа для reset_daily_progress_if_needed"""
+    yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+    insert_chunked(
+        'INSERT IGNORE INTO daily_progress (user_id, date, questions_asked) VALUES (%s, %s, %s)',
+        [(user_base + i, yesterday, 3) for i in range(size)]
+    )
+
+
+def cleanup(user_base):
+    """Удаляет всех синтетических пользователей, в том числе после прерванного заполнения"""
+    execute_query('DELETE FROM user_answered_questions WHERE user_id >= %s', (user_base,))
+    execute_query('DELETE FROM daily_progress WHERE user_id >= %s', (user_base,))
+    execute_query('DELETE FROM users WHERE user_id >= %s', (user_base,))
+
+
+def run_size(size, user_base, calls, reset_repeats, rng):
+    """Замеры функций, зависящих от числа пользователей"""
+    user_ids = [user_base + rng.randrange(size) for _ in range(calls)]
+    results = []
+
+    latencies = []
+    for user_id in user_ids:
+        # Кэш статистики сбрасывается, чтобы мерить запрос к БД, а не словарь
+        drop_cached('user_stats', user_id)
+        latencies.append(timed(get_user_stats, user_id))
+    results.append(summarize('get_user_stats', size, latencies))
+
+    results.append(summarize('get_questions_by_topic', size, [
+        timed(get_questions_by_topic, user_id, rng.choice(TOPICS)) for user_id in user_ids
+    ]))
+    results.append(summarize('get_user_answered_questions_count', size, [
+        timed(get_user_answered_questions_count, user_id, rng.choice(TOPICS)) for user_id in user_ids
+    ]))
+    results.append(summarize('update_user_daily_progress', size, [
+        timed(update_user_daily_progress, user_id) for user_id in user_ids
+    ]))
+
+    latencies = []
+    for _ in range(reset_repeats):
+        seed_stale_progress(user_base, size)
+        latencies.append(timed(reset_daily_progress_if_needed))
+    results.append(summarize('reset_daily_progress_if_needed', size, latencies))
+
+    execute_query('DELETE FROM daily_progress WHERE user_id >= %s AND user_id < %s', (user_base, user_base + size))
+    return results
+
+
+def compare(results, baseline, max_regression):
+    """Список замедлений медианы больше max_regression процентов относительно baseline"""
+    previous = {(item['function'], item['size']): item for item in baseline.get('results', [])}
+    regressions = []
+    for item in results:
+        base = previous.get((item['function'], item['size']))
+        if not base or base['p50_ms'] <= 0:
+            continue
+        change = (item['p50_ms'] - base['p50_ms']) / base['p50_ms'] * 100
+        if change > max_regression:
+            regressions.append({
+                'function': item['function'],
+                'size': item['size'],
+                'baseline_p50_ms': base['p50_ms'],
+                'p50_ms': item['p50_ms'],
+                'change_percent': round(change, 1),
+            })
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Микробенчмарки функций БД')
+    parser.add_argument('--sizes', default='1000,100000,1000000',
+                        help='число синтетических пользователей через запятую')
+    parser.add_argument('--calls', type=int, default=200, help='вызовов каждой функции на объем')
+    parser.add_argument('--reset-repeats', type=int, default=3)
+    parser.add_argument('--load-repeats', type=int, default=3)
+    parser.add_argument('--answered-per-user', type=int, default=3)
+    parser.add_argument('--database', required=True,
+                        help='отдельная база для замеров (не DB_NAME из настроек)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench_db.json', help='куда записать результаты')
+    parser.add_argument('--baseline', help='результаты прошлого запуска для сравнения')
+    parser.add_argument('--max-regression', type=float, default=20.0,
+                        help='допустимое замедление медианы, процентов')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    config = get_config()
+    if args.database == config.DB_NAME:
+        raise SystemExit(f'База {args.database} указана в DB_NAME: замеры изменяют данные, '
+                         f'запустите их на отдельной базе')
+    config.DB_NAME = args.database
+    sizes = sorted(int(size) for size in args.sizes.split(','))
+    rng = random.Random(args.seed)
+
+    create_tables()
+
+    # Загрузка вопросов не зависит от числа пользователей - замеряется один раз
+    results = [summarize('load_questions_from_fs', 0, [
+        timed(load_questions_from_fs) for _ in range(args.load_repeats)
+    ])]
+
+    question_ids = [row[0] for row in execute_query('SELECT question_id FROM questions', fetch_all=True) or []]
+    if not question_ids:
+        raise SystemExit('В базе нет вопросов: проверьте папку questions')
+
+    # Объемы идут по возрастанию, база только дополняется до следующего размера
+    # Остатки прерванного запуска искажали бы замеры
+    cleanup(BENCH_USER_BASE)
+    seeded = 0
+    try:
+        for size in sizes:
+            started = time.perf_counter()
+            seed(BENCH_USER_BASE, seeded, size, question_ids, args.answered_per_user, rng)
+            seeded = size
+            if not args.json:
+                print(f"{size} пользователей подготовлено за {time.perf_counter() - started:.1f} с")
+            results.extend(run_size(size, BENCH_USER_BASE, args.calls, args.reset_repeats, rng))
+    finally:
+        cleanup(BENCH_USER_BASE)
+
+    report = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'database': args.database,
+        'sizes': sizes,
+        'calls': args.calls,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+
+    if args.json:
+        print(json.dumps({'results': results, 'regressions': regressions}, ensure_ascii=False))
+    else:
+        for result in results:
+            print(f"{result['function']:>34} [{result['size']:>8}]: p50 {result['p50_ms']} мс, "
+                  f"p99 {result['p99_ms']} мс, среднее {result['mean_ms']} мс ({result['calls']} вызовов)")
+        for regression in regressions:
+            print(f"❌ {regression['function']} [{regression['size']}]: медиана {regression['baseline_p50_ms']} -> "
+                  f"{regression['p50_ms']} мс (+{regression['change_percent']}%)")
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
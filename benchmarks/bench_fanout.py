@@ -0,0 +1,295 @@
+# benchmarks/bench_fanout.py - нагрузочный тест путей отправки на заглушке Bot API
+#
+# Сценарии questions и broadcast вызывают функции отправки напрямую и не
+# обращаются к MySQL. Сценарий interactive проходит путь ответа пользователя
+# целиком: callback через dp.feed_update (UpdatePool, обработчики) и отложенный
+# следующий вопрос, а бот работает через сессию бота с OutboundMiddleware.
+# Он пишет в базу, поэтому работает только с отдельной базой из --database
+# и отказывается запускаться на базе DB_NAME; синтетические пользователи с ID
+# от BENCH_USER_BASE удаляются после замера.
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update
+from benchmarks.fake_telegram import FakeTelegramServer, BOT_USER
+
+FAKE_TOKEN = '123456:FAKE-TOKEN-FOR-BENCHMARKS'
+
+BENCH_USER_BASE = 9_200_000_000_000
+
+# Сколько ждать следующего вопроса после ответа, секунд
+ANSWER_TIMEOUT = 30
+
+# Строка таблицы questions (12 полей), как ее возвращает get_question
+FAKE_QUESTION = (
+    1, 'typography', 'Какой шрифт лучше для основного текста?\na) Гротеск\nb) Антиква',
+    None, None, None, None, None, 2, 'a', 'Объяснение', None
+)
+
+
+# Пользователи, которых отправка пометила заблокировавшими бота (вместо записи в БД)
+blocked_marks = []
+
+
+def stub_mark_user_blocked(module):
+    """Подменяет mark_user_blocked в модуле отправки: тест не обращается к MySQL"""
+    module.mark_user_blocked = blocked_marks.append
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def run_concurrently(n, concurrency, send):
+    """Вызывает send(user_id) для n пользователей, не больше concurrency одновременно"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(user_id):
+        async with semaphore:
+            started = time.perf_counter()
+            await send(user_id)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(user_id) for user_id in range(1, n + 1)))
+    return time.perf_counter() - started, latencies
+
+
+async def bench_questions(bot, args):
+    """Ежедневная рассылка: send_question_to_user для каждого пользователя"""
+    from bot import scheduler
+    from bot.scheduler import send_question_to_user
+
+    stub_mark_user_blocked(scheduler)
+    return await run_concurrently(
+        args.users, args.concurrency,
+        lambda user_id: send_question_to_user(bot, user_id, FAKE_QUESTION, '// Typography')
+    )
+
+
+async def bench_broadcast(bot, args):
+    """Рассылка /letter: copy_to_user с общим ограничением скорости"""
+    from bot import broadcast
+    from bot.broadcast import BroadcastJob, copy_to_user
+
+    stub_mark_user_blocked(broadcast)
+    job = BroadcastJob(None, 1, 1, 1, None)
+    return await run_concurrently(
+        args.users, args.concurrency,
+        lambda user_id: copy_to_user(bot, job, user_id)
+    )
+
+
+def make_answer_update(bot, update_id, user_id, question_id):
+    """Нажатие кнопки ответа "a" под сообщением с вопросом"""
+    return Update.model_validate({
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Bench'},
+            'chat_instance': 'bench',
+            'data': f'answer_{question_id}_a',
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': 'Вопрос',
+            },
+        },
+    }, context={'bot': bot})
+
+
+def prepare_interactive(args):
+    """Переключается на базу из --database и возвращает вопросы для ответов"""
+    from bot.config import get_config
+    from bot.db.database import execute_query, create_tables, load_questions_from_fs, DAILY_LIMIT
+
+    config = get_config()
+    if not args.database:
+        raise SystemExit('Сценарий interactive пишет в базу: укажите отдельную базу в --database')
+    if args.database == config.DB_NAME:
+        raise SystemExit(f'База {args.database} указана в DB_NAME: замер изменяет данные, '
+                         f'запустите его на отдельной базе')
+    # Последний ответ дня завершает сессию вместо отправки следующего вопроса
+    if not 0 < args.answers < DAILY_LIMIT:
+        raise SystemExit(f'--answers должно быть от 1 до {DAILY_LIMIT - 1}')
+    config.DB_NAME = args.database
+
+    create_tables()
+    query = "SELECT question_id FROM questions WHERE category = 'typography' LIMIT %s"
+    rows = execute_query(query, (DAILY_LIMIT,), fetch_all=True)
+    if len(rows or []) < DAILY_LIMIT:
+        load_questions_from_fs()
+        rows = execute_query(query, (DAILY_LIMIT,), fetch_all=True)
+    question_ids = [row[0] for row in rows or []]
+    if len(question_ids) < DAILY_LIMIT:
+        raise SystemExit('Недостаточно вопросов в базе: проверьте папку questions')
+    return question_ids
+
+
+def cleanup_interactive(user_base, users):
+    from bot.db.database import execute_query
+
+    params = (user_base, user_base + users)
+    for table in ('user_answered_questions', 'daily_progress', 'quiz_sessions', 'users'):
+        execute_query(f'DELETE FROM {table} WHERE user_id >= %s AND user_id < %s', params)
+
+
+async def bench_interactive(bot, args):
+    """Ответы пользователей: callback через диспетчер и следующий вопрос после паузы.
+
+    Задержка одного ответа - от передачи callback в dp.feed_update до отправки
+    следующего вопроса, включая паузу --next-delay.
+    """
+    from bot import handlers
+    from bot.db.database import add_user
+    from bot.deletion import deletion_batcher
+    from bot.logs import UpdateContextMiddleware
+    from bot.sessions import get_session_store
+    from bot.update_pool import get_update_pool
+
+    question_ids = prepare_interactive(args)
+
+    # Тот же порядок middleware, что в initialize_bot
+    dp = Dispatcher()
+    handlers.register_handlers(dp)
+    dp.update.outer_middleware(UpdateContextMiddleware())
+    dp.update.outer_middleware(get_update_pool())
+
+    # Следующий вопрос отправляется вне обработки обновления - отмечаем момент его отправки
+    delivered = {}
+    send_next_question = handlers.send_next_question
+
+    async def send_and_mark(message, user_id):
+        try:
+            await send_next_question(message, user_id)
+        finally:
+            delivered[user_id].set()
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    update_ids = iter(range(1, args.users * args.answers + 1))
+    latencies = []
+
+    async def answer_questions(user_id):
+        async with semaphore:
+            for question_id in question_ids[:args.answers]:
+                delivered[user_id] = asyncio.Event()
+                started = time.perf_counter()
+                await dp.feed_update(bot, make_answer_update(bot, next(update_ids), user_id, question_id))
+                await asyncio.wait_for(delivered[user_id].wait(), ANSWER_TIMEOUT)
+                latencies.append(time.perf_counter() - started)
+
+    next_delay = handlers.NEXT_QUESTION_DELAY
+    handlers.send_next_question = send_and_mark
+    handlers.NEXT_QUESTION_DELAY = args.next_delay
+    store = get_session_store()
+    try:
+        # Остатки прерванного запуска искажали бы замер
+        cleanup_interactive(BENCH_USER_BASE, args.users)
+
+        # Каждый пользователь видит первый вопрос, остальные ждут в его сессии
+        for i in range(args.users):
+            add_user(BENCH_USER_BASE + i, 'bench')
+            store.activate(BENCH_USER_BASE + i)
+            store.set_questions(BENCH_USER_BASE + i, question_ids[1:args.answers + 1])
+
+        started = time.perf_counter()
+        await asyncio.gather(*(answer_questions(BENCH_USER_BASE + i) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+        await deletion_batcher.flush_all()
+    finally:
+        handlers.send_next_question = send_next_question
+        handlers.NEXT_QUESTION_DELAY = next_delay
+        for i in range(args.users):
+            store.end(BENCH_USER_BASE + i)
+        cleanup_interactive(BENCH_USER_BASE, args.users)
+
+    return elapsed, latencies
+
+
+SCENARIOS = {
+    'questions': bench_questions,
+    'broadcast': bench_broadcast,
+    'interactive': bench_interactive,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочный тест рассылок на заглушке Bot API')
+    parser.add_argument('scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--retry-after-rate', type=float, default=0.0)
+    parser.add_argument('--blocked-rate', type=float, default=0.0, help='доля заблокировавших бота')
+    parser.add_argument('--answers', type=int, default=3, help='interactive: ответов каждого пользователя')
+    parser.add_argument('--next-delay', type=float, default=0.0,
+                        help='interactive: пауза перед следующим вопросом (NEXT_QUESTION_DELAY), секунд')
+    parser.add_argument('--database', help='interactive: отдельная база для замера (не DB_NAME из настроек)')
+    parser.add_argument('--json', action='store_true', help='вывести результат в JSON')
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    blocked_every = int(1 / args.blocked_rate) if args.blocked_rate else 0
+    server = FakeTelegramServer(
+        port=args.port, latency=args.latency, jitter=args.jitter,
+        retry_after_rate=args.retry_after_rate, seed=42,
+        blocked_users=range(blocked_every, args.users + 1, blocked_every) if blocked_every else ()
+    )
+    await server.start()
+
+    api = TelegramAPIServer.from_base(server.url)
+    if args.scenario == 'interactive':
+        # Сессия бота как в работе: отправки идут через OutboundMiddleware и общую очередь
+        from bot.client import create_session
+        session = create_session(api=api)
+    else:
+        session = AiohttpSession(api=api)
+    bot = Bot(token=FAKE_TOKEN, session=session)
+
+    try:
+        elapsed, latencies = await SCENARIOS[args.scenario](bot, args)
+    finally:
+        await session.close()
+        await server.stop()
+
+    from bot import outbound
+
+    result = {
+        'scenario': args.scenario,
+        'users': args.users,
+        'concurrency': args.concurrency,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_per_s': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'latency_mean_ms': round(statistics.fmean(latencies) * 1000, 2) if latencies else 0,
+        'marked_blocked': len(blocked_marks),
+        'outbound': outbound.outbound_queue.stats() if outbound.outbound_queue else None,
+        'api': server.stats(),
+    }
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+    else:
+        for key, value in result.items():
+            print(f"{key}: {value}")
+    return result
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
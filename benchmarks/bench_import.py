@@ -0,0 +1,84 @@
+# benchmarks/bench_import.py - время импорта модулей бота (python -X importtime)
+#
+# Запускает импорт main в отдельном интерпретаторе, суммирует время собственных
+# модулей (bot.*, main) и сторонних библиотек и проверяет, что импорт не
+# выполняет работу: не читает настройки и не запускает потоки.
+import argparse
+import json
+import subprocess
+import sys
+
+PROJECT_PREFIXES = ('bot', 'main')
+
+IMPORT_CODE = (
+    "import threading, main, bot.config; "
+    "print(bot.config.cached_config is None and threading.active_count() == 1)"
+)
+
+
+def is_project_module(name):
+    return any(name == prefix or name.startswith(prefix + '.') for prefix in PROJECT_PREFIXES)
+
+
+def measure(module_code=IMPORT_CODE):
+    """Возвращает (список (модуль, собственное время мкс, общее время мкс), импорт без побочных эффектов)"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', module_code],
+        capture_output=True, text=True, check=True
+    )
+
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+
+    return modules, result.stdout.strip().endswith('True')
+
+
+def summarize(modules, pure, top):
+    project = [m for m in modules if is_project_module(m[0])]
+    return {
+        'total_ms': round(sum(m[1] for m in modules) / 1000, 1),
+        'project_ms': round(sum(m[1] for m in project) / 1000, 1),
+        'third_party_ms': round(sum(m[1] for m in modules if not is_project_module(m[0])) / 1000, 1),
+        'pure': pure,
+        'slowest_project': [
+            {'module': name, 'self_ms': round(self_us / 1000, 2)}
+            for name, self_us, _ in sorted(project, key=lambda m: m[1], reverse=True)[:top]
+        ],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Время импорта модулей бота')
+    parser.add_argument('--runs', type=int, default=5, help='число замеров, берется лучший')
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--max-project-ms', type=float, default=None,
+                        help='ошибка, если собственные модули импортируются дольше')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    summaries = [summarize(*measure(), args.top) for _ in range(args.runs)]
+    summary = min(summaries, key=lambda s: s['total_ms'])
+
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False))
+    else:
+        print(f"Импорт main: {summary['total_ms']} мс (свои модули {summary['project_ms']} мс, "
+              f"библиотеки {summary['third_party_ms']} мс)")
+        for module in summary['slowest_project']:
+            print(f"  {module['self_ms']:>7} мс  {module['module']}")
+        print("Импорт без побочных эффектов" if summary['pure'] else
+              "⚠️ Импорт читает настройки или запускает потоки")
+
+    failed = not summary['pure']
+    if args.max_project_ms is not None and summary['project_ms'] > args.max_project_ms:
+        print(f"⚠️ Свои модули импортируются дольше {args.max_project_ms} мс")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+# benchmarks/bench_record_answer.py - задержка обработки ответа: record_answer против старой цепочки вызовов
+#
+# Работает только с отдельной базой из --database на сервере из настроек DB_*
+# и отказывается запускаться на базе DB_NAME. Создает синтетических пользователей
+# с ID от BENCH_USER_BASE и удаляет их после замера. Если вопросов в базе нет,
+# они загружаются (load_questions_from_fs).
+import argparse
+import json
+import statistics
+import time
+from bot.config import get_config
+from bot.db.database import (
+    execute_query, load_questions_from_fs, add_user, get_user_stats, get_question, add_answered_question,
+    update_user_stats, update_user_daily_progress, get_questions_count_by_topic,
+    get_user_answered_questions_count, record_answer, create_tables, DAILY_LIMIT
+)
+
+BENCH_USER_BASE = 9_000_000_000_000
+
+
+def legacy_answer(user_id, question_id, option):
+    """Цепочка вызовов, которую handle_answer выполнял до record_answer"""
+    get_user_stats(user_id)
+    question = get_question(question_id)
+    add_answered_question(user_id, question_id)
+    update_user_stats(user_id, option == question[9])
+    stats = get_user_stats(user_id)
+    execute_query(
+        'UPDATE users SET current_topic_progress = %s WHERE user_id = %s',
+        (stats[2] + 1, user_id)
+    )
+    update_user_daily_progress(user_id)
+    stats = get_user_stats(user_id)
+    get_questions_count_by_topic(stats[1])
+    get_user_answered_questions_count(user_id, stats[1])
+
+
+def new_answer(user_id, question_id, option):
+    record_answer(user_id, question_id, option)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def cleanup(user_base, users):
+    params = (user_base, user_base + users)
+    execute_query('DELETE FROM user_answered_questions WHERE user_id >= %s AND user_id < %s', params)
+    execute_query('DELETE FROM daily_progress WHERE user_id >= %s AND user_id < %s', params)
+    execute_query('DELETE FROM users WHERE user_id >= %s AND user_id < %s', params)
+
+
+def run(variant, answer, question_ids, answers, user_base):
+    """Каждый синтетический пользователь отвечает на DAILY_LIMIT вопросов"""
+    users = (answers + DAILY_LIMIT - 1) // DAILY_LIMIT
+    for i in range(users):
+        add_user(user_base + i, 'bench')
+
+    latencies = []
+    try:
+        for n in range(answers):
+            user_id = user_base + n // DAILY_LIMIT
+            question_id = question_ids[n % len(question_ids)]
+            started = time.perf_counter()
+            answer(user_id, question_id, 'a')
+            latencies.append(time.perf_counter() - started)
+    finally:
+        cleanup(user_base, users)
+
+    return {
+        'variant': variant,
+        'answers': answers,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Замер задержки записи ответа')
+    parser.add_argument('--answers', type=int, default=200)
+    parser.add_argument('--database', required=True,
+                        help='отдельная база для замеров (не DB_NAME из настроек)')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    config = get_config()
+    if args.database == config.DB_NAME:
+        raise SystemExit(f'База {args.database} указана в DB_NAME: замер изменяет данные, '
+                         f'запустите его на отдельной базе')
+    config.DB_NAME = args.database
+
+    create_tables()
+    query = "SELECT question_id FROM questions WHERE category = 'typography' LIMIT %s"
+    rows = execute_query(query, (DAILY_LIMIT,), fetch_all=True)
+    if len(rows or []) < DAILY_LIMIT:
+        load_questions_from_fs()
+        rows = execute_query(query, (DAILY_LIMIT,), fetch_all=True)
+    question_ids = [row[0] for row in rows or []]
+    if len(question_ids) < DAILY_LIMIT:
+        raise SystemExit('Недостаточно вопросов в базе: проверьте папку questions')
+
+    results = [
+        run('legacy', legacy_answer, question_ids, args.answers, BENCH_USER_BASE),
+        run('record_answer', new_answer, question_ids, args.answers, BENCH_USER_BASE),
+    ]
+
+    for result in results:
+        print(json.dumps(result, ensure_ascii=False) if args.json else
+              f"{result['variant']:>14}: p50 {result['p50_ms']} мс, p99 {result['p99_ms']} мс, "
+              f"среднее {result['mean_ms']} мс ({result['answers']} ответов)")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+# benchmarks/fake_telegram.py - локальная заглушка Telegram Bot API для нагрузочных тестов
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+from aiohttp import web
+
+BOT_USER = {'id': 1000000, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+
+
+class FakeTelegramServer:
+    """Минимальный Bot API на aiohttp: методы, которые использует бот, плюс задержки,
+    ответы 429 с retry_after и пользователи, заблокировавшие бота.
+
+    Бот подключается к нему через AiohttpSession(api=TelegramAPIServer.from_base(server.url))
+    или переменную окружения TELEGRAM_API_URL.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8081, latency=0.0, jitter=0.0,
+                 retry_after_rate=0.0, retry_after=1, blocked_users=(), seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.blocked_users = set(blocked_users)
+        self.random = random.Random(seed)
+
+        self.calls = Counter()
+        self.completed = Counter()
+        self.errors = Counter()
+        self.updates = asyncio.Queue()
+        self._next_message_id = 1
+        self._next_update_id = 1
+        self._runner = None
+
+        self.handlers = {
+            'getMe': self.get_me,
+            'getUpdates': self.get_updates,
+            'setWebhook': self.ok_true,
+            'deleteWebhook': self.ok_true,
+            'sendMessage': self.send_message,
+            'sendPhoto': self.send_message,
+            'sendDocument': self.send_message,
+            'copyMessage': self.copy_message,
+            'editMessageText': self.edit_message,
+            'editMessageCaption': self.edit_message,
+            'editMessageReplyMarkup': self.edit_message,
+            'deleteMessage': self.ok_true,
+            'deleteMessages': self.ok_true,
+            'answerCallbackQuery': self.ok_true,
+            'getChatMember': self.get_chat_member,
+        }
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def stats(self):
+        """Счетчики вызовов и ошибок по методам"""
+        return {'calls': dict(self.calls), 'completed': dict(self.completed), 'errors': dict(self.errors),
+                'total': sum(self.calls.values())}
+
+    def reset_stats(self):
+        self.calls.clear()
+        self.completed.clear()
+        self.errors.clear()
+
+    def push_update(self, update):
+        """Добавляет входящее обновление, которое получит getUpdates"""
+        update = dict(update, update_id=self._next_update_id)
+        self._next_update_id += 1
+        self.updates.put_nowait(update)
+        return update['update_id']
+
+    def make_message(self, chat_id, **fields):
+        message_id = self._next_message_id
+        self._next_message_id += 1
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+            'from': BOT_USER,
+            **fields,
+        }
+
+    # Обработчики методов
+
+    async def ok_true(self, params):
+        return True
+
+    async def get_me(self, params):
+        return BOT_USER
+
+    async def get_updates(self, params):
+        timeout = float(params.get('timeout') or 0)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout=max(timeout, 0.01)))
+        except asyncio.TimeoutError:
+            return []
+
+        limit = int(params.get('limit') or 100)
+        while len(updates) < limit and not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def send_message(self, params):
+        fields = {}
+        if 'text' in params:
+            fields['text'] = params['text']
+        if 'caption' in params:
+            fields['caption'] = params['caption']
+            fields['photo'] = [{'file_id': 'fake', 'file_unique_id': 'fake', 'width': 1, 'height': 1}]
+        return self.make_message(params['chat_id'], **fields)
+
+    async def copy_message(self, params):
+        return {'message_id': self.make_message(params['chat_id'])['message_id']}
+
+    async def edit_message(self, params):
+        return self.make_message(params.get('chat_id', 0), text=params.get('text', ''))
+
+    async def get_chat_member(self, params):
+        return {
+            'status': 'member',
+            'user': {'id': int(params['user_id']), 'is_bot': False, 'first_name': 'User'},
+        }
+
+    # HTTP
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        self.calls[method] += 1
+
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self.random.uniform(0, self.jitter))
+
+        handler = self.handlers.get(method)
+        if handler is None:
+            return self.error(method, 404, 'Not Found: method not found')
+
+        chat_id = params.get('chat_id')
+        if chat_id is not None and int(chat_id) in self.blocked_users and method != 'getChatMember':
+            return self.error(method, 403, 'Forbidden: bot was blocked by the user')
+
+        if method not in ('getMe', 'getUpdates') and self.random.random() < self.retry_after_rate:
+            return self.error(method, 429, f'Too Many Requests: retry after {self.retry_after}',
+                              parameters={'retry_after': self.retry_after})
+
+        result = await handler(params)
+        self.completed[method] += 1
+        return web.json_response({'ok': True, 'result': result})
+
+    def error(self, method, code, description, **extra):
+        self.errors[method] += 1
+        return web.json_response({'ok': False, 'error_code': code, 'description': description, **extra},
+                                 status=code)
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats())
+
+    async def handle_push_update(self, request):
+        return web.json_response({'update_id': self.push_update(await request.json())})
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get('/_fake/stats', self.handle_stats)
+        app.router.add_post('/_fake/updates', self.handle_push_update)
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        return app
+
+    async def start(self):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        return self
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Локальная заглушка Telegram Bot API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.05, help='задержка ответа, секунд')
+    parser.add_argument('--jitter', type=float, default=0.02, help='случайная добавка к задержке, секунд')
+    parser.add_argument('--retry-after-rate', type=float, default=0.0, help='доля ответов 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after в ответах 429')
+    parser.add_argument('--blocked', default='', help='ID заблокировавших бота через запятую')
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    server = FakeTelegramServer(
+        host=args.host, port=args.port, latency=args.latency, jitter=args.jitter,
+        retry_after_rate=args.retry_after_rate, retry_after=args.retry_after,
+        blocked_users=[int(x) for x in args.blocked.split(',') if x]
+    )
+    await server.start()
+    print(f"Заглушка Bot API слушает {server.url} (TELEGRAM_API_URL={server.url})")
+
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(json.dumps(server.stats(), ensure_ascii=False))
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,236 @@
+# bot/broadcast.py - фоновая рассылка сообщений администратора (/letter)
+import logging
+import asyncio
+import time
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from bot.config import get_config
+from bot.db.database import (
+    iter_user_chunks, count_users, mark_user_blocked, create_broadcast_job,
+    update_broadcast_progress, set_broadcast_status, claim_stale_broadcast_jobs, touch_broadcast_job
+)
+from bot.leader import INSTANCE_ID
+from bot.ratelimit import TokenBucket
+from bot.metrics import DELIVERIES
+from bot.logs import HOT
+
+logger = logging.getLogger(__name__)
+
+# Пользователей в одной порции; после каждой порции курсор сохраняется в БД
+CHUNK_SIZE = 100
+
+# Рассылка считается брошенной, если ее updated_at не обновлялся столько секунд
+STALE_AFTER = 120
+
+# Как часто выполняющаяся рассылка продлевает updated_at независимо от порций:
+# долгая пауза по RetryAfter или медленная порция не делают ее брошенной
+HEARTBEAT_INTERVAL = STALE_AFTER / 4
+
+# Активные рассылки этого процесса: admin_chat_id -> BroadcastJob
+active_broadcasts = {}
+
+# Общий для всех рассылок процесса лимит скорости
+rate_limiter = None
+
+
+def get_rate_limiter():
+    """Возвращает общий token bucket рассылок"""
+    global rate_limiter
+    if rate_limiter is None:
+        rate_limiter = TokenBucket(get_config().BROADCAST_RATE_LIMIT)
+    return rate_limiter
+
+
+def format_duration(seconds):
+    """Форматирует длительность как М:СС"""
+    seconds = int(seconds)
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+class BroadcastJob:
+    """Состояние одной рассылки"""
+
+    def __init__(self, job_id, admin_chat_id, from_chat_id, message_id, progress_message_id,
+                 last_user_id=0, succeeded=0, failed=0):
+        self.job_id = job_id
+        self.admin_chat_id = admin_chat_id
+        self.from_chat_id = from_chat_id
+        self.message_id = message_id
+        self.progress_message_id = progress_message_id
+        self.last_user_id = last_user_id
+        self.succeeded = succeeded
+        self.failed = failed
+        self.total = succeeded + failed
+        self.cancelled = False
+        self.started_at = time.monotonic()
+        self.sent_this_run = 0
+        self.last_progress_at = 0
+        self.task = None
+
+    @property
+    def processed(self):
+        return self.succeeded + self.failed
+
+    def progress_text(self, header):
+        elapsed = time.monotonic() - self.started_at
+        remaining = max(0, self.total - self.processed)
+        text = (
+            f"{header}\n"
+            f"Всего пользователей: {self.total}\n"
+            f"Успешно: {self.succeeded}\n"
+            f"Не удалось: {self.failed}\n"
+            f"Осталось: {remaining}\n"
+            f"Прошло: {format_duration(elapsed)}"
+        )
+        if remaining and self.sent_this_run:
+            eta = elapsed / self.sent_this_run * remaining
+            text += f"\nОсталось примерно: {format_duration(eta)}"
+        return text
+
+    async def report_progress(self, bot: Bot, header, force=False):
+        """Обновляет сообщение о прогрессе не чаще BROADCAST_PROGRESS_INTERVAL"""
+        now = time.monotonic()
+        if not force and now - self.last_progress_at < get_config().BROADCAST_PROGRESS_INTERVAL:
+            return
+
+        self.last_progress_at = now
+        try:
+            await bot.edit_message_text(
+                chat_id=self.admin_chat_id,
+                message_id=self.progress_message_id,
+                text=self.progress_text(header)
+            )
+        except Exception:
+            pass  # Текст не изменился или сообщение удалено
+
+
+async def copy_to_user(bot: Bot, job: BroadcastJob, user_id, attempts=3):
+    """Копирует сообщение рассылки пользователю с учетом лимитов Telegram"""
+    limiter = get_rate_limiter()
+
+    for _ in range(attempts):
+        if job.cancelled:
+            return None
+
+        await limiter.acquire()
+        try:
+            await bot.copy_message(
+                chat_id=user_id,
+                from_chat_id=job.from_chat_id,
+                message_id=job.message_id
+            )
+            return True
+        except TelegramRetryAfter as e:
+            # Telegram просит подождать - притормаживаем все рассылки процесса
+            limiter.pause(e.retry_after)
+        except TelegramForbiddenError:
+            # Пользователь заблокировал бота - исключаем его из следующих рассылок
+            mark_user_blocked(user_id)
+            return False
+        except Exception as e:
+            logger.warning("Ошибка отправки сообщения пользователю %s: %s", user_id, e,
+                           extra={**HOT, 'user_id': user_id})
+            return False
+
+    return False
+
+
+async def heartbeat(job: BroadcastJob):
+    """Продлевает updated_at рассылки, пока она выполняется"""
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        touch_broadcast_job(job.job_id)
+
+
+async def run_broadcast(bot: Bot, job: BroadcastJob):
+    """Выполняет рассылку порциями, сохраняя курсор после каждой порции"""
+    config = get_config()
+    semaphore = asyncio.Semaphore(config.BROADCAST_CONCURRENCY)
+
+    async def send(user_id):
+        async with semaphore:
+            result = await copy_to_user(bot, job, user_id)
+        if result is None:
+            return
+        if result:
+            job.succeeded += 1
+        else:
+            job.failed += 1
+        DELIVERIES.inc('broadcast', 'ok' if result else 'failed')
+        job.sent_this_run += 1
+
+    heartbeat_task = asyncio.create_task(heartbeat(job))
+    try:
+        job.total = job.processed + count_users(job.last_user_id, exclude_blocked=True)
+
+        async for chunk in iter_user_chunks(CHUNK_SIZE, job.last_user_id, exclude_blocked=True):
+            if job.cancelled:
+                break
+
+            await asyncio.gather(*(send(user_id) for user_id in chunk))
+
+            if not job.cancelled:
+                job.last_user_id = chunk[-1]
+            update_broadcast_progress(job.job_id, job.last_user_id, job.succeeded, job.failed)
+            await job.report_progress(bot, "✉️ Рассылка в процессе...")
+
+        if job.cancelled:
+            set_broadcast_status(job.job_id, 'cancelled')
+            await job.report_progress(bot, "⏹ Рассылка остановлена!", force=True)
+        else:
+            set_broadcast_status(job.job_id, 'finished')
+            await job.report_progress(bot, "✅ Рассылка завершена!", force=True)
+
+        logger.info(f"Рассылка {job.job_id} завершена: успешно {job.succeeded}, не удалось {job.failed}")
+
+    except Exception as e:
+        # Статус остается running - рассылку продолжит следующий запуск
+        logger.error(f"❌ Ошибка рассылки {job.job_id}: {e}")
+    finally:
+        heartbeat_task.cancel()
+        if active_broadcasts.get(job.admin_chat_id) is job:
+            del active_broadcasts[job.admin_chat_id]
+
+
+def launch(bot: Bot, job: BroadcastJob):
+    """Запускает рассылку в фоне"""
+    active_broadcasts[job.admin_chat_id] = job
+    job.task = asyncio.create_task(run_broadcast(bot, job))
+    return job
+
+
+async def start_broadcast(bot: Bot, admin_chat_id, from_chat_id, message_id):
+    """Создает задачу рассылки и сразу возвращает управление обработчику"""
+    if admin_chat_id in active_broadcasts:
+        return None
+
+    progress_msg = await bot.send_message(chat_id=admin_chat_id, text="✉️ Начинаю рассылку сообщения...")
+    job_id = create_broadcast_job(INSTANCE_ID, admin_chat_id, from_chat_id, message_id, progress_msg.message_id)
+    if not job_id:
+        await progress_msg.edit_text("❌ Не удалось создать рассылку. Попробуйте позже.")
+        return None
+
+    job = BroadcastJob(job_id, admin_chat_id, from_chat_id, message_id, progress_msg.message_id)
+    return launch(bot, job)
+
+
+def cancel_broadcast(admin_chat_id):
+    """Останавливает активную рассылку администратора"""
+    job = active_broadcasts.get(admin_chat_id)
+    if not job:
+        return False
+
+    job.cancelled = True
+    return True
+
+
+async def resume_broadcasts(bot: Bot):
+    """Продолжает рассылки, прерванные перезапуском или падением экземпляра"""
+    for (job_id, admin_chat_id, from_chat_id, message_id, progress_message_id,
+         last_user_id, succeeded, failed) in claim_stale_broadcast_jobs(INSTANCE_ID, STALE_AFTER):
+        if admin_chat_id in active_broadcasts:
+            continue
+
+        logger.info(f"Продолжаем рассылку {job_id} с пользователя {last_user_id}")
+        launch(bot, BroadcastJob(job_id, admin_chat_id, from_chat_id, message_id, progress_message_id,
+                                 last_user_id, succeeded, failed))
@@ -0,0 +1,135 @@
+# bot/client.py - HTTP-клиент бота: настроенный коннектор, метрики соединений, отдельный бот для рассылок
+import asyncio
+from aiohttp import ClientSession, TraceConfig
+from aiohttp.hdrs import USER_AGENT
+from aiohttp.http import SERVER_SOFTWARE
+from aiogram import Bot, __version__ as aiogram_version
+from aiogram.client.session.aiohttp import AiohttpSession
+from bot.config import get_config
+from bot.outbound import OutboundMiddleware, INTERACTIVE, BROADCAST
+from bot.metrics import RequestMetricsMiddleware
+from bot.tracing import RequestSpanMiddleware
+
+# Счетчики соединений по назначению клиента ('interactive', 'bulk').
+# Хранятся отдельно от сессий, поэтому переживают переподключения
+client_metrics = {}
+
+
+def get_client_metrics():
+    """Запросы, новые и переиспользованные соединения, попадания в DNS-кэш по каждому клиенту"""
+    result = {}
+    for name, metrics in client_metrics.items():
+        connections = metrics['new_connections'] + metrics['reused_connections']
+        result[name] = dict(metrics, reuse_ratio=round(metrics['reused_connections'] / connections, 3)
+                            if connections else None)
+    return result
+
+
+class ManagedSession(AiohttpSession):
+    """AiohttpSession с настроенным коннектором и трассировкой соединений.
+
+    Коннектор один на всё время жизни сессии: keep-alive соединения к Bot API
+    переиспользуются между запросами, DNS кэшируется. Сколько соединений
+    открыто заново, а сколько взято из пула, видно в get_client_metrics().
+    """
+
+    def __init__(self, proxy=None, name='interactive', limit=100, keepalive_timeout=60, **kwargs):
+        super().__init__(proxy=proxy, limit=limit, **kwargs)
+        self.name = name
+        self._connector_init.update(
+            limit=limit,
+            limit_per_host=limit,
+            keepalive_timeout=keepalive_timeout,
+            ttl_dns_cache=3600,
+        )
+        self.metrics = client_metrics.setdefault(name, {
+            'sessions': 0, 'requests': 0, 'new_connections': 0, 'reused_connections': 0,
+            'dns_cache_hits': 0, 'dns_cache_misses': 0,
+        })
+
+    def _trace_config(self):
+        metrics = self.metrics
+        trace = TraceConfig()
+
+        async def count(key):
+            metrics[key] += 1
+
+        trace.on_request_start.append(lambda *args: count('requests'))
+        trace.on_connection_create_end.append(lambda *args: count('new_connections'))
+        trace.on_connection_reuseconn.append(lambda *args: count('reused_connections'))
+        trace.on_dns_cache_hit.append(lambda *args: count('dns_cache_hits'))
+        trace.on_dns_cache_miss.append(lambda *args: count('dns_cache_misses'))
+        return trace
+
+    async def create_session(self):
+        if self._should_reset_connector:
+            await self.close()
+
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=self._connector_type(**self._connector_init),
+                headers={USER_AGENT: f"{SERVER_SOFTWARE} aiogram/{aiogram_version}"},
+                trace_configs=[self._trace_config()],
+            )
+            self._should_reset_connector = False
+            self.metrics['sessions'] += 1
+
+        return self._session
+
+
+def create_session(proxy=None, api=None, name='interactive'):
+    """Сессия Bot API с лимитом соединений из настроек для данного назначения"""
+    config = get_config()
+    limit = config.BULK_CONNECTION_LIMIT if name == 'bulk' else config.BOT_CONNECTION_LIMIT
+    kwargs = {'api': api} if api else {}
+    session = ManagedSession(proxy=proxy, name=name, limit=limit, keepalive_timeout=config.HTTP_KEEPALIVE, **kwargs)
+    # Отправки идут через общую приоритетную очередь; рассылки по умолчанию - в низшем классе
+    session.middleware(OutboundMiddleware(BROADCAST if name == 'bulk' else INTERACTIVE))
+    # Метрики снаружи очереди не нужны: время запроса считается без ожидания токена
+    session.middleware(RequestMetricsMiddleware(name))
+    session.middleware(RequestSpanMiddleware())
+    return session
+
+
+async def replace_session(bot, session):
+    """Подменяет сессию бота и закрывает старую (ссылки на объект Bot остаются рабочими)"""
+    old_session = bot.session
+    bot.session = session
+    if old_session is not session:
+        try:
+            await old_session.close()
+        except Exception:
+            pass
+
+
+# Бот для массовых рассылок: тот же токен, но свой пул соединений,
+# чтобы рассылки не занимали соединения, нужные для ответов пользователям
+bulk_bot = None
+
+
+def get_bulk_bot(bot):
+    """Возвращает бота для рассылок с тем же маршрутом (прокси и адрес API), что и у bot"""
+    global bulk_bot
+    session = bot.session
+
+    if bulk_bot is None or bulk_bot.token != bot.token:
+        bulk_bot = Bot(token=bot.token, session=create_session(session.proxy, session.api, name='bulk'))
+    elif bulk_bot.session.proxy != session.proxy or bulk_bot.session.api != session.api:
+        # Основной бот переподключился по другому маршруту - переводим рассылки туда же
+        asyncio.create_task(replace_session(
+            bulk_bot, create_session(session.proxy, session.api, name='bulk')
+        ))
+
+    return bulk_bot
+
+
+async def close_bulk_bot():
+    """Закрывает бота рассылок; следующий get_bulk_bot создаст нового"""
+    global bulk_bot
+    if bulk_bot is None:
+        return
+    stale_bot, bulk_bot = bulk_bot, None
+    try:
+        await stale_bot.session.close()
+    except Exception:
+        pass
@@ -0,0 +1,232 @@
+# bot/cluster.py - несколько процессов-воркеров с маршрутизацией обновлений по user_id
+import logging
+import asyncio
+import multiprocessing
+import queue
+import zlib
+from bot.db.database import cache_listeners, drop_cached
+from bot.lifecycle import mark_serving
+
+logger = logging.getLogger(__name__)
+
+# Все процессы запускаются через spawn: fork внутри работающего цикла событий небезопасен
+mp = multiprocessing.get_context('spawn')
+
+# Сколько сообщений может ждать отправки в канал одного воркера
+WORKER_QUEUE_SIZE = 100
+
+# Как часто супервизор проверяет, что воркеры живы (в секундах)
+WATCHDOG_INTERVAL = 1
+
+
+def update_user_id(update):
+    """ID пользователя, от которого пришло обновление (словарь в формате Bot API)"""
+    for key, value in update.items():
+        if isinstance(value, dict):
+            user = value.get('from') or value.get('user') or value.get('chat')
+            if user and 'id' in user:
+                return user['id']
+    return 0
+
+
+def shard_for(user_id, workers):
+    """Номер воркера для пользователя. crc32 стабилен между процессами, в отличие от hash()"""
+    return zlib.crc32(str(user_id).encode()) % workers
+
+
+class WorkerChannel:
+    """Сторона воркера: получает обновления и инвалидации от супервизора
+    и публикует свои инвалидации кэшей для остальных воркеров."""
+
+    def __init__(self, index, conn, events):
+        self.index = index
+        self.conn = conn
+        self.events = events
+        self.received = 0
+
+    def publish_invalidation(self, name, key):
+        self.events.put(('invalidate', self.index, name, key))
+
+    async def serve(self, bot, dp):
+        """Передает обновления в диспетчер до команды остановки"""
+        cache_listeners.append(self.publish_invalidation)
+        loop = asyncio.get_running_loop()
+        self.events.put(('ready', self.index))
+
+        try:
+            while True:
+                # recv блокирующий, поэтому ждем его в потоке. Следующее сообщение читается
+                # только после передачи предыдущего в диспетчер - так работает backpressure
+                try:
+                    message = await loop.run_in_executor(None, self.conn.recv)
+                except EOFError:
+                    # Супервизор завершился
+                    return
+                kind = message[0]
+
+                if kind == 'update':
+                    self.received += 1
+                    try:
+                        await dp.feed_raw_update(bot, message[1])
+                    except Exception as e:
+                        logger.error(f"❌ Воркер {self.index}: ошибка обработки обновления: {e}")
+                elif kind == 'invalidate':
+                    drop_cached(message[1], message[2])
+                elif kind == 'stop':
+                    return
+        finally:
+            cache_listeners.remove(self.publish_invalidation)
+
+
+def run_worker(target, index, conn, events):
+    """Точка входа процесса-воркера: target(channel) - корутина, обслуживающая канал"""
+    try:
+        asyncio.run(target(WorkerChannel(index, conn, events)))
+    except KeyboardInterrupt:
+        pass
+
+
+class Supervisor:
+    """Запускает воркеры, раздает им обновления по хэшу user_id и пересылает
+    инвалидации кэшей между ними.
+
+    Все обновления одного пользователя попадают в один процесс, поэтому его
+    сессия, блокировки и кэши остаются локальными для этого процесса.
+    """
+
+    def __init__(self, target, workers):
+        self.target = target
+        self.workers = workers
+        self.events = mp.Queue()
+        self.processes = [None] * workers
+        self.connections = [None] * workers
+        self.queues = [asyncio.Queue(maxsize=WORKER_QUEUE_SIZE) for _ in range(workers)]
+        self.routed = [0] * workers
+        self.invalidations = 0
+        self.restarts = 0
+        # Следующий update_id для getUpdates: переживает ошибки и повторный запуск poll_updates
+        self.offset = None
+        self.ready = set()
+        self.all_ready = asyncio.Event()
+        self._tasks = []
+
+    def spawn(self, index):
+        receiver, sender = mp.Pipe(duplex=False)
+        process = mp.Process(
+            target=run_worker, args=(self.target, index, receiver, self.events),
+            name=f'bot-worker-{index}', daemon=True
+        )
+        process.start()
+        receiver.close()
+
+        self.processes[index] = process
+        self.connections[index] = sender
+
+    async def start(self):
+        for index in range(self.workers):
+            self.spawn(index)
+            self._tasks.append(asyncio.create_task(self.write_loop(index)))
+
+        self._tasks.append(asyncio.create_task(self.event_loop()))
+        self._tasks.append(asyncio.create_task(self.watchdog()))
+        logger.info(f"✅ Запущено воркеров: {self.workers}")
+
+    async def route(self, update):
+        """Отправляет обновление (словарь в формате Bot API) воркеру пользователя"""
+        index = shard_for(update_user_id(update), self.workers)
+        self.routed[index] += 1
+        # Если очередь воркера заполнена, ждем - это тормозит и получение новых обновлений
+        await self.queues[index].put(('update', update))
+
+    async def write_loop(self, index):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await self.queues[index].get()
+            try:
+                await loop.run_in_executor(None, self.connections[index].send, message)
+            except (BrokenPipeError, OSError) as e:
+                logger.error(f"❌ Воркер {index} недоступен: {e}")
+
+    async def event_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # get с таймаутом, чтобы поток не зависал в ожидании после остановки
+            try:
+                event = await loop.run_in_executor(None, self.events.get, True, WATCHDOG_INTERVAL)
+            except queue.Empty:
+                continue
+
+            if event[0] == 'ready':
+                self.ready.add(event[1])
+                if len(self.ready) == self.workers:
+                    self.all_ready.set()
+                    # Все воркеры обрабатывают обновления - кластер готов
+                    mark_serving()
+
+            elif event[0] == 'invalidate':
+                _, source, name, key = event
+                self.invalidations += 1
+                for index in range(self.workers):
+                    if index != source:
+                        await self.queues[index].put(('invalidate', name, key))
+
+    async def watchdog(self):
+        while True:
+            await asyncio.sleep(WATCHDOG_INTERVAL)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.warning(f"⚠️ Воркер {index} завершился (код {process.exitcode}), перезапускаем")
+                    self.connections[index].close()
+                    self.ready.discard(index)
+                    self.spawn(index)
+                    self.restarts += 1
+
+    async def stop(self, timeout=10):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+
+        for connection in self.connections:
+            try:
+                connection.send(('stop',))
+            except (BrokenPipeError, OSError):
+                pass
+
+        for process in self.processes:
+            await asyncio.get_running_loop().run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                process.terminate()
+
+    def metrics(self):
+        """Состояние кластера для сервера метрик: [(имя, {метки}, значение)]"""
+        yield 'bot_cluster_workers', {}, self.workers
+        yield 'bot_cluster_ready', {}, len(self.ready)
+        yield 'bot_cluster_invalidations', {}, self.invalidations
+        yield 'bot_cluster_restarts', {}, self.restarts
+        for index, worker_queue in enumerate(self.queues):
+            yield 'bot_cluster_routed', {'worker': index}, self.routed[index]
+            yield 'bot_cluster_queued', {'worker': index}, worker_queue.qsize()
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'ready': len(self.ready),
+            'routed': list(self.routed),
+            'queued': [worker_queue.qsize() for worker_queue in self.queues],
+            'invalidations': self.invalidations,
+            'restarts': self.restarts,
+        }
+
+
+async def poll_updates(bot, supervisor, allowed_updates=None):
+    """Long polling в супервизоре: обновления раздаются воркерам.
+
+    Смещение хранится в супервизоре: после ошибки следующий вызов продолжает
+    с первого не переданного воркерам обновления, и Telegram не присылает
+    уже розданные обновления повторно.
+    """
+    while True:
+        updates = await bot.get_updates(offset=supervisor.offset, timeout=30, allowed_updates=allowed_updates)
+        for update in updates:
+            await supervisor.route(update.model_dump(mode='json', by_alias=True, exclude_none=True))
+            supervisor.offset = update.update_id + 1
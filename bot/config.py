@@ -1,8 +1,6 @@
 import os
 from dotenv import load_dotenv
 
-load_dotenv()
-
 
 class Config:
     def __init__(self):
@@ -17,6 +15,79 @@ class Config:
         self.DB_PASSWORD = os.getenv('DB_PASSWORD')
         self.DB_PORT = int(os.getenv('DB_PORT', 3306))
 
+        # Адрес Bot API (для локальной заглушки из benchmarks/fake_telegram.py)
+        self.TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
+        # Выбор лидера для запланированных задач (несколько экземпляров бота)
+        self.LEADER_LEASE_TTL = int(os.getenv('LEADER_LEASE_TTL', 30))
+        self.LEADER_HEARTBEAT_INTERVAL = int(os.getenv('LEADER_HEARTBEAT_INTERVAL', 10))
+
+        # Распределенная очередь доставки (таблица delivery_jobs)
+        self.DELIVERY_QUEUE_ENABLED = os.getenv('DELIVERY_QUEUE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+        self.DELIVERY_WORKERS = int(os.getenv('DELIVERY_WORKERS', 1))
+        self.DELIVERY_BATCH_SIZE = int(os.getenv('DELIVERY_BATCH_SIZE', 20))
+        self.DELIVERY_VISIBILITY_TIMEOUT = int(os.getenv('DELIVERY_VISIBILITY_TIMEOUT', 60))
+        self.DELIVERY_MAX_ATTEMPTS = int(os.getenv('DELIVERY_MAX_ATTEMPTS', 3))
+        self.DELIVERY_RATE_LIMIT = int(os.getenv('DELIVERY_RATE_LIMIT', 25))  # сообщений в секунду на все процессы
+
+        # Фоновая рассылка /letter
+        self.BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 10))
+        self.BROADCAST_RATE_LIMIT = int(os.getenv('BROADCAST_RATE_LIMIT', 25))  # сообщений в секунду
+        self.BROADCAST_PROGRESS_INTERVAL = int(os.getenv('BROADCAST_PROGRESS_INTERVAL', 5))  # секунд между обновлениями
+
+        # Защита от двойных нажатий на кнопки ответа
+        self.IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 60))  # секунд
+        self.IDEMPOTENCY_SHARED = os.getenv('IDEMPOTENCY_SHARED', 'false').lower() in ('1', 'true', 'yes')
+
+        # Время жизни сессии вопросов без активности
+        self.QUIZ_SESSION_TTL = int(os.getenv('QUIZ_SESSION_TTL', 6 * 3600))  # секунд
+
+        # Ограничения обработки входящих обновлений
+        self.UPDATE_MAX_IN_FLIGHT = int(os.getenv('UPDATE_MAX_IN_FLIGHT', 50))
+        self.UPDATE_MAX_PENDING = int(os.getenv('UPDATE_MAX_PENDING', 1000))
+
+        # Способ получения обновлений: polling или webhook
+        self.BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+        self.WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # публичный адрес, например https://bot.example.com
+        self.WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+        self.WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # обязателен в режиме webhook
+        self.WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+        self.WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+        self.WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+
+        # Число процессов-воркеров в режиме polling (больше 1 - запуск через супервизор)
+        self.BOT_WORKERS = int(os.getenv('BOT_WORKERS', 1))
+
+        # Соединения с Bot API: ответы пользователям и рассылки используют разные пулы
+        self.BOT_CONNECTION_LIMIT = int(os.getenv('BOT_CONNECTION_LIMIT', 50))
+        self.BULK_CONNECTION_LIMIT = int(os.getenv('BULK_CONNECTION_LIMIT', 10))
+        self.HTTP_KEEPALIVE = int(os.getenv('HTTP_KEEPALIVE', 60))  # секунд держать простаивающее соединение
+
+        # Общий лимит исходящих сообщений процесса и доли рассылок в нем
+        self.OUTBOUND_RATE_LIMIT = int(os.getenv('OUTBOUND_RATE_LIMIT', 30))  # запросов в секунду
+        self.OUTBOUND_DAILY_SHARE = float(os.getenv('OUTBOUND_DAILY_SHARE', 0.6))
+        self.OUTBOUND_BROADCAST_SHARE = float(os.getenv('OUTBOUND_BROADCAST_SHARE', 0.4))
+
+        # HTTP-сервер метрик Prometheus и проверок /healthz, /readyz
+        # (воркеры кластера - на METRICS_PORT + номер воркера + 1)
+        self.METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+        self.METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+        self.METRICS_PORT = int(os.getenv('METRICS_PORT', 9100))
+        self.METRICS_MAX_LOOP_LAG = float(os.getenv('METRICS_MAX_LOOP_LAG', 5))  # секунд, выше - процесс не жив
+
+        # Логирование: уровень, формат (text или json) и файл (пустое значение - только консоль)
+        self.LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+        self.LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+        self.LOG_FILE = os.getenv('LOG_FILE', 'bot.log')
+
+        # Трассировка обновлений: доля обновлений в выборке (0 - выключена) и файл Chrome trace
+        self.TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0))
+        self.TRACE_FILE = os.getenv('TRACE_FILE', 'trace-{pid}.json')
+
+        # Зависание цикла событий дольше порога записывается в лог со стеком
+        self.LOOP_STALL_THRESHOLD = float(os.getenv('LOOP_STALL_THRESHOLD', 1.0))  # секунд
+        self.PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', 60))  # предел для /profile
+
         # Проверяем обязательные переменные
         required_vars = {
             'BOT_TOKEN': self.TOKEN,
@@ -27,6 +98,9 @@ class Config:
             'DB_USER': self.DB_USER,
             'DB_PASSWORD': self.DB_PASSWORD
         }
+        if self.BOT_MODE == 'webhook':
+            required_vars['WEBHOOK_URL'] = self.WEBHOOK_URL
+            required_vars['WEBHOOK_SECRET'] = self.WEBHOOK_SECRET
 
         missing_vars = [var for var, value in required_vars.items() if not value]
         if missing_vars:
@@ -34,4 +108,18 @@ class Config:
 
 
 def load_config():
+    """Читает настройки из окружения (и .env) заново"""
+    load_dotenv()
     return Config()
+
+
+# Настройки процесса, прочитанные при первом обращении
+cached_config = None
+
+
+def get_config():
+    """Возвращает общие настройки процесса, читая их один раз"""
+    global cached_config
+    if cached_config is None:
+        cached_config = load_config()
+    return cached_config
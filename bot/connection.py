@@ -0,0 +1,145 @@
+# bot/connection.py - выбор маршрута до Telegram API: параллельная гонка подключений
+import asyncio
+import time
+from aiogram import Bot
+from bot.client import create_session
+
+# Маршруты до Bot API: None - прямое подключение
+PROXY_OPTIONS = [
+    None,
+    "http://proxy.server:3128",
+]
+
+# Через сколько секунд без ответа запускать попытку по следующему маршруту
+STAGGER_DELAY = 0.25
+
+# Сколько ждать ответа get_me по одному маршруту
+CONNECT_TIMEOUT = 5
+
+# Маршрут, через который подключились в прошлый раз, пробуется первым
+connection_state = {'last_winner': None}
+
+# Статистика по маршрутам: попытки, успехи и время ответа get_me
+route_stats = {}
+
+
+def route_name(proxy):
+    return proxy or 'direct'
+
+
+def record_attempt(proxy, ok, latency=None):
+    stats = route_stats.setdefault(route_name(proxy), {
+        'attempts': 0, 'successes': 0, 'failures': 0, 'wins': 0,
+        'last_latency_ms': None, 'total_latency_ms': 0.0,
+    })
+    stats['attempts'] += 1
+    if ok:
+        stats['successes'] += 1
+        stats['last_latency_ms'] = round(latency * 1000, 1)
+        stats['total_latency_ms'] += latency * 1000
+    else:
+        stats['failures'] += 1
+
+
+def get_route_stats():
+    """Успехи, ошибки, победы в гонке и время ответа по каждому маршруту"""
+    return {
+        name: {
+            'attempts': stats['attempts'],
+            'successes': stats['successes'],
+            'failures': stats['failures'],
+            'wins': stats['wins'],
+            'last_latency_ms': stats['last_latency_ms'],
+            'avg_latency_ms': round(stats['total_latency_ms'] / stats['successes'], 1) if stats['successes'] else None,
+        }
+        for name, stats in route_stats.items()
+    }
+
+
+async def try_route(token, api, proxy, timeout):
+    """Создает бота по маршруту и проверяет его через get_me. При ошибке или отмене сессия закрывается"""
+    session = create_session(proxy, api)
+    bot = Bot(token=token, session=session)
+    started = time.monotonic()
+
+    try:
+        await asyncio.wait_for(bot.get_me(), timeout=timeout)
+    except asyncio.CancelledError:
+        await session.close()
+        raise
+    except Exception:
+        record_attempt(proxy, False)
+        await session.close()
+        raise
+
+    record_attempt(proxy, True, time.monotonic() - started)
+    return bot
+
+
+async def race_routes(token, api, routes=None, stagger=STAGGER_DELAY, timeout=CONNECT_TIMEOUT):
+    """Подключается по первому ответившему маршруту (happy eyeballs).
+
+    Попытки стартуют по очереди с интервалом stagger, а если попытка быстро
+    завершилась ошибкой - следующая стартует сразу. Первый успешный бот
+    возвращается вместе с маршрутом, остальные попытки отменяются, их сессии
+    закрываются.
+    """
+    routes = list(PROXY_OPTIONS if routes is None else routes)
+    last_winner = connection_state['last_winner']
+    if last_winner in routes:
+        routes.remove(last_winner)
+        routes.insert(0, last_winner)
+
+    loop = asyncio.get_running_loop()
+    attempts = {}
+    pending = set()
+    errors = []
+    winner = None
+
+    def collect(done):
+        nonlocal winner
+        for task in done:
+            if task.exception():
+                errors.append(f"{route_name(attempts[task])}: {task.exception()!r}")
+            elif winner is None:
+                winner = task
+
+    for index, proxy in enumerate(routes):
+        task = asyncio.create_task(try_route(token, api, proxy, timeout))
+        attempts[task] = proxy
+        pending.add(task)
+
+        is_last = index == len(routes) - 1
+        deadline = loop.time() + stagger
+        while pending and winner is None:
+            wait_for = None if is_last else deadline - loop.time()
+            if wait_for is not None and wait_for <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            collect(done)
+            if not pending:
+                # Все запущенные попытки уже завершились ошибкой - не ждем, запускаем следующую
+                break
+
+        if winner:
+            break
+
+    # Проигравшие попытки отменяем, их сессии закрываются в try_route
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+    # Попытки, успевшие завершиться успешно одновременно с победителем, тоже закрываем
+    for task in attempts:
+        if task is not winner and task.done() and not task.cancelled() and not task.exception():
+            await task.result().session.close()
+
+    if winner is None:
+        raise Exception(f"Не удалось подключиться ни через один из маршрутов: {'; '.join(errors)}")
+
+    proxy = attempts[winner]
+    connection_state['last_winner'] = proxy
+    route_stats[route_name(proxy)]['wins'] += 1
+    return winner.result(), route_name(proxy)
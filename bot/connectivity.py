@@ -0,0 +1,154 @@
+# bot/connectivity.py - фоновая проверка доступности интернета
+import logging
+import asyncio
+import time
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+PROBE_URLS = [
+    "https://api.telegram.org",
+    "https://google.com",
+    "https://cloudflare.com",
+]
+
+
+class ConnectivityMonitor:
+    """Проверяет доступность сети одной долгоживущей сессией.
+
+    Все адреса опрашиваются одновременно, для результата хватает первого ответа.
+    Запросы идут тем же маршрутом, что и запросы бота (через прокси, если бот
+    подключен через прокси), а успешное подключение к Telegram само считается
+    признаком связи.
+    Текущее состояние доступно как asyncio.Event: wait_online() возвращается,
+    как только связь появилась. Пока сети нет, проверки идут каждые
+    retry_interval секунд, а при наличии связи - каждые interval секунд.
+    """
+
+    def __init__(self, urls=PROBE_URLS, interval=30, retry_interval=2, timeout=5):
+        self.urls = urls
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        self.proxy = None
+
+        self.online = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self._session = None
+        self._task = None
+
+        self.probes = 0
+        self.failed_probes = 0
+        self.last_probe_ms = None
+        self.last_change = None
+
+    async def _fetch(self, url):
+        async with self._session.get(url, proxy=self.proxy, allow_redirects=False) as response:
+            return response.status
+
+    async def probe(self):
+        """Опрашивает все адреса одновременно. True - ответил хотя бы один"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+        started = time.monotonic()
+        tasks = [asyncio.create_task(self._fetch(url)) for url in self.urls]
+        ok = False
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    await next_done
+                except Exception:
+                    continue
+                # Любой HTTP-ответ означает, что сеть есть
+                ok = True
+                break
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.probes += 1
+        self.last_probe_ms = round((time.monotonic() - started) * 1000, 1)
+        if not ok:
+            self.failed_probes += 1
+        self._set_state(ok)
+        return ok
+
+    def _set_state(self, ok):
+        if ok != self.online.is_set():
+            self.last_change = time.time()
+            logger.warning("✅ Сеть доступна" if ok else "⚠️ Сеть недоступна")
+        if ok:
+            self.online.set()
+        else:
+            self.online.clear()
+
+    def use_route(self, proxy):
+        """Бот подключился к Telegram маршрутом proxy (None - напрямую):
+        проверки идут тем же маршрутом, а сеть считается доступной"""
+        self.proxy = proxy
+        self._set_state(True)
+
+    async def check_now(self):
+        """Немедленная проверка (например, после ошибки polling)"""
+        self.ensure_running()
+        return await self.probe()
+
+    async def wait_online(self, timeout=None):
+        """Ждет, пока сеть станет доступна. False - не дождались за timeout секунд"""
+        self.ensure_running()
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self.online.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await self.probe()
+            except Exception as e:
+                logger.warning(f"Ошибка проверки сети: {e}")
+                self._set_state(False)
+
+            delay = self.interval if self.online.is_set() else self.retry_interval
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    def stats(self):
+        return {
+            'online': self.online.is_set(),
+            'probes': self.probes,
+            'failed_probes': self.failed_probes,
+            'last_probe_ms': self.last_probe_ms,
+            'last_change': self.last_change,
+        }
+
+
+# Общий монитор сети процесса
+connectivity_monitor = None
+
+
+def get_connectivity_monitor():
+    """Возвращает общий монитор сети"""
+    global connectivity_monitor
+    if connectivity_monitor is None:
+        connectivity_monitor = ConnectivityMonitor()
+    return connectivity_monitor
@@ -1,13 +1,19 @@
 # bot/db/database.py - ФИНАЛЬНАЯ исправленная версия БЕЗ пула соединений
+import logging
 import mysql.connector
 from mysql.connector import Error
+import asyncio
 import os
+from collections import namedtuple
 from datetime import datetime
-from bot.config import load_config
+from bot.config import get_config
+from bot.metrics import DB_QUERY_SECONDS, DB_QUERY_ERRORS, cache_lookup, query_operation
+from bot.logs import HOT
+from bot.tracing import record_span
 import threading
 import time
 
-config = load_config()
+logger = logging.getLogger(__name__)
 
 # Кэш для часто используемых данных
 question_count_cache = {}
@@ -18,6 +24,17 @@ cache_lock = threading.Lock()
 # Время жизни кэша (в секундах)
 CACHE_TTL = 300  # 5 минут
 
+# Дневной лимит вопросов
+DAILY_LIMIT = 5
+
+# Результат record_answer:
+# status - 'ok', 'limit_reached' или 'not_found';
+# topic_completed/next_topic - тема завершена и на какую тему перешел пользователь (None - все темы пройдены)
+AnswerResult = namedtuple('AnswerResult', [
+    'status', 'is_correct', 'correct_option', 'explanation',
+    'topic', 'topic_completed', 'next_topic', 'daily_progress'
+])
+
 
 def cleanup_old_cache():
     """Очищает устаревшие записи в кэшах"""
@@ -39,8 +56,31 @@ def cleanup_old_cache():
                 del subscription_check_cache[user_id]
 
 
+# Подписчики на инвалидацию кэшей, вызываются как listener(name, key).
+# Через них процессы кластера сообщают друг другу об изменениях (см. bot/cluster.py)
+cache_listeners = []
+
+
+def drop_cached(name, key=None):
+    """Удаляет запись кэша name (весь кэш при key=None) только в этом процессе"""
+    cache = {'user_stats': user_stats_cache, 'question_count': question_count_cache}[name]
+    with cache_lock:
+        if key is None:
+            cache.clear()
+        else:
+            cache.pop(key, None)
+
+
+def invalidate_cache(name, key=None):
+    """Удаляет запись кэша и уведомляет подписчиков"""
+    drop_cached(name, key)
+    for listener in cache_listeners:
+        listener(name, key)
+
+
 def db_connect():
     """Простое подключение к MySQL без пула"""
+    config = get_config()
     try:
         connection = mysql.connector.connect(
             host=config.DB_HOST,
@@ -52,14 +92,18 @@ def db_connect():
         )
         return connection
     except Error as e:
-        print(f"❌ Ошибка подключения к MySQL: {e}")
+        logger.error("❌ Ошибка подключения к MySQL: %s", e, extra=HOT)
         return None
 
 
-def execute_query(query, params=None, fetch_one=False, fetch_all=False, many=False):
+def execute_query(query, params=None, fetch_one=False, fetch_all=False, many=False,
+                  rowcount=False, lastrowid=False):
     """Универсальная функция выполнения запросов"""
+    operation = query_operation(query)
+    started = time.monotonic()
     conn = db_connect()
     if not conn:
+        DB_QUERY_ERRORS.inc(operation)
         return None
 
     try:
@@ -74,6 +118,10 @@ def execute_query(query, params=None, fetch_one=False, fetch_all=False, many=Fal
             result = cursor.fetchone()
         elif fetch_all:
             result = cursor.fetchall()
+        elif rowcount:
+            result = cursor.rowcount
+        elif lastrowid:
+            result = cursor.lastrowid
         else:
             result = None
 
@@ -81,7 +129,8 @@ def execute_query(query, params=None, fetch_one=False, fetch_all=False, many=Fal
             conn.commit()
         return result
     except Error as e:
-        print(f"❌ Ошибка выполнения запроса: {e}")
+        logger.error("❌ Ошибка выполнения запроса: %s", e, extra=HOT)
+        DB_QUERY_ERRORS.inc(operation)
         if conn:
             conn.rollback()
         return None
@@ -90,13 +139,32 @@ def execute_query(query, params=None, fetch_one=False, fetch_all=False, many=Fal
             cursor.close()
         if conn:
             conn.close()
+        DB_QUERY_SECONDS.observe(time.monotonic() - started, operation)
+        record_span(operation, 'db', started)
+
+
+def ping_database():
+    """Проверка доступности БД для /readyz"""
+    return execute_query('SELECT 1', fetch_one=True) is not None
+
+
+def add_column_if_missing(cursor, table, column, definition):
+    """Добавляет колонку в существующую таблицу, если ее еще нет"""
+    cursor.execute(
+        '''SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s''',
+        (table, column)
+    )
+    if not cursor.fetchone()[0]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        logger.info(f"✅ Добавлена колонка {table}.{column}")
 
 
 def create_tables():
     """Создает таблицы в MySQL"""
     conn = db_connect()
     if not conn:
-        print("❌ Не удалось подключиться к базе данных")
+        logger.error("❌ Не удалось подключиться к базе данных")
         return
 
     cursor = conn.cursor()
@@ -112,6 +180,7 @@ def create_tables():
             current_topic_progress INT DEFAULT 0,
             completed_topics TEXT,
             role VARCHAR(20) DEFAULT 'user',
+            is_blocked TINYINT(1) DEFAULT 0,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
         ) ENGINE=InnoDB;
@@ -128,6 +197,7 @@ def create_tables():
             buttons_count INT NOT NULL,
             correct_option CHAR(1) NOT NULL,
             explanation TEXT,
+            question_key VARCHAR(191) UNIQUE,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         ) ENGINE=InnoDB;
 
@@ -147,15 +217,87 @@ def create_tables():
             INDEX idx_user_id (user_id),
             INDEX idx_question_id (question_id)
         ) ENGINE=InnoDB;
+
+        CREATE TABLE IF NOT EXISTS scheduler_leases (
+            name VARCHAR(64) PRIMARY KEY,
+            owner VARCHAR(128) NOT NULL,
+            expires_at DATETIME(3) NOT NULL
+        ) ENGINE=InnoDB;
+
+        CREATE TABLE IF NOT EXISTS delivery_batches (
+            batch_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            kind VARCHAR(20) NOT NULL,
+            status VARCHAR(20) DEFAULT 'enqueuing',
+            total INT DEFAULT 0,
+            succeeded INT DEFAULT 0,
+            failed INT DEFAULT 0,
+            skipped INT DEFAULT 0,
+            report_chat_id BIGINT,
+            report_message_id BIGINT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP NULL
+        ) ENGINE=InnoDB;
+
+        CREATE TABLE IF NOT EXISTS delivery_jobs (
+            job_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            batch_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            payload TEXT,
+            status VARCHAR(20) DEFAULT 'queued',
+            attempts INT DEFAULT 0,
+            locked_by VARCHAR(128),
+            visible_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+            last_error TEXT,
+            INDEX idx_claim (status, visible_at),
+            INDEX idx_batch (batch_id)
+        ) ENGINE=InnoDB;
+
+        CREATE TABLE IF NOT EXISTS delivery_rate_budget (
+            window_start BIGINT PRIMARY KEY,
+            used INT NOT NULL DEFAULT 0
+        ) ENGINE=InnoDB;
+
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            idem_key VARCHAR(128) PRIMARY KEY,
+            expires_at DATETIME(3) NOT NULL,
+            INDEX idx_expires_at (expires_at)
+        ) ENGINE=InnoDB;
+
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            job_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            owner VARCHAR(128),
+            admin_chat_id BIGINT NOT NULL,
+            from_chat_id BIGINT NOT NULL,
+            message_id BIGINT NOT NULL,
+            progress_message_id BIGINT,
+            status VARCHAR(20) DEFAULT 'running',
+            last_user_id BIGINT DEFAULT 0,
+            succeeded INT DEFAULT 0,
+            failed INT DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB;
+
+        CREATE TABLE IF NOT EXISTS quiz_sessions (
+            user_id BIGINT PRIMARY KEY,
+            is_active TINYINT(1) DEFAULT 0,
+            question_ids VARCHAR(255) DEFAULT '',
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_updated_at (updated_at)
+        ) ENGINE=InnoDB;
         '''
 
         for result in cursor.execute(create_tables_query, multi=True):
             pass
 
-        print("✅ Таблицы базы данных проверены/созданы")
+        # Колонки, добавленные после первого релиза (для уже созданных таблиц)
+        add_column_if_missing(cursor, 'users', 'is_blocked', 'TINYINT(1) DEFAULT 0')
+        add_column_if_missing(cursor, 'questions', 'question_key', 'VARCHAR(191) UNIQUE')
+
+        logger.info("✅ Таблицы базы данных проверены/созданы")
 
     except Error as e:
-        print(f"❌ Ошибка создания таблиц: {e}")
+        logger.error(f"❌ Ошибка создания таблиц: {e}")
     finally:
         cursor.close()
         conn.close()
@@ -163,13 +305,20 @@ def create_tables():
 
 def add_user(user_id, username):
     """Добавляет пользователя с batch обработкой"""
+    # Пользователь снова написал боту - значит, он его больше не блокирует
     execute_query(
-        '''INSERT IGNORE INTO users (user_id, username)
-        VALUES (%s, %s)''',
+        '''INSERT INTO users (user_id, username)
+        VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE is_blocked = 0''',
         (user_id, username)
     )
 
 
+def mark_user_blocked(user_id):
+    """Помечает пользователя, заблокировавшего бота, чтобы пропускать его в рассылках"""
+    execute_query('UPDATE users SET is_blocked = 1 WHERE user_id = %s', (user_id,))
+
+
 def get_user_stats(user_id):
     """Получает статистику пользователя с кэшированием"""
     current_time = time.time()
@@ -178,7 +327,9 @@ def get_user_stats(user_id):
     with cache_lock:
         if user_id in user_stats_cache:
             if current_time - user_stats_cache[user_id]['timestamp'] < CACHE_TTL:
+                cache_lookup('user_stats', True)
                 return user_stats_cache[user_id]['data']
+    cache_lookup('user_stats', False)
 
     # Если нет в кэше или устарело, получаем из БД
     result = execute_query(
@@ -213,9 +364,7 @@ def update_user_stats(user_id, correct):
         )
 
     # Инвалидируем кэш
-    with cache_lock:
-        if user_id in user_stats_cache:
-            del user_stats_cache[user_id]
+    invalidate_cache('user_stats', user_id)
 
 
 def get_questions_by_topic(user_id, topic, limit=5):
@@ -264,9 +413,7 @@ def update_user_topic_progress(user_id, topic, progress):
     )
 
     # Инвалидируем кэш
-    with cache_lock:
-        if user_id in user_stats_cache:
-            del user_stats_cache[user_id]
+    invalidate_cache('user_stats', user_id)
 
 
 def mark_topic_completed(user_id, topic):
@@ -293,9 +440,7 @@ def mark_topic_completed(user_id, topic):
     )
 
     # Инвалидируем кэш
-    with cache_lock:
-        if user_id in user_stats_cache:
-            del user_stats_cache[user_id]
+    invalidate_cache('user_stats', user_id)
 
 
 def get_questions_count_by_topic(topic):
@@ -306,7 +451,9 @@ def get_questions_count_by_topic(topic):
     with cache_lock:
         if topic in question_count_cache:
             if current_time - question_count_cache[topic]['timestamp'] < CACHE_TTL:
+                cache_lookup('question_count', True)
                 return question_count_cache[topic]['data']
+    cache_lookup('question_count', False)
 
     # Если нет в кэше или устарело, получаем из БД
     result = execute_query(
@@ -333,6 +480,65 @@ def get_all_users():
     return [row[0] for row in result] if result else []
 
 
+def build_users_filter(after_user_id=0, active_since=None, exclude_blocked=False):
+    """Собирает условие WHERE для выборок пользователей"""
+    conditions = ['user_id > %s']
+    params = [after_user_id]
+
+    if active_since is not None:
+        conditions.append('updated_at >= %s')
+        params.append(active_since)
+    if exclude_blocked:
+        conditions.append('is_blocked = 0')
+
+    return ' AND '.join(conditions), params
+
+
+def get_users_page(after_user_id=0, limit=500, active_since=None, exclude_blocked=False):
+    """Возвращает следующую страницу ID пользователей по возрастанию (keyset-пагинация)"""
+    where, params = build_users_filter(after_user_id, active_since, exclude_blocked)
+    result = execute_query(
+        f'SELECT user_id FROM users WHERE {where} ORDER BY user_id LIMIT %s',
+        (*params, limit),
+        fetch_all=True
+    )
+    return [row[0] for row in result] if result else []
+
+
+def count_users(after_user_id=0, active_since=None, exclude_blocked=False):
+    """Возвращает количество пользователей, подходящих под фильтры"""
+    where, params = build_users_filter(after_user_id, active_since, exclude_blocked)
+    result = execute_query(f'SELECT COUNT(*) FROM users WHERE {where}', tuple(params), fetch_one=True)
+    return result[0] if result else 0
+
+
+async def iter_user_chunks(chunk_size=500, after_user_id=0, active_since=None, exclude_blocked=False):
+    """Асинхронно выдает ID пользователей порциями, не загружая всю таблицу.
+
+    Следующая страница запрашивается только когда обработана предыдущая,
+    поэтому первая порция доступна сразу при любом размере таблицы.
+    """
+    while True:
+        page = await asyncio.to_thread(
+            get_users_page, after_user_id, chunk_size, active_since, exclude_blocked
+        )
+        if not page:
+            return
+
+        yield page
+
+        if len(page) < chunk_size:
+            return
+        after_user_id = page[-1]
+
+
+async def iter_users(chunk_size=500, after_user_id=0, active_since=None, exclude_blocked=False):
+    """Асинхронно перебирает ID пользователей по одному"""
+    async for chunk in iter_user_chunks(chunk_size, after_user_id, active_since, exclude_blocked):
+        for user_id in chunk:
+            yield user_id
+
+
 def get_user_daily_progress(user_id):
     """Получает прогресс пользователя за сегодня"""
     today = datetime.now().strftime('%Y-%m-%d')
@@ -373,9 +579,7 @@ def update_user_daily_progress(user_id):
         )
 
     # Инвалидируем кэш статистики пользователя
-    with cache_lock:
-        if user_id in user_stats_cache:
-            del user_stats_cache[user_id]
+    invalidate_cache('user_stats', user_id)
 
     return True
 
@@ -396,6 +600,127 @@ def add_answered_question(user_id, question_id):
     )
 
 
+def record_answer(user_id, question_id, option):
+    """Записывает ответ пользователя одной транзакцией.
+
+    Проверяет правильность и дневной лимит, сохраняет вопрос в истории,
+    обновляет счетчики и, если тема пройдена, помечает ее завершенной
+    и переводит пользователя на следующую тему. Возвращает AnswerResult.
+    """
+    conn = db_connect()
+    if not conn:
+        return None
+
+    cursor = conn.cursor()
+    today = datetime.now().strftime('%Y-%m-%d')
+
+    try:
+        conn.start_transaction()
+
+        cursor.execute(
+            'SELECT category, correct_option, explanation FROM questions WHERE question_id = %s',
+            (question_id,)
+        )
+        question = cursor.fetchone()
+        if not question:
+            conn.rollback()
+            return AnswerResult('not_found', False, None, None, None, False, None, 0)
+
+        category, correct_option, explanation = question
+        is_correct = option == correct_option
+
+        # Блокируем строку пользователя: параллельные ответы одного пользователя выполняются по очереди
+        cursor.execute(
+            'SELECT current_topic, completed_topics FROM users WHERE user_id = %s FOR UPDATE',
+            (user_id,)
+        )
+        user = cursor.fetchone()
+        if not user:
+            cursor.execute(
+                "INSERT IGNORE INTO users (user_id, username) VALUES (%s, 'unknown')",
+                (user_id,)
+            )
+            user = ('typography', '')
+        current_topic, completed_topics = user
+
+        cursor.execute(
+            'SELECT questions_asked FROM daily_progress WHERE user_id = %s AND date = %s',
+            (user_id, today)
+        )
+        row = cursor.fetchone()
+        daily_progress = row[0] if row else 0
+
+        if daily_progress >= DAILY_LIMIT:
+            conn.rollback()
+            return AnswerResult('limit_reached', is_correct, correct_option, explanation,
+                                current_topic, False, None, daily_progress)
+
+        cursor.execute(
+            '''INSERT INTO daily_progress (user_id, date, questions_asked) VALUES (%s, %s, 1)
+            ON DUPLICATE KEY UPDATE questions_asked = questions_asked + 1''',
+            (user_id, today)
+        )
+        daily_progress += 1
+
+        cursor.execute(
+            'INSERT IGNORE INTO user_answered_questions (user_id, question_id) VALUES (%s, %s)',
+            (user_id, question_id)
+        )
+        cursor.execute(
+            '''UPDATE users
+            SET total_correct = total_correct + %s, current_topic_progress = current_topic_progress + 1
+            WHERE user_id = %s''',
+            (1 if is_correct else 0, user_id)
+        )
+
+        # Проверяем, пройдена ли текущая тема: отвеченные и все вопросы темы
+        # одним запросом на соединении транзакции, пока держится блокировка строки
+        cursor.execute(
+            '''SELECT
+                (SELECT COUNT(*) FROM user_answered_questions uaq
+                 JOIN questions q ON uaq.question_id = q.question_id
+                 WHERE uaq.user_id = %s AND q.category = %s),
+                (SELECT COUNT(*) FROM questions WHERE category = %s)''',
+            (user_id, current_topic, current_topic)
+        )
+        answered, topic_total = cursor.fetchone()
+        topic_completed = answered >= topic_total
+        next_topic = None
+
+        if topic_completed:
+            completed_list = completed_topics.split(',') if completed_topics else []
+            if current_topic not in completed_list:
+                completed_list.append(current_topic)
+
+            next_topic = get_next_topic(current_topic)
+            if next_topic:
+                cursor.execute(
+                    '''UPDATE users SET completed_topics = %s, current_topic = %s, current_topic_progress = 0
+                    WHERE user_id = %s''',
+                    (','.join(completed_list), next_topic, user_id)
+                )
+            else:
+                cursor.execute(
+                    'UPDATE users SET completed_topics = %s WHERE user_id = %s',
+                    (','.join(completed_list), user_id)
+                )
+
+        conn.commit()
+        return AnswerResult('ok', is_correct, correct_option, explanation,
+                            current_topic, topic_completed, next_topic, daily_progress)
+
+    except Error as e:
+        logger.error(f"❌ Ошибка записи ответа: {e}")
+        conn.rollback()
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+        # Инвалидируем кэш
+        invalidate_cache('user_stats', user_id)
+
+
 def get_user_answered_questions_count(user_id, topic):
     """Получает количество отвеченных вопросов по теме"""
     result = execute_query(
@@ -424,35 +749,351 @@ def reset_user_progress(user_id):
     execute_query('DELETE FROM daily_progress WHERE user_id = %s', (user_id,))
 
     # Инвалидируем кэш
-    with cache_lock:
-        if user_id in user_stats_cache:
-            del user_stats_cache[user_id]
+    invalidate_cache('user_stats', user_id)
+
+
+def acquire_lease(name, owner, ttl):
+    """Захватывает или продлевает аренду. Возвращает True, если аренда принадлежит owner"""
+    # MySQL применяет присваивания слева направо, поэтому во втором IF
+    # owner уже содержит нового владельца
+    execute_query(
+        '''INSERT INTO scheduler_leases (name, owner, expires_at)
+        VALUES (%s, %s, NOW(3) + INTERVAL %s SECOND)
+        ON DUPLICATE KEY UPDATE
+            owner = IF(owner = VALUES(owner) OR expires_at < NOW(3), VALUES(owner), owner),
+            expires_at = IF(owner = VALUES(owner), VALUES(expires_at), expires_at)''',
+        (name, owner, ttl)
+    )
+
+    result = execute_query(
+        'SELECT owner FROM scheduler_leases WHERE name = %s',
+        (name,),
+        fetch_one=True
+    )
+    return bool(result) and result[0] == owner
+
+
+def release_lease(name, owner):
+    """Освобождает аренду, если она принадлежит owner"""
+    execute_query(
+        'DELETE FROM scheduler_leases WHERE name = %s AND owner = %s',
+        (name, owner)
+    )
+
+
+def create_delivery_batch(kind, report_chat_id=None, report_message_id=None):
+    """Создает пакет доставки и возвращает его ID"""
+    return execute_query(
+        '''INSERT INTO delivery_batches (kind, report_chat_id, report_message_id)
+        VALUES (%s, %s, %s)''',
+        (kind, report_chat_id, report_message_id),
+        lastrowid=True
+    )
+
+
+def enqueue_delivery_jobs(batch_id, user_ids, payload, chunk_size=1000):
+    """Добавляет задачи доставки в очередь порциями"""
+    for i in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[i:i + chunk_size]
+        execute_query(
+            'INSERT INTO delivery_jobs (batch_id, user_id, payload) VALUES (%s, %s, %s)',
+            [(batch_id, user_id, payload) for user_id in chunk],
+            many=True
+        )
+        execute_query(
+            'UPDATE delivery_batches SET total = total + %s WHERE batch_id = %s',
+            (len(chunk), batch_id)
+        )
+
+
+def start_delivery_batch(batch_id):
+    """Помечает пакет как полностью поставленный в очередь"""
+    execute_query(
+        "UPDATE delivery_batches SET status = 'running' WHERE batch_id = %s",
+        (batch_id,)
+    )
+
+
+def claim_delivery_jobs(worker_id, limit, visibility_timeout, max_attempts):
+    """Забирает задачи из очереди для воркера.
+
+    Задачи, которые воркер не завершил за visibility_timeout, снова становятся
+    видимыми для других воркеров. Исчерпавшие попытки помечаются как failed.
+    """
+    conn = db_connect()
+    if not conn:
+        return []
+
+    cursor = conn.cursor()
+
+    try:
+        conn.start_transaction()
+        cursor.execute(
+            '''SELECT job_id, batch_id, user_id, payload, attempts FROM delivery_jobs
+            WHERE status IN ('queued', 'processing') AND visible_at <= NOW(3)
+            ORDER BY job_id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED''',
+            (limit,)
+        )
+        rows = cursor.fetchall()
+
+        claimed = [row for row in rows if row[4] < max_attempts]
+        exhausted = [row for row in rows if row[4] >= max_attempts]
+
+        if claimed:
+            placeholders = ', '.join(['%s'] * len(claimed))
+            cursor.execute(
+                f'''UPDATE delivery_jobs
+                SET status = 'processing', locked_by = %s, attempts = attempts + 1,
+                    visible_at = NOW(3) + INTERVAL %s SECOND
+                WHERE job_id IN ({placeholders})''',
+                (worker_id, visibility_timeout, *[row[0] for row in claimed])
+            )
+
+        for job_id, batch_id, user_id, payload, attempts in exhausted:
+            cursor.execute(
+                "UPDATE delivery_jobs SET status = 'failed', last_error = 'max attempts' WHERE job_id = %s",
+                (job_id,)
+            )
+            cursor.execute(
+                'UPDATE delivery_batches SET failed = failed + 1 WHERE batch_id = %s',
+                (batch_id,)
+            )
+
+        conn.commit()
+        return [row[:4] for row in claimed]
+    except Error as e:
+        logger.error(f"❌ Ошибка получения задач доставки: {e}")
+        conn.rollback()
+        return []
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def finish_delivery_job(job_id, batch_id, status, error=None):
+    """Завершает задачу доставки со статусом done, failed или skipped"""
+    counter = {'done': 'succeeded', 'failed': 'failed', 'skipped': 'skipped'}[status]
+    updated = execute_query(
+        "UPDATE delivery_jobs SET status = %s, last_error = %s WHERE job_id = %s AND status = 'processing'",
+        (status, error, job_id),
+        rowcount=True
+    )
+
+    # Счетчик пакета увеличиваем только если задача не была завершена другим воркером
+    if updated:
+        execute_query(
+            f'UPDATE delivery_batches SET {counter} = {counter} + 1 WHERE batch_id = %s',
+            (batch_id,)
+        )
+
+
+def retry_delivery_job(job_id, delay, error=None):
+    """Возвращает задачу в очередь с задержкой"""
+    execute_query(
+        '''UPDATE delivery_jobs
+        SET status = 'queued', last_error = %s, visible_at = NOW(3) + INTERVAL %s SECOND
+        WHERE job_id = %s''',
+        (error, delay, job_id)
+    )
+
+
+def reserve_rate_budget(wanted, limit):
+    """Резервирует отправки в общем для всех процессов бюджете на текущую секунду.
+
+    Возвращает количество выделенных отправок (от 0 до wanted).
+    """
+    conn = db_connect()
+    if not conn:
+        return 0
+
+    cursor = conn.cursor()
+    window = int(time.time())
+
+    try:
+        cursor.execute(
+            'INSERT IGNORE INTO delivery_rate_budget (window_start, used) VALUES (%s, 0)',
+            (window,)
+        )
+        # LAST_INSERT_ID(used) запоминает значение до обновления в рамках соединения
+        cursor.execute(
+            '''UPDATE delivery_rate_budget
+            SET used = LEAST(%s, LAST_INSERT_ID(used) + %s)
+            WHERE window_start = %s''',
+            (limit, wanted, window)
+        )
+        cursor.execute('SELECT LAST_INSERT_ID()')
+        used_before = cursor.fetchone()[0]
+        return max(0, min(limit, used_before + wanted) - used_before)
+    except Error as e:
+        logger.error(f"❌ Ошибка резервирования бюджета отправок: {e}")
+        return 0
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def get_active_delivery_batches():
+    """Возвращает пакеты доставки, которые еще не завершены"""
+    return execute_query(
+        '''SELECT batch_id, kind, status, total, succeeded, failed, skipped,
+                  report_chat_id, report_message_id, created_at
+        FROM delivery_batches WHERE status IN ('enqueuing', 'running')''',
+        fetch_all=True
+    ) or []
+
+
+def finish_delivery_batch(batch_id):
+    """Помечает пакет доставки как завершенный"""
+    execute_query(
+        "UPDATE delivery_batches SET status = 'finished', finished_at = NOW() WHERE batch_id = %s",
+        (batch_id,)
+    )
+
+
+def cleanup_delivery_queue(keep_seconds=3600):
+    """Удаляет завершенные задачи и старые окна бюджета отправок"""
+    execute_query(
+        '''DELETE j FROM delivery_jobs j
+        JOIN delivery_batches b ON b.batch_id = j.batch_id
+        WHERE b.status = 'finished' AND b.finished_at < NOW() - INTERVAL %s SECOND''',
+        (keep_seconds,)
+    )
+    execute_query(
+        'DELETE FROM delivery_rate_budget WHERE window_start < %s',
+        (int(time.time()) - 60,)
+    )
+
+
+def create_broadcast_job(owner, admin_chat_id, from_chat_id, message_id, progress_message_id):
+    """Сохраняет задачу рассылки и возвращает ее ID"""
+    return execute_query(
+        '''INSERT INTO broadcast_jobs (owner, admin_chat_id, from_chat_id, message_id, progress_message_id)
+        VALUES (%s, %s, %s, %s, %s)''',
+        (owner, admin_chat_id, from_chat_id, message_id, progress_message_id),
+        lastrowid=True
+    )
+
+
+def update_broadcast_progress(job_id, last_user_id, succeeded, failed):
+    """Сохраняет курсор и счетчики рассылки (заодно продлевает updated_at)"""
+    execute_query(
+        '''UPDATE broadcast_jobs SET last_user_id = %s, succeeded = %s, failed = %s, updated_at = NOW()
+        WHERE job_id = %s''',
+        (last_user_id, succeeded, failed, job_id)
+    )
+
+
+def touch_broadcast_job(job_id):
+    """Продлевает updated_at выполняющейся рассылки без изменения прогресса"""
+    # ON UPDATE CURRENT_TIMESTAMP не срабатывает, если значения не меняются,
+    # поэтому время выставляется явно
+    execute_query(
+        "UPDATE broadcast_jobs SET updated_at = NOW() WHERE job_id = %s AND status = 'running'",
+        (job_id,)
+    )
+
+
+def set_broadcast_status(job_id, status):
+    """Меняет статус рассылки: running, finished или cancelled"""
+    execute_query(
+        'UPDATE broadcast_jobs SET status = %s WHERE job_id = %s',
+        (status, job_id)
+    )
+
+
+def claim_stale_broadcast_jobs(owner, stale_seconds):
+    """Забирает рассылки, брошенные упавшими экземплярами, и возвращает их"""
+    execute_query(
+        '''UPDATE broadcast_jobs SET owner = %s
+        WHERE status = 'running' AND updated_at < NOW() - INTERVAL %s SECOND''',
+        (owner, stale_seconds)
+    )
+    return execute_query(
+        '''SELECT job_id, admin_chat_id, from_chat_id, message_id, progress_message_id,
+                  last_user_id, succeeded, failed
+        FROM broadcast_jobs WHERE status = 'running' AND owner = %s''',
+        (owner,),
+        fetch_all=True
+    ) or []
+
+
+def claim_idempotency_key(key, ttl):
+    """Захватывает ключ идемпотентности на ttl секунд. False - ключ уже захвачен"""
+    # Без CLIENT_FOUND_ROWS rowcount равен 0, если существующая строка не изменилась
+    return bool(execute_query(
+        '''INSERT INTO idempotency_keys (idem_key, expires_at)
+        VALUES (%s, NOW(3) + INTERVAL %s SECOND)
+        ON DUPLICATE KEY UPDATE
+            expires_at = IF(expires_at < NOW(3), VALUES(expires_at), expires_at)''',
+        (key, ttl),
+        rowcount=True
+    ))
+
+
+def release_idempotency_key(key):
+    """Освобождает ключ идемпотентности до истечения срока"""
+    execute_query('DELETE FROM idempotency_keys WHERE idem_key = %s', (key,))
+
+
+def cleanup_idempotency_keys():
+    """Удаляет истекшие ключи идемпотентности"""
+    execute_query('DELETE FROM idempotency_keys WHERE expires_at < NOW(3)')
+
+
+def save_quiz_session(user_id, is_active, question_ids):
+    """Сохраняет сессию вопросов пользователя (question_ids - строка ID через запятую)"""
+    execute_query(
+        '''INSERT INTO quiz_sessions (user_id, is_active, question_ids, updated_at)
+        VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
+        ON DUPLICATE KEY UPDATE
+            is_active = VALUES(is_active),
+            question_ids = VALUES(question_ids),
+            updated_at = CURRENT_TIMESTAMP''',
+        (user_id, int(is_active), question_ids)
+    )
+
+
+def delete_quiz_session(user_id):
+    """Удаляет сессию вопросов пользователя"""
+    execute_query('DELETE FROM quiz_sessions WHERE user_id = %s', (user_id,))
+
+
+def get_quiz_sessions(ttl):
+    """Возвращает сессии, активные в последние ttl секунд: (user_id, is_active, question_ids)"""
+    return execute_query(
+        '''SELECT user_id, is_active, question_ids FROM quiz_sessions
+        WHERE updated_at > NOW() - INTERVAL %s SECOND''',
+        (ttl,), fetch_all=True
+    ) or []
+
+
+def cleanup_quiz_sessions(ttl):
+    """Удаляет сессии без активности дольше ttl секунд"""
+    execute_query('DELETE FROM quiz_sessions WHERE updated_at <= NOW() - INTERVAL %s SECOND', (ttl,))
 
 
 def load_questions_from_fs():
     """Загружает вопросы из файловой системы в MySQL БД"""
     conn = db_connect()
     if not conn:
-        print("❌ Не удалось подключиться к базе данных для загрузки вопросов")
+        logger.error("❌ Не удалось подключиться к базе данных для загрузки вопросов")
         return
 
     cursor = conn.cursor()
 
     try:
-        # Очищаем старые вопросы перед загрузкой новых
-        cursor.execute('DELETE FROM questions')
-        print("Старые вопросы удалены из базы данных")
-
         # Определяем правильный путь к папке questions
         current_dir = os.path.dirname(os.path.abspath(__file__))
         base_dir = os.path.join(current_dir, '..', '..')
         questions_dir = os.path.join(base_dir, 'questions')
         questions_dir = os.path.normpath(questions_dir)
-        print(f"Ищем вопросы в: {questions_dir}")
+        logger.info(f"Ищем вопросы в: {questions_dir}")
 
         # Проверяем существование папки
         if not os.path.exists(questions_dir):
-            print(f"❌ Папка questions не найдена по пути: {questions_dir}")
+            logger.error(f"❌ Папка questions не найдена по пути: {questions_dir}")
             return
 
         categories = ['typography', 'coloristics', 'composition', 'ux_principles', 'ui_patterns']
@@ -461,24 +1102,23 @@ def load_questions_from_fs():
 
         for category in categories:
             category_path = os.path.join(questions_dir, category)
-            print(f"Проверяем категорию: {category_path}")
+            logger.debug("Проверяем категорию: %s", category_path)
 
             if os.path.exists(category_path):
                 # Ищем все .txt файлы
                 txt_files = [f for f in os.listdir(category_path) if f.endswith('.txt')]
-                print(f"Найдено .txt файлов в {category}: {len(txt_files)}")
+                logger.info("Найдено .txt файлов в %s: %s", category, len(txt_files))
 
                 for file_name in txt_files:
                     try:
                         file_path = os.path.join(category_path, file_name)
-                        print(f"Обрабатываем файл: {file_name}")
                         with open(file_path, 'r', encoding='utf-8') as f:
                             content = f.read().strip()
 
                         # Разбираем содержимое файла
                         parts = content.split(';')
                         if len(parts) < 4:
-                            print(f"❌ Файл {file_name} имеет неправильный формат (частей: {len(parts)})")
+                            logger.error(f"❌ Файл {file_name} имеет неправильный формат (частей: {len(parts)})")
                             continue
 
                         # Первая часть - вопрос и варианты ответов
@@ -488,7 +1128,7 @@ def load_questions_from_fs():
                         try:
                             buttons_count = int(parts[1].strip())
                         except ValueError:
-                            print(f"❌ Ошибка в файле {file_name}: buttons_count должен быть числом")
+                            logger.error(f"❌ Ошибка в файле {file_name}: buttons_count должен быть числом")
                             continue
 
                         # Третья часть - правильный ответ
@@ -496,7 +1136,7 @@ def load_questions_from_fs():
 
                         # Проверяем корректность correct_option
                         if correct_option not in ['a', 'b', 'c', 'd']:
-                            print(f"❌ Ошибка в файле {file_name}: correct_option должен быть a, b, c или d")
+                            logger.error(f"❌ Ошибка в файле {file_name}: correct_option должен быть a, b, c или d")
                             continue
 
                         # Четвертая часть - объяснение
@@ -511,66 +1151,61 @@ def load_questions_from_fs():
                             potential_image = os.path.join(category_path, base_name + ext)
                             if os.path.exists(potential_image):
                                 image_path = potential_image
-                                print(f"Найдено изображение: {image_path}")
+                                logger.debug("Найдено изображение: %s", image_path)
                                 break
 
                         # Добавляем вопрос в список для batch вставки
                         questions_to_insert.append((
                             category, question_block, image_path,
                             None, None, None, None,  # options a-d
-                            buttons_count, correct_option, explanation
+                            buttons_count, correct_option, explanation,
+                            f"{category}/{base_name}"
                         ))
 
                         total_loaded += 1
-                        print(f"✓ Подготовлен вопрос из файла: {file_name}")
+                        logger.debug("✓ Подготовлен вопрос из файла: %s", file_name)
 
                     except Exception as e:
-                        print(f"❌ Ошибка загрузки вопроса {file_name}: {e}")
-                        import traceback
-                        traceback.print_exc()
+                        logger.exception(f"❌ Ошибка загрузки вопроса {file_name}: {e}")
             else:
-                print(f"❌ Папка категории {category} не найдена: {category_path}")
+                logger.error(f"❌ Папка категории {category} не найдена: {category_path}")
 
-        # Выполняем batch вставку всех вопросов
+        # Вопрос определяется ключом "категория/имя файла": при повторной загрузке
+        # строка обновляется на месте и сохраняет question_id, поэтому ID
+        # в сохраненных сессиях (quiz_sessions) остаются действительными
         if questions_to_insert:
             cursor.executemany('''INSERT INTO questions
                                (category, question_text, image_path, option_a, option_b, option_c, option_d,
-                                buttons_count, correct_option, explanation)
-                               VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)''',
+                                buttons_count, correct_option, explanation, question_key)
+                               VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                               ON DUPLICATE KEY UPDATE
+                                   category = VALUES(category),
+                                   question_text = VALUES(question_text),
+                                   image_path = VALUES(image_path),
+                                   buttons_count = VALUES(buttons_count),
+                                   correct_option = VALUES(correct_option),
+                                   explanation = VALUES(explanation)''',
                                questions_to_insert)
 
+            # Удаляем вопросы, файлов которых больше нет (и строки старого формата без ключа)
+            keys = [question[-1] for question in questions_to_insert]
+            placeholders = ', '.join(['%s'] * len(keys))
+            cursor.execute(
+                f'DELETE FROM questions WHERE question_key IS NULL OR question_key NOT IN ({placeholders})',
+                keys
+            )
+            if cursor.rowcount:
+                logger.info(f"Удалено устаревших вопросов: {cursor.rowcount}")
+
             conn.commit()
-            print(f"✅ Вопросы успешно загружены в MySQL! Всего: {total_loaded}")
+            logger.info(f"✅ Вопросы успешно загружены в MySQL! Всего: {total_loaded}")
 
             # Очищаем кэш счетчиков вопросов
-            with cache_lock:
-                question_count_cache.clear()
+            invalidate_cache('question_count')
 
     except Exception as e:
-        print(f"❌ Ошибка при загрузке вопросов: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"❌ Ошибка при загрузке вопросов: {e}")
         conn.rollback()
     finally:
         cursor.close()
         conn.close()
-
-
-# Функция для периодической очистки кэша
-def start_cache_cleanup():
-    """Запускает периодическую очистку кэша"""
-
-    def cleanup_loop():
-        while True:
-            time.sleep(CACHE_TTL)
-            cleanup_old_cache()
-
-    cleanup_thread = threading.Thread(target=cleanup_loop, daemon=True)
-    cleanup_thread.start()
-
-
-# Запускаем очистку кэша при импорте
-start_cache_cleanup()
-
-# Создаем таблицы при импорте
-create_tables()
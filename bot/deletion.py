@@ -0,0 +1,89 @@
+# bot/deletion.py - пакетное удаление сообщений через deleteMessages
+import logging
+from bot.timers import delayed_actions
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждать остальные удаления в том же чате перед отправкой пакета
+FLUSH_DELAY = 0.5
+
+# Ограничение Bot API: до 100 сообщений в одном вызове deleteMessages
+MAX_BATCH_SIZE = 100
+
+
+class DeletionBatcher:
+    """Собирает удаления сообщений по чатам и отправляет их одним deleteMessages.
+
+    Первое удаление в чате планирует отправку пакета через flush_delay секунд
+    (в общем планировщике delayed_actions, без отдельной задачи), а пакет
+    из batch_size сообщений отправляется сразу. Сообщения, которые уже удалены
+    или слишком старые, Bot API пропускает, поэтому ошибки не повторяются.
+    """
+
+    def __init__(self, flush_delay=FLUSH_DELAY, batch_size=MAX_BATCH_SIZE):
+        self.flush_delay = flush_delay
+        self.batch_size = batch_size
+        # (bot, chat_id) -> message_id в порядке добавления
+        self._pending = {}
+
+        self.requested = 0
+        self.api_calls = 0
+        self.failed_calls = 0
+
+    def add(self, bot, chat_id, message_id):
+        """Ставит сообщение в очередь на удаление"""
+        key = (bot, chat_id)
+        message_ids = self._pending.setdefault(key, {})
+        if message_id in message_ids:
+            return
+
+        message_ids[message_id] = None
+        self.requested += 1
+
+        if len(message_ids) >= self.batch_size:
+            # Пакет заполнен - переносим отправку на ближайший момент
+            delayed_actions.schedule(0, self.flush, key, key=('delete_batch', key))
+        elif len(message_ids) == 1:
+            delayed_actions.schedule(self.flush_delay, self.flush, key, key=('delete_batch', key))
+
+    async def flush(self, key):
+        """Удаляет накопленные сообщения чата одним вызовом"""
+        message_ids = self._pending.pop(key, None)
+        if not message_ids:
+            return
+
+        bot, chat_id = key
+        message_ids = list(message_ids)
+        for start in range(0, len(message_ids), self.batch_size):
+            batch = message_ids[start:start + self.batch_size]
+            self.api_calls += 1
+            try:
+                await bot.delete_messages(chat_id=chat_id, message_ids=batch)
+            except Exception as e:
+                self.failed_calls += 1
+                logger.warning(f"Ошибка пакетного удаления {len(batch)} сообщений в чате {chat_id}: {e}")
+
+    async def flush_all(self):
+        """Удаляет все накопленные сообщения (перед остановкой бота)"""
+        for key in list(self._pending):
+            delayed_actions.cancel(('delete_batch', key))
+            await self.flush(key)
+
+    def reset(self):
+        """Забывает накопленные удаления (их отправка была запланирована в завершившемся цикле)"""
+        self._pending.clear()
+
+    def stats(self):
+        pending = sum(len(message_ids) for message_ids in self._pending.values())
+        return {
+            'pending': pending,
+            'requested': self.requested,
+            'api_calls': self.api_calls,
+            'failed_calls': self.failed_calls,
+            # Без пакетов каждое отправленное удаление было бы отдельным вызовом
+            'calls_saved': self.requested - pending - self.api_calls,
+        }
+
+
+# Общий сборщик удалений бота
+deletion_batcher = DeletionBatcher()
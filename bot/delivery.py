@@ -0,0 +1,236 @@
+# bot/delivery.py - распределенная очередь доставки сообщений
+import logging
+import asyncio
+import json
+import time
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from bot.config import get_config
+from bot.db.database import (
+    create_delivery_batch, enqueue_delivery_jobs, start_delivery_batch,
+    claim_delivery_jobs, finish_delivery_job, retry_delivery_job,
+    reserve_rate_budget, get_active_delivery_batches, finish_delivery_batch,
+    cleanup_delivery_queue, mark_user_blocked, create_tables
+)
+from bot.leader import INSTANCE_ID
+from bot.subscription import check_subscription
+from bot.client import create_session
+from bot.outbound import send_priority, DAILY
+from bot.metrics import DELIVERIES
+from bot.logs import HOT, setup_logging
+
+logger = logging.getLogger(__name__)
+
+# Задачи воркеров, запущенных в этом процессе
+worker_tasks = []
+
+# Пауза между опросами пустой очереди (в секундах)
+IDLE_POLL_INTERVAL = 1.0
+
+BATCH_TITLES = {
+    'daily': '📬 Ежедневная рассылка вопросов',
+    'broadcast': '✉️ Рассылка сообщения',
+}
+
+
+async def enqueue_delivery(bot: Bot, kind, user_chunks, payload, report_chat_id=None):
+    """Ставит доставку в очередь: по одной задаче на пользователя.
+
+    user_chunks - асинхронный итератор порций ID (см. iter_user_chunks),
+    воркеры начинают доставку, пока следующие порции еще ставятся в очередь.
+    """
+    report_message_id = None
+    if report_chat_id:
+        try:
+            msg = await bot.send_message(
+                chat_id=report_chat_id,
+                text=f"{BATCH_TITLES.get(kind, kind)}: ставлю получателей в очередь..."
+            )
+            report_message_id = msg.message_id
+        except Exception as e:
+            logger.warning(f"Ошибка отправки отчета о рассылке: {e}")
+
+    batch_id = create_delivery_batch(kind, report_chat_id, report_message_id)
+    if not batch_id:
+        logger.error(f"❌ Не удалось создать пакет доставки {kind}")
+        return None
+
+    total = 0
+    payload = json.dumps(payload)
+    async for chunk in user_chunks:
+        enqueue_delivery_jobs(batch_id, chunk, payload)
+        total += len(chunk)
+    start_delivery_batch(batch_id)
+
+    logger.info(f"Пакет доставки {batch_id} ({kind}) поставлен в очередь: {total} задач")
+    return batch_id
+
+
+async def acquire_rate_budget(wanted):
+    """Ждет, пока в общем бюджете отправок не появятся свободные слоты"""
+    config = get_config()
+
+    while True:
+        granted = reserve_rate_budget(wanted, config.DELIVERY_RATE_LIMIT)
+        if granted:
+            return granted
+
+        # Бюджет текущей секунды исчерпан, ждем начала следующей
+        await asyncio.sleep(1 - time.time() % 1)
+
+
+async def deliver_job(bot: Bot, job):
+    """Выполняет одну задачу доставки. Возвращает число отправленных сообщений"""
+    job_id, batch_id, user_id, payload = job
+    config = get_config()
+    data = json.loads(payload) if payload else {}
+    kind = 'broadcast' if data.get('type') == 'broadcast' else 'daily'
+    sent = 0
+
+    try:
+        if kind == 'broadcast':
+            await bot.copy_message(
+                chat_id=user_id,
+                from_chat_id=data['from_chat_id'],
+                message_id=data['message_id']
+            )
+            sent = 1
+        else:
+            from bot.scheduler import process_user_questions
+
+            if not await check_subscription(user_id, bot):
+                finish_delivery_job(job_id, batch_id, 'skipped')
+                DELIVERIES.inc(kind, 'skipped')
+                return 0
+
+            # Тема берется из статистики пользователя внутри process_user_questions.
+            # strict=True: ошибки отправки доходят до обработчиков ниже, и задача
+            # повторяется или завершается с ошибкой, а не считается доставленной
+            with send_priority(DAILY):
+                _, sent = await process_user_questions(bot, user_id, None, strict=True)
+
+        finish_delivery_job(job_id, batch_id, 'done')
+        DELIVERIES.inc(kind, 'ok')
+        return sent
+
+    except TelegramRetryAfter as e:
+        # Telegram просит подождать - возвращаем задачу в очередь
+        retry_delivery_job(job_id, e.retry_after, str(e))
+    except TelegramForbiddenError as e:
+        # Пользователь заблокировал бота - повторять бессмысленно
+        mark_user_blocked(user_id)
+        finish_delivery_job(job_id, batch_id, 'failed', str(e))
+        DELIVERIES.inc(kind, 'failed')
+    except Exception as e:
+        logger.warning("Ошибка доставки задачи %s пользователю %s: %s", job_id, user_id, e,
+                       extra={**HOT, 'user_id': user_id})
+        retry_delivery_job(job_id, config.DELIVERY_VISIBILITY_TIMEOUT // 2, str(e))
+    return sent
+
+
+async def run_delivery_worker(bot: Bot, worker_id=INSTANCE_ID):
+    """Бесконечный цикл воркера: забирает задачи из очереди и доставляет их"""
+    config = get_config()
+    logger.info(f"Воркер доставки {worker_id} запущен")
+
+    while True:
+        try:
+            jobs = claim_delivery_jobs(
+                worker_id, config.DELIVERY_BATCH_SIZE,
+                config.DELIVERY_VISIBILITY_TIMEOUT, config.DELIVERY_MAX_ATTEMPTS
+            )
+            if not jobs:
+                await asyncio.sleep(IDLE_POLL_INTERVAL)
+                continue
+
+            # Отправляем порциями в пределах выделенного бюджета: заранее по одному
+            # сообщению на задачу, а дополнительные (уведомление о смене темы
+            # перед вопросом) списываются из бюджета после отправки
+            while jobs:
+                granted = await acquire_rate_budget(len(jobs))
+                chunk, jobs = jobs[:granted], jobs[granted:]
+                sent = await asyncio.gather(*(deliver_job(bot, job) for job in chunk))
+                extra = sum(max(count - 1, 0) for count in sent)
+                while extra > 0:
+                    extra -= await acquire_rate_budget(extra)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Ошибка воркера доставки {worker_id}: {e}")
+            await asyncio.sleep(IDLE_POLL_INTERVAL)
+
+
+def start_delivery_workers(bot: Bot):
+    """Запускает воркеры доставки в текущем процессе (один раз)"""
+    config = get_config()
+
+    if not config.DELIVERY_QUEUE_ENABLED or any(not task.done() for task in worker_tasks):
+        return
+
+    worker_tasks.clear()
+    for i in range(config.DELIVERY_WORKERS):
+        worker_id = f"{INSTANCE_ID}#{i}"
+        worker_tasks.append(asyncio.create_task(run_delivery_worker(bot, worker_id)))
+
+
+async def stop_delivery_workers():
+    """Останавливает воркеры доставки процесса (перед холодным перезапуском)"""
+    for task in worker_tasks:
+        task.cancel()
+    await asyncio.gather(*worker_tasks, return_exceptions=True)
+    worker_tasks.clear()
+
+
+async def report_delivery_progress(bot: Bot):
+    """Обновляет сводные отчеты о прогрессе пакетов в чате администратора"""
+    for (batch_id, kind, status, total, succeeded, failed, skipped,
+         report_chat_id, report_message_id, created_at) in get_active_delivery_batches():
+        processed = succeeded + failed + skipped
+        finished = status == 'running' and processed >= total
+
+        if finished:
+            finish_delivery_batch(batch_id)
+
+        if not report_chat_id or not report_message_id:
+            continue
+
+        title = BATCH_TITLES.get(kind, kind)
+        header = f"✅ {title} завершена!" if finished else f"{title} в процессе..."
+        try:
+            await bot.edit_message_text(
+                chat_id=report_chat_id,
+                message_id=report_message_id,
+                text=(
+                    f"{header}\n"
+                    f"Всего получателей: {total}\n"
+                    f"Успешно: {succeeded}\n"
+                    f"Не удалось: {failed}\n"
+                    f"Пропущено: {skipped}\n"
+                    f"Осталось: {max(0, total - processed)}"
+                )
+            )
+        except Exception:
+            pass  # Текст не изменился или сообщение удалено
+
+    cleanup_delivery_queue()
+
+
+async def main():
+    """Запускает отдельный процесс-воркер без polling"""
+    config = get_config()
+    create_tables()
+    bot = Bot(token=config.TOKEN, session=create_session(name='bulk'))
+
+    try:
+        await asyncio.gather(*(
+            run_delivery_worker(bot, f"{INSTANCE_ID}#{i}") for i in range(config.DELIVERY_WORKERS)
+        ))
+    finally:
+        await bot.session.close()
+
+
+if __name__ == "__main__":
+    config = get_config()
+    setup_logging(config.LOG_LEVEL, config.LOG_FORMAT, config.LOG_FILE)
+    asyncio.run(main())
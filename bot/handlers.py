@@ -1,147 +1,79 @@
 # bot/handlers.py - полностью оптимизированная версия
+import logging
 from aiogram import types, F
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from bot.db.database import (
-    add_user, get_user_stats, update_user_stats,
+    add_user, get_user_stats,
     get_questions_by_topic, get_question,
-    update_user_topic_progress, mark_topic_completed,
+    update_user_topic_progress,
     get_questions_count_by_topic,
-    get_user_daily_progress, update_user_daily_progress,
+    get_user_daily_progress,
     reset_daily_progress_if_needed,
     get_user_answered_questions_count,
-    add_answered_question, get_next_topic,
-    get_all_users, reset_user_progress,
-    execute_query
+    get_next_topic, record_answer,
+    iter_user_chunks, reset_user_progress
+)
+from bot.config import get_config
+from bot.delivery import enqueue_delivery
+from bot.broadcast import start_broadcast, cancel_broadcast, active_broadcasts
+from bot.client import get_bulk_bot
+from bot.timers import delayed_actions
+from bot.deletion import deletion_batcher
+from bot.metrics import HandlerMetricsMiddleware
+from bot.tracing import HandlerSpanMiddleware
+from bot.profiling import profile_event_loop
+from bot.idempotency import get_answer_guard
+from bot.update_pool import get_update_pool
+from bot.sessions import get_session_store
+from bot.subscription import (
+    subscription_cache, check_subscription,
+    SubscriptionMiddleware, OPTIONAL, SKIP
 )
-from bot.config import load_config
 import os
-import asyncio
-from aiogram.types import FSInputFile
+from aiogram.types import FSInputFile, BufferedInputFile
 from datetime import datetime
 import time
 
-# Глобальные словари с ограничением размера и TTL
-user_next_questions = {}
-user_active_sessions = {}
+logger = logging.getLogger(__name__)
+
+# Глобальные словари с TTL (сессии вопросов хранятся в bot.sessions)
 admin_broadcast_state = {}
 user_reset_states = {}
-message_delete_tasks = {}
-subscription_cache = {}
 
-# Ограничиваем размер кэшей
-MAX_CACHE_SIZE = 1000
 CACHE_TTL = 300  # 5 минут
 
-config = load_config()
-
-
-def cleanup_old_cache():
-    """Очищает устаревшие записи в кэшах"""
-    current_time = time.time()
-
-    # Очищаем кэши
-    for cache_dict in [user_next_questions, user_active_sessions,
-                       admin_broadcast_state, user_reset_states, subscription_cache]:
-        keys_to_remove = []
-        for key, value in cache_dict.items():
-            if isinstance(value, dict) and 'timestamp' in value:
-                if current_time - value['timestamp'] > CACHE_TTL:
-                    keys_to_remove.append(key)
-            elif current_time - getattr(value, 'timestamp', current_time) > CACHE_TTL:
-                keys_to_remove.append(key)
-
-        for key in keys_to_remove:
-            del cache_dict[key]
+# Пауза на чтение объяснения перед следующим вопросом (в секундах)
+NEXT_QUESTION_DELAY = 10
 
-    # Очищаем слишком большие кэши
-    for cache_dict in [user_next_questions, user_active_sessions]:
-        if len(cache_dict) > MAX_CACHE_SIZE:
-            keys_to_remove = list(cache_dict.keys())[:len(cache_dict) - MAX_CACHE_SIZE]
-            for key in keys_to_remove:
-                del cache_dict[key]
 
+def delete_message_after(message: types.Message, delay: int):
+    """Планирует удаление сообщения через delay секунд (повторный вызов переносит срок).
 
-async def delete_message_after(message: types.Message, delay: int):
-    """Удаляет сообщение после задержки с отменой предыдущих задач"""
-    user_id = message.chat.id
+    По сроку сообщение попадает в пакетное удаление чата, а не удаляется
+    отдельным запросом.
+    """
+    chat_id = message.chat.id
     message_id = message.message_id
 
-    # Отменяем предыдущую задачу удаления для этого сообщения
-    task_key = f"{user_id}_{message_id}"
-    if task_key in message_delete_tasks:
-        message_delete_tasks[task_key].cancel()
-
-    # Создаем новую задачу
-    async def delete_task():
-        await asyncio.sleep(delay)
-        try:
-            await message.delete()
-        except:
-            pass
-        finally:
-            if task_key in message_delete_tasks:
-                del message_delete_tasks[task_key]
-
-    message_delete_tasks[task_key] = asyncio.create_task(delete_task())
-
-
-async def check_subscription(user_id, bot, force_check=False):
-    """Проверяет подписку с кэшированием"""
-    current_time = time.time()
-
-    # Если принудительная проверка, игнорируем кэш
-    if not force_check:
-        # Проверяем кэш
-        if user_id in subscription_cache:
-            if current_time - subscription_cache[user_id]['timestamp'] < CACHE_TTL:
-                return subscription_cache[user_id]['subscribed']
-
-    # Если нет в кэше или устарело, проверяем через API
-    try:
-        member = await bot.get_chat_member(chat_id=config.CHANNEL_ID, user_id=user_id)
-        is_subscribed = member.status in ['member', 'administrator', 'creator']
-
-        # Сохраняем в кэш
-        subscription_cache[user_id] = {
-            'subscribed': is_subscribed,
-            'timestamp': current_time
-        }
-
-        return is_subscribed
-    except Exception as e:
-        print(f"Ошибка при проверке подписки: {e}")
-        return False
-
-async def ask_for_subscription(message: types.Message):
-    """Просит пользователя подписаться на канал"""
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📢 Подписаться на канал", url="https://t.me/matzar_studio")],
-        [InlineKeyboardButton(text="✅ Проверить подписку", callback_data="check_subscription")]
-    ])
-
-    await message.answer(
-        "⚠️ Для использования бота необходимо подписаться на канал @matzar_studio.\n\n"
-        "После подписки нажмите кнопку 'Проверить подписку' ниже.",
-        reply_markup=keyboard
+    delayed_actions.schedule(
+        delay, deletion_batcher.add, message.bot, chat_id, message_id,
+        key=('delete', chat_id, message_id)
     )
 
 
-async def start_command(message: types.Message):
+async def start_command(message: types.Message, is_subscribed: bool):
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name
     add_user(user_id, username)
     reset_daily_progress_if_needed()
 
     # Проверяем, является ли пользователь администратором
-    is_admin = str(user_id) == config.ADMIN_ID
+    is_admin = str(user_id) == get_config().ADMIN_ID
 
     # Получаем имя пользователя для приветствия
     user_first_name = message.from_user.first_name or "друг"
 
-    # Проверяем подписку с кэшированием
-    is_subscribed = await check_subscription(user_id, message.bot)
-
     welcome_text = (
         f"🎨 Привет, {user_first_name}!\n\n"
         "Я помогу вам изучить основы дизайна через ежедневное обучение.\n\n"
@@ -181,6 +113,7 @@ async def start_command(message: types.Message):
             "\n👑 Команды администратора:\n"
             "/letter - отправить сообщение всем пользователям\n"
             "/out - отменить рассылку\n"
+            "/profile [секунд] - профиль цикла событий\n"
         )
 
     welcome_text += "\n💡 Не удаляйте сообщения с вопросами - они помогут в обучении!"
@@ -189,17 +122,8 @@ async def start_command(message: types.Message):
 
 
 async def stats_command(message: types.Message):
-    # Проверяем подписку с кэшированием
-    is_subscribed = await check_subscription(message.from_user.id, message.bot)
-    if not is_subscribed:
-        await ask_for_subscription(message)
-        return
-
     # Удаляем сообщение пользователя с командой /stats
-    try:
-        await message.delete()
-    except:
-        pass
+    deletion_batcher.add(message.bot, message.chat.id, message.message_id)
 
     user_id = message.from_user.id
     stats = get_user_stats(user_id)
@@ -258,21 +182,15 @@ async def stats_command(message: types.Message):
     stats_msg = await message.answer(response)
 
     # Определяем время удаления в зависимости от активности сессии
-    if user_id in user_active_sessions and user_active_sessions[user_id]:
+    if get_session_store().is_active(user_id):
         # Активная сессия - удаляем через 10 секунд
-        asyncio.create_task(delete_message_after(stats_msg, 10))
+        delete_message_after(stats_msg, 10)
     else:
         # Неактивная сессия - удаляем через 60 секунд
-        asyncio.create_task(delete_message_after(stats_msg, 60))
+        delete_message_after(stats_msg, 60)
 
 
 async def today_command(message: types.Message):
-    # Проверяем подписку с кэшированием
-    is_subscribed = await check_subscription(message.from_user.id, message.bot)
-    if not is_subscribed:
-        await ask_for_subscription(message)
-        return
-
     user_id = message.from_user.id
 
     # Проверяем дневной лимит ПЕРЕД началом сессии
@@ -288,11 +206,11 @@ async def today_command(message: types.Message):
 
             msg = await message.answer(
                 "❌ Вы уже ответили на 5 вопросов сегодня. Следующие вопросы будут доступны завтра.")
-            asyncio.create_task(delete_message_after(msg, 10))
+            delete_message_after(msg, 10)
             return
 
     # Проверяем, есть ли уже активная сессия
-    if user_id in user_active_sessions and user_active_sessions[user_id]:
+    if get_session_store().is_active(user_id):
         # Удаляем сообщение пользователя с командой /today
         try:
             await message.delete()
@@ -301,7 +219,7 @@ async def today_command(message: types.Message):
 
         # Отправляем и удаляем сообщение бота о активной сессии
         msg = await message.answer("❌ Вы уже просматриваете сегоднящние вопросы. Завершите текущую сессию!")
-        asyncio.create_task(delete_message_after(msg, 10))
+        delete_message_after(msg, 10)
         return
 
     """Отправляет сегодняшние вопросы (до 5)"""
@@ -324,11 +242,11 @@ async def today_command(message: types.Message):
 
         # Отправляем и удаляем сообщение бота о лимите
         msg = await message.answer("❌ Вы уже ответили на 5 вопросов сегодня. Следующие вопросы будут доступны завтра.")
-        asyncio.create_task(delete_message_after(msg, 10))
+        delete_message_after(msg, 10)
         return
 
     # Помечаем сессию как активную
-    user_active_sessions[user_id] = True
+    get_session_store().activate(user_id)
 
     # Проверяем, завершена ли текущая тема
     total_questions = get_questions_count_by_topic(current_topic)
@@ -346,7 +264,7 @@ async def today_command(message: types.Message):
             # Все темы завершены
             await message.answer("🎉 Поздравляем! Вы завершили все темы!")
             # Снимаем отметку об активной сессии
-            user_active_sessions[user_id] = False
+            get_session_store().deactivate(user_id)
             return
 
     # Проверяем, есть ли вопросы в теме
@@ -354,7 +272,7 @@ async def today_command(message: types.Message):
     if topic_questions_count == 0:
         await message.answer(f"❌ Вопросы по теме '{current_topic}' не найдены.\n\nАдминистратор добавит вопросы скоро.")
         # Снимаем отметку об активной сессии
-        user_active_sessions[user_id] = False
+        get_session_store().deactivate(user_id)
         return
 
     # Получаем вопросы для текущей темы (только те, на которые еще не ответили)
@@ -379,16 +297,16 @@ async def today_command(message: types.Message):
             if not question_ids:
                 await message.answer(f"❌ В теме '{current_topic}' тоже нет вопросов.")
                 # Снимаем отметку об активной сессии
-                user_active_sessions[user_id] = False
+                get_session_store().deactivate(user_id)
                 return
         else:
             await message.answer("🎉 Поздравляем! Вы завершили все темы!")
             # Снимаем отметку об активной сессии
-            user_active_sessions[user_id] = False
+            get_session_store().deactivate(user_id)
             return
 
     # Сохраняем следующие вопросы для пользователя
-    user_next_questions[user_id] = question_ids
+    get_session_store().set_questions(user_id, question_ids)
 
     # Отправляем первый вопрос
     await send_next_question(message, user_id)
@@ -405,18 +323,18 @@ async def letter_command(message: types.Message):
         pass
 
     # Проверяем, является ли пользователь администратором
-    if str(user_id) != config.ADMIN_ID:
+    if str(user_id) != get_config().ADMIN_ID:
         msg = await message.answer("❌ У вас нет прав для выполнения этой команды.")
-        asyncio.create_task(delete_message_after(msg, 60))
+        delete_message_after(msg, 60)
         return
 
     # Устанавливаем состояние рассылки
     admin_broadcast_state[user_id] = True
     msg = await message.answer(
         "✉️ Режим рассылки активирован. Отправьте сообщение, которое будет отправлено всем пользователям.\n\n"
-        "Используйте /out для отмены."
+        "Используйте /out для отмены (в том числе уже запущенной рассылки)."
     )
-    asyncio.create_task(delete_message_after(msg, 60))
+    delete_message_after(msg, 60)
 
 
 async def out_command(message: types.Message):
@@ -430,9 +348,15 @@ async def out_command(message: types.Message):
         pass
 
     # Проверяем, является ли пользователь администратором
-    if str(user_id) != config.ADMIN_ID:
+    if str(user_id) != get_config().ADMIN_ID:
         msg = await message.answer("❌ У вас нет прав для выполнения этой команды.")
-        asyncio.create_task(delete_message_after(msg, 60))
+        delete_message_after(msg, 60)
+        return
+
+    # Останавливаем уже запущенную рассылку
+    if cancel_broadcast(message.chat.id):
+        msg = await message.answer("⏹ Останавливаю рассылку...")
+        delete_message_after(msg, 60)
         return
 
     # Отключаем состояние рассылки
@@ -440,7 +364,45 @@ async def out_command(message: types.Message):
         del admin_broadcast_state[user_id]
 
     msg = await message.answer("❌ Режим рассылки отменен.")
-    asyncio.create_task(delete_message_after(msg, 60))
+    delete_message_after(msg, 60)
+
+
+async def profile_command(message: types.Message, command: CommandObject):
+    """Профилирует цикл событий N секунд и присылает collapsed stacks (только для администратора)"""
+    user_id = message.from_user.id
+
+    deletion_batcher.add(message.bot, message.chat.id, message.message_id)
+
+    if str(user_id) != get_config().ADMIN_ID:
+        msg = await message.answer("❌ У вас нет прав для выполнения этой команды.")
+        delete_message_after(msg, 60)
+        return
+
+    max_seconds = get_config().PROFILE_MAX_SECONDS
+    try:
+        seconds = min(max(int(command.args or 10), 1), max_seconds)
+    except ValueError:
+        msg = await message.answer(f"Использование: /profile [секунд, до {max_seconds}]")
+        delete_message_after(msg, 60)
+        return
+
+    status_msg = await message.answer(f"🔬 Профилирую цикл событий {seconds} с...")
+    profiler = await profile_event_loop(seconds)
+    deletion_batcher.add(message.bot, status_msg.chat.id, status_msg.message_id)
+    if profiler is None:
+        msg = await message.answer("⚠️ Профайлер уже запущен, дождитесь результата.")
+        delete_message_after(msg, 60)
+        return
+
+    top = '\n'.join(f"{count} × {name}" for name, count in profiler.top_functions())
+    await message.answer_document(
+        BufferedInputFile(profiler.collapsed().encode('utf-8'), filename=f"profile-{int(time.time())}.collapsed"),
+        caption=(
+            f"🔬 Профиль за {seconds} с, сэмплов: {profiler.total}\n"
+            f"Чаще всего на вершине стека:\n{top}\n\n"
+            "Файл открывается в speedscope.app или flamegraph.pl"
+        )[:1024]
+    )
 
 
 async def handle_broadcast_message(message: types.Message):
@@ -454,74 +416,32 @@ async def handle_broadcast_message(message: types.Message):
     # Отключаем состояние рассылки
     del admin_broadcast_state[user_id]
 
-    # Получаем всех пользователей
-    users = get_all_users()
-    total_users = len(users)
-    successful = 0
-    failed = 0
-
-    # Отправляем сообщение о начале рассылки
-    progress_msg = await message.answer(f"✉️ Начинаю рассылку сообщения для {total_users} пользователей...")
-
-    # Функция для отправки сообщения пользователю
-    async def send_to_user(user_id):
-        try:
-            # Используем copy_message для копирования исходного сообщения
-            await message.bot.copy_message(
-                chat_id=user_id,
-                from_chat_id=message.chat.id,
-                message_id=message.message_id
-            )
-            return True
-        except Exception as e:
-            print(f"Ошибка отправки сообщения пользователю {user_id}: {e}")
-            return False
-
-    # Отправляем сообщение всем пользователям с ограничением скорости
-    for i, user_id in enumerate(users):
-        if await send_to_user(user_id):
-            successful += 1
-        else:
-            failed += 1
+    # В режиме очереди рассылку выполняют воркеры доставки
+    if get_config().DELIVERY_QUEUE_ENABLED:
+        payload = {'type': 'broadcast', 'from_chat_id': message.chat.id, 'message_id': message.message_id}
+        await enqueue_delivery(message.bot, 'broadcast', iter_user_chunks(exclude_blocked=True), payload,
+                               report_chat_id=message.chat.id)
+        return True
 
-        # Обновляем прогресс каждые 10 отправок и делаем небольшую паузу
-        if (i + 1) % 10 == 0:
-            try:
-                await progress_msg.edit_text(
-                    f"✉️ Рассылка в процессе...\n"
-                    f"Успешно: {successful}\n"
-                    f"Не удалось: {failed}\n"
-                    f"Осталось: {total_users - i - 1}"
-                )
-                await asyncio.sleep(0.1)  # Небольшая пауза
-            except:
-                pass
-
-    # Отправляем финальный отчет
-    await progress_msg.edit_text(
-        f"✅ Рассылка завершена!\n"
-        f"Всего пользователей: {total_users}\n"
-        f"Успешно: {successful}\n"
-        f"Не удалось: {failed}"
-    )
+    # Рассылка идет в фоне, обработчик администратора сразу освобождается
+    job = await start_broadcast(get_bulk_bot(message.bot), message.chat.id, message.chat.id, message.message_id)
+    if not job and message.chat.id in active_broadcasts:
+        msg = await message.answer("⚠️ Рассылка уже выполняется. Используйте /out для отмены.")
+        delete_message_after(msg, 60)
 
     return True
 
 
 async def end_questions_session(message, user_id):
     """Завершает сессию вопросов с финальным сообщением"""
-    # Очищаем оставшиеся вопросы
-    if user_id in user_next_questions:
-        del user_next_questions[user_id]
-
-    # Снимаем отметку об активной сессии
-    user_active_sessions[user_id] = False
+    # Очищаем оставшиеся вопросы и снимаем отметку об активной сессии
+    get_session_store().end(user_id)
 
     final_msg = await message.answer(
         "🎉 Вы ответили на все 5 вопросов сегодня!\n\n"
         "Завтра вас ждут новые вопросы. Не забывайте заглядывать!"
     )
-    asyncio.create_task(delete_message_after(final_msg, 10))
+    delete_message_after(final_msg, 10)
 
 
 async def send_next_question(message, user_id):
@@ -529,7 +449,7 @@ async def send_next_question(message, user_id):
     # Проверяем дневной лимит ПЕРЕД отправкой вопроса
     stats = get_user_stats(user_id)
     if not stats:
-        user_active_sessions[user_id] = False
+        get_session_store().deactivate(user_id)
         return
 
     total_correct, current_topic, progress, completed_topics, user_role, daily_progress = stats
@@ -540,10 +460,10 @@ async def send_next_question(message, user_id):
         return
 
     # Если нет сохраненных вопросов, получаем новые
-    if user_id not in user_next_questions or not user_next_questions[user_id]:
+    if not get_session_store().has_questions(user_id):
         stats = get_user_stats(user_id)
         if not stats:
-            user_active_sessions[user_id] = False
+            get_session_store().deactivate(user_id)
             return
 
         total_correct, current_topic, progress, completed_topics, user_role, daily_progress = stats
@@ -562,10 +482,10 @@ async def send_next_question(message, user_id):
             await end_questions_session(message, user_id)
             return
 
-        user_next_questions[user_id] = question_ids
+        get_session_store().set_questions(user_id, question_ids)
 
     # Берем следующий вопрос
-    question_id = user_next_questions[user_id].pop(0)
+    question_id = get_session_store().pop_question(user_id)
     question_data = get_question(question_id)
 
     if question_data:
@@ -584,7 +504,7 @@ async def send_next_question(message, user_id):
             await send_question(message, question_data, f"// {topic_name}")
     else:
         await message.answer("❌ Не удалось загрузить вопрос. Попробуйте позже.")
-        user_active_sessions[user_id] = False
+        get_session_store().deactivate(user_id)
 
 
 async def send_question(message, question_data, caption):
@@ -617,7 +537,7 @@ async def send_question(message, question_data, caption):
         else:
             msg = await message.answer(full_question_text, reply_markup=keyboard)
     except Exception as e:
-        print(f"Ошибка при отправке вопроса: {e}")
+        logger.warning(f"Ошибка при отправке вопроса: {e}")
         msg = await message.answer(full_question_text, reply_markup=keyboard)
 
     return msg
@@ -632,120 +552,85 @@ async def handle_answer(callback_query: types.CallbackQuery):
     question_id = int(data[1])
     user_answer = data[2]
 
-    # Проверяем дневной лимит перед обработкой ответа
-    stats = get_user_stats(user_id)
-    if stats:
-        total_correct, current_topic, progress, completed_topics, user_role, daily_progress = stats
-        if daily_progress >= 5:
-            # Лимит достигнут, завершаем сессию
-            await end_questions_session(callback_query.message, user_id)
-            return
+    # Повторное нажатие на кнопку того же вопроса отбрасываем до любых запросов к БД
+    guard = get_answer_guard()
+    guard_key = (user_id, question_id)
+    if not guard.try_acquire(guard_key):
+        return
+
+    # Проверка ответа, лимит, история, счетчики и завершение темы - одной транзакцией
+    try:
+        result = record_answer(user_id, question_id, user_answer)
+    except Exception:
+        guard.release(guard_key)
+        raise
+    if not result:
+        # Ответ не записан (ошибка БД): кнопки остаются, повторное нажатие обработается заново
+        guard.release(guard_key)
+        return
 
     # Отключаем все кнопки в сообщении
     try:
-        if callback_query.message.photo:
-            await callback_query.message.edit_reply_markup(reply_markup=None)
-        else:
-            await callback_query.message.edit_reply_markup(reply_markup=None)
+        await callback_query.message.edit_reply_markup(reply_markup=None)
     except:
         pass  # Игнорируем ошибки, если сообщение уже было изменено
 
-    question_data = get_question(question_id)
-    if not question_data:
+    if result.status == 'not_found':
         return
 
-    (question_id, category, question_block, image_path,
-     option_a, option_b, option_c, option_d,
-     buttons_count, correct_option, explanation, created_at) = question_data
-
-    is_correct = user_answer == correct_option
-
-    # Добавляем вопрос в отвеченные
-    add_answered_question(user_id, question_id)
-
-    # Обновляем статистику
-    if is_correct:
-        update_user_stats(user_id, True)
-        response = f"✅ Правильно\n\n{explanation}"
-    else:
-        response = f"❌ Неправильно \nПравильный ответ: {correct_option.lower()})\n\n{explanation}"
-
-    # ОБНОВЛЯЕМ ПРОГРЕСС ПО ТЕМЕ
-    # Получаем текущую тему пользователя
-    stats = get_user_stats(user_id)
-    if stats:
-        total_correct, current_topic, progress, completed_topics, user_role, daily_progress = stats
-        # Увеличиваем прогресс по теме на 1
-        new_progress = progress + 1
-        execute_query(
-            'UPDATE users SET current_topic_progress = %s WHERE user_id = %s',
-            (new_progress, user_id)
-        )
-
-    # Обновляем дневной прогресс
-    if not update_user_daily_progress(user_id):
+    if result.status == 'limit_reached':
         # Лимит достигнут, завершаем сессию
         await end_questions_session(callback_query.message, user_id)
         return
 
+    if result.is_correct:
+        response = f"✅ Правильно\n\n{result.explanation}"
+    else:
+        response = f"❌ Неправильно \nПравильный ответ: {result.correct_option.lower()})\n\n{result.explanation}"
+
     # Отправляем ответ как отдельное сообщение
     result_message = await callback_query.message.answer(response)
 
-    # Проверяем, завершена ли текущая тема ПОСЛЕ объяснения
-    stats = get_user_stats(user_id)
-    topic_completed = False
-    if stats:
-        # ИСПРАВЛЕНО: распаковываем 6 значений вместо 5
-        total_correct, current_topic, progress, completed_topics, user_role, daily_progress = stats
-        total_questions = get_questions_count_by_topic(current_topic)
-        answered_questions = get_user_answered_questions_count(user_id, current_topic)
+    # Показываем статичный таймер и планируем продолжение через общий планировщик,
+    # чтобы обработчик не держал корутину и не тратил 9 вызовов edit_text на анимацию
+    timer_msg = await callback_query.message.answer(
+        f"⏳ Следующий вопрос через {NEXT_QUESTION_DELAY} секунд..."
+    )
+    delayed_actions.schedule(
+        NEXT_QUESTION_DELAY, continue_after_answer,
+        callback_query.message, result_message, timer_msg, result, user_id,
+        key=('next_question', user_id)
+    )
 
-        # Если тема завершена, помечаем ее как завершенную
-        if answered_questions >= total_questions:
-            mark_topic_completed(user_id, current_topic)
-            topic_completed = True
 
-    # Отправляем анимированный таймер
-    timer_msg = await callback_query.message.answer("⏳ Следующий вопрос через 10 секунд...")
+async def continue_after_answer(message, result_message, timer_msg, result, user_id):
+    """Продолжает сессию после паузы на чтение объяснения.
 
-    # Анимируем таймер (обновляем каждую секунду)
-    for seconds_left in range(9, 0, -1):
-        await asyncio.sleep(1)
-        try:
-            await timer_msg.edit_text(f"⏳ Следующий вопрос через {seconds_left} секунд...")
-        except:
-            break  # Если сообщение было удалено, прерываем цикл
+    Выполняется из delayed_actions, вне обработки обновления, поэтому берет
+    блокировку пользователя в UpdatePool: /today или новый ответ того же
+    пользователя не изменят его сессию одновременно с продолжением.
+    """
+    async with get_update_pool().user_lock(user_id):
+        await advance_after_answer(message, result_message, timer_msg, result, user_id)
 
-    # Удаляем таймер
-    await timer_msg.delete()
-
-    # Убираем кнопки из исходного сообщения (если еще не убрали)
-    try:
-        # Получаем текст исходного сообщения
-        original_text = callback_query.message.caption if callback_query.message.photo else callback_query.message.text
 
-        # Редактируем сообщение, убирая клавиатуру (если еще не убрали)
-        if callback_query.message.photo:
-            await callback_query.message.edit_caption(caption=original_text, reply_markup=None)
-        else:
-            await callback_query.message.edit_text(text=original_text, reply_markup=None)
-    except:
-        pass  # Игнорируем ошибки редактирования
+async def advance_after_answer(message, result_message, timer_msg, result, user_id):
+    # Удаляем таймер
+    deletion_batcher.add(timer_msg.bot, timer_msg.chat.id, timer_msg.message_id)
 
-    # Удаляем только временную часть сообщения с результатом через 0 секунд
-    await asyncio.sleep(0)
+    # Кнопки исходного сообщения уже убраны в handle_answer
     try:
         # Оставляем только объяснение, удаляя первую часть сообщения
-        await result_message.edit_text(explanation)
+        await result_message.edit_text(result.explanation)
     except:
         # Если не получилось отредактировать, просто удаляем всё сообщение
-        await result_message.delete()
+        deletion_batcher.add(result_message.bot, result_message.chat.id, result_message.message_id)
 
     # Если тема завершена, отправляем сообщение о переходе ПОСЛЕ объяснения
-    if topic_completed:
-        next_topic = get_next_topic(current_topic)
+    # (сам переход на следующую тему уже сохранен в record_answer)
+    if result.topic_completed:
+        next_topic = result.next_topic
         if next_topic:
-            update_user_topic_progress(user_id, next_topic, 0)
             # Уведомляем пользователя о переходе
             topic_names = {
                 'typography': 'Типографика',
@@ -755,15 +640,15 @@ async def handle_answer(callback_query: types.CallbackQuery):
                 'ui_patterns': 'UI-паттерны',
             }
             next_topic_name = topic_names.get(next_topic, next_topic.capitalize())
-            await callback_query.message.answer(
+            await message.answer(
                 f"🎉 Тема завершена! Переходим к следующей теме: {next_topic_name}"
             )
         else:
-            await callback_query.message.answer("🎉 Поздравляем! Вы завершили все темы!")
+            await message.answer("🎉 Поздравляем! Вы завершили все темы!")
             return
 
     # Отправляем следующий вопрос
-    await send_next_question(callback_query.message, user_id)
+    await send_next_question(message, user_id)
 
 
 async def check_subscription_callback(callback_query: types.CallbackQuery):
@@ -798,12 +683,6 @@ async def check_subscription_callback(callback_query: types.CallbackQuery):
 
 
 async def reset_progress_command(message: types.Message):
-    # Проверяем подписку с кэшированием
-    is_subscribed = await check_subscription(message.from_user.id, message.bot)
-    if not is_subscribed:
-        await ask_for_subscription(message)
-        return
-
     user_id = message.from_user.id
 
     # Удаляем сообщение с командой
@@ -852,11 +731,7 @@ async def handle_reset_confirmation(callback_query: types.CallbackQuery):
 
         # Удаляем сообщение с подтверждением
         if user_id in user_reset_states:
-            try:
-                await callback_query.bot.delete_message(chat_id=user_id, message_id=user_reset_states[user_id])
-            except:
-                pass
-            del user_reset_states[user_id]
+            deletion_batcher.add(callback_query.bot, user_id, user_reset_states.pop(user_id))
 
         # Отправляем подтверждение сброса
         confirmation_msg = await callback_query.message.answer(
@@ -865,37 +740,35 @@ async def handle_reset_confirmation(callback_query: types.CallbackQuery):
         )
 
         # Удаляем сообщение через 5 секунд
-        asyncio.create_task(delete_message_after(confirmation_msg, 5))
+        delete_message_after(confirmation_msg, 5)
 
     elif action == "cancel":
         # Отменяем сброс
         if user_id in user_reset_states:
-            try:
-                await callback_query.bot.delete_message(chat_id=user_id, message_id=user_reset_states[user_id])
-            except:
-                pass
-            del user_reset_states[user_id]
+            deletion_batcher.add(callback_query.bot, user_id, user_reset_states.pop(user_id))
 
         # Отправляем сообщение об отмене
         cancel_msg = await callback_query.message.answer("❌ Сброс прогресса отменен.")
 
         # Удаляем сообщение через 5 секунд
-        asyncio.create_task(delete_message_after(cancel_msg, 5))
+        delete_message_after(cancel_msg, 5)
 
-    # Удаляем исходное сообщение с кнопками
-    try:
-        await callback_query.message.delete()
-    except:
-        pass
+    # Удаляем исходное сообщение с кнопками (вместе с подтверждением - одним запросом)
+    deletion_batcher.add(callback_query.bot, callback_query.message.chat.id, callback_query.message.message_id)
 
 
 def cleanup_old_cache():
     """Очищает устаревшие записи в кэшах handlers"""
     current_time = time.time()
 
+    # Очищаем истекшие ключи защиты от двойных нажатий
+    get_answer_guard().prune()
+
+    # Сессии вопросов истекают по времени последней активности
+    get_session_store().expire()
+
     # Очищаем кэши
-    for cache_dict in [user_next_questions, user_active_sessions,
-                       admin_broadcast_state, user_reset_states, subscription_cache]:
+    for cache_dict in [admin_broadcast_state, user_reset_states, subscription_cache]:
         keys_to_remove = []
         for key, value in cache_dict.items():
             if isinstance(value, dict) and 'timestamp' in value:
@@ -907,24 +780,33 @@ def cleanup_old_cache():
         for key in keys_to_remove:
             del cache_dict[key]
 
-    # Очищаем слишком большие кэши
-    for cache_dict in [user_next_questions, user_active_sessions]:
-        if len(cache_dict) > MAX_CACHE_SIZE:
-            keys_to_remove = list(cache_dict.keys())[:len(cache_dict) - MAX_CACHE_SIZE]
-            for key in keys_to_remove:
-                del cache_dict[key]
-
 
 def register_handlers(dp):
-    dp.message.register(start_command, Command('start'))
+    # Время обработчиков (вместе с проверкой подписки)
+    handler_metrics = HandlerMetricsMiddleware()
+    dp.message.middleware(handler_metrics)
+    dp.callback_query.middleware(handler_metrics)
+    handler_spans = HandlerSpanMiddleware()
+    dp.message.middleware(handler_spans)
+    dp.callback_query.middleware(handler_spans)
+
+    # Подписка проверяется до обработчика; исключения помечены флагом subscription
+    subscription_middleware = SubscriptionMiddleware()
+    dp.message.middleware(subscription_middleware)
+    dp.callback_query.middleware(subscription_middleware)
+
+    dp.message.register(start_command, Command('start'), flags={'subscription': OPTIONAL})
     dp.message.register(stats_command, Command('stats'))
     dp.message.register(today_command, Command('today'))
     dp.message.register(reset_progress_command, Command('reset_progress'))
-    dp.message.register(letter_command, Command('letter'))
-    dp.message.register(out_command, Command('out'))
+    dp.message.register(letter_command, Command('letter'), flags={'subscription': SKIP})
+    dp.message.register(out_command, Command('out'), flags={'subscription': SKIP})
+    dp.message.register(profile_command, Command('profile'), flags={'subscription': SKIP})
     dp.callback_query.register(handle_answer, F.data.startswith('answer_'))
-    dp.callback_query.register(check_subscription_callback, F.data == "check_subscription")
-    dp.callback_query.register(handle_reset_confirmation, F.data.startswith('reset_'))
+    dp.callback_query.register(check_subscription_callback, F.data == "check_subscription",
+                               flags={'subscription': SKIP})
+    dp.callback_query.register(handle_reset_confirmation, F.data.startswith('reset_'),
+                               flags={'subscription': SKIP})
 
     # Добавляем обработчик для сообщений (должен быть последним)
-    dp.message.register(handle_broadcast_message, F.chat.type == "private")
+    dp.message.register(handle_broadcast_message, F.chat.type == "private", flags={'subscription': SKIP})
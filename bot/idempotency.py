@@ -0,0 +1,74 @@
+# bot/idempotency.py - защита от повторной обработки одинаковых callback
+import time
+from bot.config import get_config
+from bot.db.database import claim_idempotency_key, release_idempotency_key
+
+# Как часто чистить устаревшие ключи (в проверках)
+PRUNE_EVERY = 1000
+
+
+class IdempotencyGuard:
+    """Пропускает только первое событие с данным ключом в пределах TTL.
+
+    Проверка идет в памяти процесса, без обращений к БД. С shared=True ключ
+    дополнительно захватывается в таблице idempotency_keys, чтобы дубликат не
+    обработал другой процесс.
+    """
+
+    def __init__(self, ttl, shared=False):
+        self.ttl = ttl
+        self.shared = shared
+        self._expires = {}
+        self._checks = 0
+        self.accepted = 0
+        self.duplicates = 0
+
+    def try_acquire(self, key):
+        """Возвращает True для первого события с ключом и False для дубликатов"""
+        now = time.monotonic()
+
+        self._checks += 1
+        if self._checks % PRUNE_EVERY == 0:
+            self.prune(now)
+
+        expires_at = self._expires.get(key)
+        if expires_at and expires_at > now:
+            self.duplicates += 1
+            return False
+
+        if self.shared and not claim_idempotency_key(':'.join(map(str, key)), self.ttl):
+            # Событие уже обработал другой процесс - запоминаем это локально
+            self._expires[key] = now + self.ttl
+            self.duplicates += 1
+            return False
+
+        self._expires[key] = now + self.ttl
+        self.accepted += 1
+        return True
+
+    def release(self, key):
+        """Освобождает ключ, если событие не удалось обработать: повтор будет принят"""
+        if self._expires.pop(key, None) is not None and self.shared:
+            release_idempotency_key(':'.join(map(str, key)))
+
+    def prune(self, now=None):
+        """Удаляет ключи с истекшим TTL"""
+        now = now or time.monotonic()
+        for key in [key for key, expires_at in self._expires.items() if expires_at <= now]:
+            del self._expires[key]
+
+    def stats(self):
+        return {'accepted': self.accepted, 'duplicates': self.duplicates, 'keys': len(self._expires)}
+
+
+# Защита от двойных нажатий на кнопки ответа: ключ (user_id, question_id)
+answer_guard = None
+
+
+def get_answer_guard():
+    """Возвращает общий guard для callback ответов"""
+    global answer_guard
+    if answer_guard is None:
+        config = get_config()
+        answer_guard = IdempotencyGuard(config.IDEMPOTENCY_TTL, shared=config.IDEMPOTENCY_SHARED)
+    return answer_guard
@@ -0,0 +1,96 @@
+# bot/leader.py - выбор лидера для запланированных задач
+import logging
+import asyncio
+import functools
+import os
+import socket
+import time
+import uuid
+from bot.config import get_config
+from bot.db.database import acquire_lease, release_lease
+
+logger = logging.getLogger(__name__)
+
+# Имя аренды в таблице scheduler_leases
+LEASE_NAME = 'scheduler'
+
+# Уникальный идентификатор этого экземпляра бота
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# Состояние лидерства текущего экземпляра
+leader_state = {'is_leader': False, 'last_renewal': 0}
+
+
+def renew_leadership():
+    """Захватывает или продлевает аренду лидера (heartbeat)"""
+    config = get_config()
+
+    try:
+        acquired = acquire_lease(LEASE_NAME, INSTANCE_ID, config.LEADER_LEASE_TTL)
+    except Exception as e:
+        logger.warning(f"Ошибка продления аренды лидера: {e}")
+        acquired = False
+
+    was_leader = leader_state['is_leader']
+    if acquired and not was_leader:
+        logger.info(f"👑 Экземпляр {INSTANCE_ID} стал лидером планировщика")
+    elif not acquired and was_leader:
+        logger.warning(f"⚠️ Экземпляр {INSTANCE_ID} потерял лидерство планировщика")
+
+    leader_state['is_leader'] = acquired
+    if acquired:
+        leader_state['last_renewal'] = time.time()
+
+    return acquired
+
+
+def is_leader():
+    """Проверяет, что экземпляр является лидером и аренда еще не истекла"""
+    config = get_config()
+
+    # Если продление не удавалось дольше TTL, другой экземпляр мог забрать аренду
+    return (leader_state['is_leader'] and
+            time.time() - leader_state['last_renewal'] < config.LEADER_LEASE_TTL)
+
+
+def resign_leadership():
+    """Освобождает аренду, чтобы другой экземпляр сразу стал лидером"""
+    if not leader_state['is_leader']:
+        return
+
+    try:
+        release_lease(LEASE_NAME, INSTANCE_ID)
+        logger.info(f"Экземпляр {INSTANCE_ID} освободил лидерство планировщика")
+    except Exception as e:
+        logger.warning(f"Ошибка освобождения аренды лидера: {e}")
+    finally:
+        leader_state['is_leader'] = False
+
+
+def leader_only(job):
+    """Оборачивает задачу планировщика, чтобы она выполнялась только на лидере.
+
+    Обычные функции остаются обычными - APScheduler по-прежнему выполняет их в пуле
+    потоков. Для корутин продление аренды (запрос к БД) уходит в поток, чтобы не
+    блокировать цикл событий.
+    """
+
+    def skip():
+        logger.info(f"⏭ Задача {job.__name__} пропущена: экземпляр не является лидером")
+
+    if not asyncio.iscoroutinefunction(job):
+        @functools.wraps(job)
+        def sync_wrapper(*args, **kwargs):
+            if not is_leader() and not renew_leadership():
+                return skip()
+            return job(*args, **kwargs)
+
+        return sync_wrapper
+
+    @functools.wraps(job)
+    async def wrapper(*args, **kwargs):
+        if not is_leader() and not await asyncio.to_thread(renew_leadership):
+            return skip()
+        return await job(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,82 @@
+# bot/lifecycle.py - уровни перезапуска бота и время до возобновления работы
+import asyncio
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Уровни перезапуска, от самого легкого к самому тяжелому:
+# reconnect - пересоздается только сессия Telegram (сетевые сбои polling);
+# warm - перезапускается получение обновлений, бот, БД, планировщик и кэши переиспользуются;
+# cold - полная инициализация: схема БД, вопросы, обработчики, планировщик.
+RECONNECT = 'reconnect'
+WARM = 'warm'
+COLD = 'cold'
+
+restart_state = {
+    'level': COLD,
+    'started_at': time.monotonic(),
+    'pending': True,
+    'cold_requested': False,
+    'counts': {RECONNECT: 0, WARM: 0, COLD: 0},
+    'history': deque(maxlen=20),
+}
+
+
+def begin_restart(level):
+    """Отмечает начало перезапуска заданного уровня"""
+    restart_state['level'] = level
+    restart_state['started_at'] = time.monotonic()
+    restart_state['pending'] = True
+    restart_state['counts'][level] += 1
+
+
+def mark_serving():
+    """Вызывается, когда бот снова принимает обновления. Возвращает время перезапуска"""
+    if not restart_state['pending']:
+        return None
+
+    elapsed = time.monotonic() - restart_state['started_at']
+    restart_state['pending'] = False
+    restart_state['history'].append((restart_state['level'], elapsed))
+    logger.info(f"⏱ Перезапуск ({restart_state['level']}): {elapsed:.2f} с до начала обработки обновлений")
+    return elapsed
+
+
+def request_cold_restart():
+    """Требует полной инициализации при следующем перезапуске"""
+    restart_state['cold_requested'] = True
+
+
+def reset_loop_state():
+    """Готовит процесс к новому циклу событий после падения предыдущего.
+
+    Общие пулы, очереди и мониторы хранят задачи и примитивы asyncio старого
+    цикла, поэтому они сбрасываются и создаются заново в новом цикле, а
+    следующий запуск выполняет холодный старт.
+    """
+    from bot import broadcast, connectivity, delivery, metrics, outbound, scheduler, update_pool
+    from bot.deletion import deletion_batcher
+    from bot.timers import delayed_actions
+
+    update_pool.update_pool = None
+    outbound.outbound_queue = None
+    connectivity.connectivity_monitor = None
+    metrics.loop_lag_monitor = None
+    broadcast.rate_limiter = None
+    broadcast.active_broadcasts.clear()
+    delivery.worker_tasks.clear()
+    scheduler.sending_lock = asyncio.Lock()
+    delayed_actions.reset()
+    deletion_batcher.reset()
+
+    request_cold_restart()
+
+
+def restart_stats():
+    """Число перезапусков по уровням и последние времена до начала обработки"""
+    last = {}
+    for level, elapsed in restart_state['history']:
+        last[level] = round(elapsed, 3)
+    return {'counts': dict(restart_state['counts']), 'last_seconds': last}
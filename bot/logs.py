@@ -0,0 +1,160 @@
+# bot/logs.py - логирование через очередь: запись в файл и консоль вне цикла событий
+import atexit
+import json
+import logging
+import queue
+import time
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from aiogram import BaseMiddleware
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Обновление, которое сейчас обрабатывается: поля попадают в каждую запись лога
+update_context = ContextVar('log_update_context', default=None)
+
+# Атрибуты LogRecord, которые есть у любой записи; остальные - поля из extra
+STANDARD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+# Пометка для записей горячего пути: extra=HOT или extra={**HOT, 'user_id': ...}
+HOT = {'rate_limited': True}
+
+
+class UpdateContextMiddleware(BaseMiddleware):
+    """Outer middleware для dp.update: запоминает update_id и user_id для логов.
+
+    Регистрируется до UpdatePool: контекст копируется в задачу обработки.
+    """
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        token = update_context.set({'update_id': event.update_id, 'user_id': user.id if user else None})
+        try:
+            return await handler(event, data)
+        finally:
+            update_context.reset(token)
+
+
+class UpdateContextFilter(logging.Filter):
+    """Добавляет к записи update_id и user_id текущего обновления"""
+
+    def filter(self, record):
+        context = update_context.get()
+        if context:
+            for key, value in context.items():
+                if value is not None and not hasattr(record, key):
+                    setattr(record, key, value)
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Ограничивает записи, помеченные HOT: не больше burst за interval секунд
+    с одного места в коде. Число пропущенных добавляется к следующей записи.
+
+    Фильтр стоит на QueueHandler, поэтому пропущенные записи не форматируются
+    и не попадают в очередь.
+    """
+
+    def __init__(self, interval=10.0, burst=5):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        # (логгер, строка) -> [начало окна, записей в окне, пропущено]
+        self._windows = {}
+        self.suppressed = 0
+
+    def filter(self, record):
+        if not getattr(record, 'rate_limited', False):
+            return True
+
+        now = time.monotonic()
+        key = (record.name, record.lineno)
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.interval:
+            skipped = window[2] if window else 0
+            window = self._windows[key] = [now, 0, 0]
+            if skipped:
+                record.suppressed = skipped
+        if window[1] >= self.burst:
+            window[2] += 1
+            self.suppressed += 1
+            return False
+
+        window[1] += 1
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: время, уровень, логгер, сообщение и поля из extra"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRIBUTES and key != 'rate_limited':
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Обычный текстовый формат; пропущенные ограничителем записи указываются в конце"""
+
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', None)
+        return f"{text} (пропущено похожих: {suppressed})" if suppressed else text
+
+
+# Поток записи логов процесса
+log_listener = None
+
+
+def stop_logging():
+    """Останавливает поток записи логов и закрывает его обработчики"""
+    global log_listener
+    if log_listener is None:
+        return
+    listener, log_listener = log_listener, None
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+def setup_logging(level='INFO', fmt='text', path='bot.log'):
+    """Настраивает корневой логгер: записи уходят в очередь, а в файл и консоль
+    их пишет отдельный поток QueueListener.
+
+    Повторный вызов (reset_loop_state, перезапуск) останавливает прежний поток;
+    обработчик atexit регистрируется один раз.
+    """
+    global log_listener
+    stop_logging()
+
+    formatter = JsonFormatter() if fmt == 'json' else TextFormatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if path:
+        handlers.append(logging.FileHandler(path, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter())
+    queue_handler.addFilter(UpdateContextFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+
+    log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+    # unregister убирает регистрацию прошлого вызова, чтобы она не дублировалась
+    atexit.unregister(stop_logging)
+    atexit.register(stop_logging)
+    return log_listener
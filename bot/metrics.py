@@ -0,0 +1,406 @@
+# bot/metrics.py - метрики процесса в формате Prometheus и проверки живости/готовности
+import logging
+import asyncio
+import json
+import threading
+import time
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from bot.config import get_config
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм по умолчанию, в секундах
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Все счетчики и гистограммы процесса
+registry = []
+
+# Функции, возвращающие текущие значения (gauge): [(имя, {метки}, значение)]
+collectors = []
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in labels.items()
+    )
+    return '{' + pairs + '}'
+
+
+def format_value(value):
+    if isinstance(value, float) and value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+class Counter:
+    """Монотонный счетчик с метками.
+
+    Значения обновляются и из потоков (execute_query в asyncio.to_thread и
+    run_in_executor), поэтому изменения и чтение идут под блокировкой.
+    """
+
+    type = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def snapshot(self):
+        """Копия значений: метки -> значение"""
+        with self._lock:
+            return dict(self.values)
+
+    def samples(self):
+        for label_values, value in self.snapshot().items():
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+
+class Histogram:
+    """Гистограмма с накопительными корзинами, суммой и числом наблюдений"""
+
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # метки -> [счетчики корзин, сумма, число наблюдений]
+        self.series = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self):
+        """Копия серий: метки -> (счетчики корзин, сумма, число наблюдений)"""
+        with self._lock:
+            return {label_values: (list(counts), total, count)
+                    for label_values, (counts, total, count) in self.series.items()}
+
+    def samples(self):
+        for label_values, (counts, total, count) in self.snapshot().items():
+            labels = dict(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", dict(labels, le=format_value(float(bound))), cumulative
+            yield f"{self.name}_bucket", dict(labels, le='+Inf'), count
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Время выполнения обработчика', ('event', 'handler'))
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Исключения в обработчиках', ('event', 'handler'))
+DB_QUERY_SECONDS = Histogram('bot_db_query_seconds', 'Время запроса execute_query', ('operation',))
+DB_QUERY_ERRORS = Counter('bot_db_query_errors_total', 'Ошибки запросов execute_query', ('operation',))
+CACHE_REQUESTS = Counter('bot_cache_requests_total', 'Обращения к кэшам', ('cache', 'result'))
+API_REQUESTS = Counter('bot_api_requests_total', 'Запросы к Bot API', ('client', 'method'))
+API_ERRORS = Counter('bot_api_errors_total', 'Ошибки запросов к Bot API', ('method', 'error'))
+API_SECONDS = Histogram('bot_api_request_seconds', 'Время запроса к Bot API', ('method',))
+DELIVERIES = Counter('bot_deliveries_total', 'Сообщения ежедневной рассылки и рассылок /letter', ('kind', 'result'))
+LOOP_LAG_SECONDS = Histogram('bot_event_loop_lag_seconds', 'Задержка цикла событий',
+                             buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+LOOP_STALL_SECONDS = Histogram('bot_event_loop_stall_seconds', 'Зависания цикла событий дольше порога',
+                               buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+
+
+def cache_lookup(cache, hit):
+    """Отмечает попадание или промах кэша"""
+    CACHE_REQUESTS.inc(cache, 'hit' if hit else 'miss')
+
+
+def query_operation(query):
+    """Тип запроса для метки: select, insert, update..."""
+    return query.lstrip().split(None, 1)[0].lower() if query.strip() else 'unknown'
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner middleware: время каждого обработчика message и callback_query"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = getattr(getattr(handler_object, 'callback', None), '__name__', 'unknown')
+        event_type = 'callback_query' if hasattr(event, 'data') and hasattr(event, 'message') else 'message'
+
+        started = time.monotonic()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(event_type, name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.monotonic() - started, event_type, name)
+
+
+class RequestMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: число, ошибки и время запросов к Bot API по методам"""
+
+    def __init__(self, client):
+        self.client = client
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        API_REQUESTS.inc(self.client, name)
+        started = time.monotonic()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            API_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(time.monotonic() - started, name)
+
+
+class LoopLagMonitor:
+    """Измеряет, насколько позже срока просыпается sleep в цикле событий"""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.last_tick = None
+        self._task = None
+
+    def ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            LOOP_LAG_SECONDS.observe(lag)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.last_tick = time.monotonic()
+
+    def stats(self):
+        return {'last_lag_ms': round(self.last_lag * 1000, 2), 'max_lag_ms': round(self.max_lag * 1000, 2)}
+
+
+# Монитор задержки цикла событий процесса
+loop_lag_monitor = None
+
+
+def get_loop_lag_monitor():
+    """Возвращает общий монитор задержки цикла событий"""
+    global loop_lag_monitor
+    if loop_lag_monitor is None:
+        loop_lag_monitor = LoopLagMonitor()
+    return loop_lag_monitor
+
+
+def flat_gauges(prefix, stats, **labels):
+    """Числовые поля словаря stats как gauge с именами prefix_поле"""
+    for key, value in stats.items():
+        if isinstance(value, (bool, int, float)):
+            yield f"{prefix}_{key}", labels, value
+
+
+def collect_component_stats():
+    """Текущее состояние сервисов бота. Сервисы, которые еще не созданы, пропускаются"""
+    from bot import update_pool, outbound, sessions, idempotency, connectivity, webhook, client, tracing, profiling
+    from bot.subscription import subscription_cache
+    from bot.deletion import deletion_batcher
+    from bot.timers import delayed_actions
+    from bot.connection import get_route_stats
+    from bot.lifecycle import restart_state, restart_stats
+
+    if update_pool.update_pool:
+        yield from flat_gauges('bot_update_pool', update_pool.update_pool.stats())
+    if outbound.outbound_queue:
+        stats = outbound.outbound_queue.stats()
+        yield from flat_gauges('bot_outbound', stats)
+        for priority, class_stats in stats['classes'].items():
+            yield from flat_gauges('bot_outbound', class_stats, priority=priority)
+    if sessions.session_store:
+        yield from flat_gauges('bot_quiz_sessions', sessions.session_store.stats())
+    if idempotency.answer_guard:
+        yield from flat_gauges('bot_answer_guard', idempotency.answer_guard.stats())
+    if connectivity.connectivity_monitor:
+        yield from flat_gauges('bot_connectivity', connectivity.connectivity_monitor.stats())
+    if webhook.webhook_server:
+        yield from flat_gauges('bot_webhook', webhook.webhook_server.stats())
+    if tracing.tracer:
+        yield from flat_gauges('bot_tracing', tracing.tracer.stats())
+    if profiling.stall_watchdog:
+        yield from flat_gauges('bot_event_loop', profiling.stall_watchdog.stats())
+    for name, client_stats in client.get_client_metrics().items():
+        yield from flat_gauges('bot_http', client_stats, client=name)
+    for name, route_stats in get_route_stats().items():
+        yield from flat_gauges('bot_route', route_stats, route=name)
+
+    yield from flat_gauges('bot_deletions', deletion_batcher.stats())
+    yield from flat_gauges('bot_delayed_actions', delayed_actions.stats())
+    yield 'bot_subscription_cache_size', {}, len(subscription_cache)
+
+    restarts = restart_stats()
+    for level, count in restarts['counts'].items():
+        yield 'bot_restarts', {'level': level}, count
+    for level, seconds in restarts['last_seconds'].items():
+        yield 'bot_restart_last_seconds', {'level': level}, seconds
+    yield 'bot_serving', {}, not restart_state['pending']
+
+    if loop_lag_monitor:
+        yield 'bot_event_loop_lag_last_seconds', {}, loop_lag_monitor.last_lag
+
+    # Доля попаданий по каждому кэшу
+    totals = {}
+    for (cache, result), count in CACHE_REQUESTS.snapshot().items():
+        hits, total = totals.get(cache, (0, 0))
+        totals[cache] = (hits + (count if result == 'hit' else 0), total + count)
+    for cache, (hits, total) in totals.items():
+        yield 'bot_cache_hit_ratio', {'cache': cache}, hits / total if total else 0.0
+
+
+collectors.append(collect_component_stats)
+
+
+def render():
+    """Все метрики процесса в текстовом формате Prometheus"""
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+
+    gauges = {}
+    for collector in collectors:
+        try:
+            for name, labels, value in collector():
+                gauges.setdefault(name, []).append((labels, value))
+        except Exception as e:
+            logger.warning(f"Ошибка сбора метрик {getattr(collector, '__name__', collector)}: {e}")
+    for name, samples in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+
+    return '\n'.join(lines) + '\n'
+
+
+def check_database():
+    from bot.db.database import ping_database
+    return ping_database()
+
+
+class MetricsServer:
+    """HTTP-сервер метрик и проверок для оркестратора.
+
+    /metrics - метрики Prometheus; /healthz - процесс жив (цикл событий не
+    завис); /readyz - бот готов принимать обновления: есть БД и связь с Telegram.
+    """
+
+    def __init__(self, max_loop_lag=5.0, db_timeout=2.0):
+        self.max_loop_lag = max_loop_lag
+        self.db_timeout = db_timeout
+        self._runner = None
+
+    async def handle_metrics(self, request):
+        return web.Response(text=render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def handle_live(self, request):
+        monitor = get_loop_lag_monitor()
+        stalled = monitor.last_tick is not None and time.monotonic() - monitor.last_tick > self.max_loop_lag
+        live = not stalled and monitor.last_lag < self.max_loop_lag
+        return self.json_response(live, monitor.stats())
+
+    async def handle_ready(self, request):
+        from bot.connectivity import connectivity_monitor
+        from bot.lifecycle import restart_state
+
+        checks = {}
+        try:
+            checks['database'] = bool(await asyncio.wait_for(
+                asyncio.get_running_loop().run_in_executor(None, check_database), timeout=self.db_timeout
+            ))
+        except Exception:
+            checks['database'] = False
+
+        # Связь с Telegram: бот обрабатывает обновления, а монитор сети (если уже
+        # проверял) видит сеть
+        checks['telegram'] = not restart_state['pending'] and (
+            connectivity_monitor is None or connectivity_monitor.probes == 0
+            or connectivity_monitor.online.is_set()
+        )
+        return self.json_response(all(checks.values()), checks)
+
+    @staticmethod
+    def json_response(ok, details):
+        return web.Response(status=200 if ok else 503, content_type='application/json',
+                            text=json.dumps({'ok': ok, **details}, ensure_ascii=False))
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        app.router.add_get('/healthz', self.handle_live)
+        app.router.add_get('/readyz', self.handle_ready)
+        return app
+
+    async def start(self, host, port):
+        get_loop_lag_monitor().ensure_running()
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"📈 Метрики доступны на http://{host}:{port}/metrics")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+# Сервер метрик процесса
+metrics_server = None
+
+
+async def start_metrics_server(port_offset=0):
+    """Запускает сервер метрик, если он включен в настройках (один раз на процесс).
+
+    Воркеры кластера передают port_offset = номер воркера + 1: у каждого свой
+    порт после METRICS_PORT, а на METRICS_PORT отвечает супервизор.
+    """
+    global metrics_server
+    config = get_config()
+    if not config.METRICS_ENABLED or metrics_server is not None:
+        return None
+
+    metrics_server = MetricsServer(max_loop_lag=config.METRICS_MAX_LOOP_LAG)
+    await metrics_server.start(config.METRICS_HOST, config.METRICS_PORT + port_offset)
+    return metrics_server
+
+
+async def stop_metrics_server():
+    """Останавливает сервер метрик (перед завершением цикла событий)"""
+    global metrics_server
+    if metrics_server is not None:
+        await metrics_server.stop()
+        metrics_server = None
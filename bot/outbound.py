@@ -0,0 +1,192 @@
+# bot/outbound.py - приоритетная очередь исходящих запросов к Bot API
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from bot.config import get_config
+from bot.ratelimit import TokenBucket
+
+# Классы приоритета: чем меньше номер, тем раньше запрос получает токен
+INTERACTIVE = 'interactive'  # ответы пользователям: следующий вопрос, результат ответа
+DAILY = 'daily'              # ежедневная рассылка вопросов
+BROADCAST = 'broadcast'      # рассылки администратора /letter
+
+PRIORITIES = {INTERACTIVE: 0, DAILY: 1, BROADCAST: 2}
+
+# Методы, которые расходуют лимит отправки сообщений
+LIMITED_PREFIXES = ('Send', 'Copy', 'Forward', 'Edit', 'Delete')
+
+# Класс приоритета текущего контекста; None - по назначению сессии
+current_priority = ContextVar('outbound_priority', default=None)
+
+
+@contextmanager
+def send_priority(priority):
+    """Все запросы внутри блока (и в запущенных из него задачах) идут с этим приоритетом"""
+    token = current_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+def is_limited(method):
+    return type(method).__name__.startswith(LIMITED_PREFIXES)
+
+
+class OutboundQueue:
+    """Раздает общий бюджет отправок между классами приоритета.
+
+    Общий token bucket ограничивает скорость всех запросов процесса. У DAILY
+    и BROADCAST есть еще свои корзины - доля от общей скорости, - поэтому
+    рассылки не могут занять весь бюджет. Когда токенов не хватает, запросы
+    ждут в очереди и получают токены по приоритету, внутри класса - по порядку.
+    """
+
+    def __init__(self, rate, shares):
+        self.bucket = TokenBucket(rate)
+        self.class_buckets = {
+            priority: TokenBucket(rate * share, max(1, rate * share))
+            for priority, share in shares.items() if share < 1
+        }
+        self._waiters = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+        self.metrics = {
+            priority: {'requests': 0, 'queued': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+            for priority in PRIORITIES
+        }
+        self.retry_after_pauses = 0
+
+    def _try_take(self, priority):
+        class_bucket = self.class_buckets.get(priority)
+        if class_bucket and class_bucket.wait_time() > 0:
+            return False
+        if not self.bucket.try_acquire():
+            return False
+        if class_bucket:
+            class_bucket.try_acquire()
+        return True
+
+    async def acquire(self, priority):
+        """Ждет токен для запроса данного класса"""
+        metrics = self.metrics[priority]
+        metrics['requests'] += 1
+
+        # Без очереди - только если никто не ждет, иначе обгоняли бы ожидающих
+        if not self._waiters and self._try_take(priority):
+            return
+
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (PRIORITIES[priority], next(self._counter), priority, future))
+        metrics['queued'] += 1
+        self._ensure_dispatcher()
+        self._wakeup.set()
+
+        try:
+            await future
+        finally:
+            waited = time.monotonic() - started
+            metrics['wait_total'] += waited
+            metrics['wait_max'] = max(metrics['wait_max'], waited)
+
+    def _ensure_dispatcher(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def _dispatch(self):
+        while self._waiters:
+            delay = None
+            blocked = set()
+            # Выдаем токены по приоритету. Если класс уперся в свою долю,
+            # токен может получить следующий класс
+            for _, _, priority, future in sorted(self._waiters):
+                if future.done() or priority in blocked:
+                    continue
+                if self._try_take(priority):
+                    future.set_result(None)
+                    continue
+                blocked.add(priority)
+                class_bucket = self.class_buckets.get(priority)
+                wait = max(self.bucket.wait_time(), class_bucket.wait_time() if class_bucket else 0)
+                delay = wait if delay is None else min(delay, wait)
+                if self.bucket.wait_time() > 0:
+                    break
+
+            self._waiters = [waiter for waiter in self._waiters if not waiter[3].done()]
+            heapq.heapify(self._waiters)
+            if not self._waiters:
+                break
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(delay or 0, 0.001))
+            except asyncio.TimeoutError:
+                pass
+
+    def pause(self, seconds):
+        """Telegram вернул 429 - останавливаем все отправки процесса"""
+        self.retry_after_pauses += 1
+        self.bucket.pause(seconds)
+
+    def stats(self):
+        return {
+            'queue_depth': len(self._waiters),
+            'retry_after_pauses': self.retry_after_pauses,
+            'classes': {
+                priority: {
+                    'requests': metrics['requests'],
+                    'queued': metrics['queued'],
+                    'wait_avg_ms': round(metrics['wait_total'] / metrics['queued'] * 1000, 1) if metrics['queued'] else 0.0,
+                    'wait_max_ms': round(metrics['wait_max'] * 1000, 1),
+                }
+                for priority, metrics in self.metrics.items()
+            },
+        }
+
+
+class OutboundMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: пропускает отправки через общую очередь.
+
+    Класс берется из send_priority(), а если он не задан - из назначения
+    сессии: интерактивная сессия - INTERACTIVE, сессия рассылок - BROADCAST.
+    """
+
+    def __init__(self, default_priority=INTERACTIVE):
+        self.default_priority = default_priority
+
+    async def __call__(self, make_request, bot, method):
+        if not is_limited(method):
+            return await make_request(bot, method)
+
+        queue = get_outbound_queue()
+        await queue.acquire(current_priority.get() or self.default_priority)
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            queue.pause(e.retry_after)
+            raise
+
+
+# Общая очередь процесса: лимит Bot API действует на токен бота целиком
+outbound_queue = None
+
+
+def get_outbound_queue():
+    """Возвращает общую очередь исходящих запросов"""
+    global outbound_queue
+    if outbound_queue is None:
+        config = get_config()
+        outbound_queue = OutboundQueue(config.OUTBOUND_RATE_LIMIT, {
+            INTERACTIVE: 1.0,
+            DAILY: config.OUTBOUND_DAILY_SHARE,
+            BROADCAST: config.OUTBOUND_BROADCAST_SHARE,
+        })
+    return outbound_queue
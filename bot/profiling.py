@@ -0,0 +1,161 @@
+# bot/profiling.py - зависания цикла событий и сэмплирующий профайлер
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from bot.config import get_config
+from bot.metrics import LOOP_STALL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних зависаний хранить вместе со стеком
+MAX_STALLS = 20
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def collapse_stack(frame):
+    """Стек от корня к текущей функции в формате collapsed (a;b;c)"""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StallWatchdog:
+    """Находит зависания цикла событий и запоминает, где они произошли.
+
+    Корутина в цикле обновляет heartbeat каждые interval секунд. Отдельный поток
+    проверяет heartbeat: если цикл не отвечает дольше threshold, поток снимает
+    стек потока цикла (что именно блокирует цикл) и пишет его в лог. Когда цикл
+    оживает, длительность зависания попадает в историю и в метрики.
+    """
+
+    def __init__(self, threshold=1.0, interval=0.1):
+        self.threshold = threshold
+        self.interval = interval
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+        self.stalls = deque(maxlen=MAX_STALLS)
+        self.stall_count = 0
+        self._captured = None
+        self._task = None
+        self._thread = None
+
+    def start(self):
+        """Запускает наблюдение за текущим циклом событий"""
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._beat())
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._watch, name='stall-watchdog', daemon=True)
+            self._thread.start()
+
+    async def _beat(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.heartbeat = time.monotonic()
+
+            stall = self.heartbeat - started - self.interval
+            if stall >= self.threshold:
+                self.stall_count += 1
+                LOOP_STALL_SECONDS.observe(stall)
+                captured, self._captured = self._captured, None
+                self.stalls.append({'at': time.time(), 'seconds': round(stall, 3), 'stack': captured})
+                logger.warning(f"⚠️ Цикл событий был заблокирован {stall:.2f} с")
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            blocked = time.monotonic() - self.heartbeat
+            if blocked < self.threshold or self._captured is not None:
+                continue
+
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            self._captured = ''.join(traceback.format_stack(frame, limit=30))
+            logger.warning(f"⚠️ Цикл событий не отвечает {blocked:.2f} с, стек:\n{self._captured}")
+
+    def stats(self):
+        return {
+            'stalls': self.stall_count,
+            'last_stall_seconds': self.stalls[-1]['seconds'] if self.stalls else 0.0,
+        }
+
+
+class SamplingProfiler:
+    """Сэмплирующий профайлер одного потока.
+
+    Из отдельного потока каждые interval секунд снимает стек потока
+    thread_id и считает одинаковые стеки. Результат - collapsed stacks,
+    которые открываются в speedscope или flamegraph.pl.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.total = 0
+
+    def run(self, seconds):
+        """Собирает сэмплы seconds секунд (блокирует вызывающий поток)"""
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[collapse_stack(frame)] += 1
+                self.total += 1
+            time.sleep(self.interval)
+        return self
+
+    def collapsed(self):
+        return '\n'.join(f"{stack} {count}" for stack, count in self.samples.most_common()) + '\n'
+
+    def top_functions(self, limit=5):
+        """Функции, чаще всего оказывавшиеся на вершине стека"""
+        leaves = Counter()
+        for stack, count in self.samples.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return leaves.most_common(limit)
+
+
+# Одновременно выполняется только один профайлер
+profile_state = {'running': False}
+
+
+async def profile_event_loop(seconds):
+    """Профилирует поток цикла событий seconds секунд, не блокируя цикл.
+    Возвращает None, если профайлер уже запущен"""
+    if profile_state['running']:
+        return None
+
+    profile_state['running'] = True
+    try:
+        profiler = SamplingProfiler(threading.get_ident())
+        await asyncio.get_running_loop().run_in_executor(None, profiler.run, seconds)
+        return profiler
+    finally:
+        profile_state['running'] = False
+
+
+# Наблюдатель за зависаниями цикла событий процесса
+stall_watchdog = None
+
+
+def get_stall_watchdog():
+    """Возвращает общий наблюдатель (порог из LOOP_STALL_THRESHOLD)"""
+    global stall_watchdog
+    if stall_watchdog is None:
+        stall_watchdog = StallWatchdog(get_config().LOOP_STALL_THRESHOLD)
+    return stall_watchdog
@@ -0,0 +1,48 @@
+# bot/ratelimit.py - ограничение скорости отправки
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Асинхронный token bucket: не больше rate операций в секунду в среднем"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        # Ожидающие получают токены строго по очереди
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self, tokens=1):
+        """Ждет, пока не освободится нужное количество токенов"""
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Останавливает выдачу токенов (например, после 429 от Telegram)"""
+        self._refill()
+        self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+    def try_acquire(self, tokens=1):
+        """Забирает токены без ожидания. False - токенов пока не хватает"""
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    def wait_time(self, tokens=1):
+        """Через сколько секунд будет доступно нужное количество токенов"""
+        self._refill()
+        return max(0.0, (tokens - self._tokens) / self.rate)
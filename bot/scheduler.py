@@ -1,27 +1,33 @@
 # bot/scheduler.py - полностью оптимизированная версия
+import logging
 import asyncio
 from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from bot.db.database import (
     get_user_stats, get_questions_by_topic, get_question,
-    get_questions_count_by_topic, get_all_users,
+    get_questions_count_by_topic, iter_users, iter_user_chunks, mark_user_blocked,
     reset_daily_progress_if_needed, get_user_answered_questions_count,
-    get_next_topic, update_user_topic_progress, mark_topic_completed
+    get_next_topic, update_user_topic_progress, mark_topic_completed,
+    cleanup_idempotency_keys
 )
-from bot.config import load_config
+from bot.config import get_config
+from bot.leader import leader_only, renew_leadership, resign_leadership
+from bot.delivery import enqueue_delivery, report_delivery_progress
+from bot.broadcast import resume_broadcasts
+from bot.subscription import subscription_cache, check_subscription, cleanup_subscription_cache
+from bot.client import get_bulk_bot
+from bot.outbound import current_priority, DAILY
+from bot.metrics import DELIVERIES
+from bot.logs import HOT
 import os
 from aiogram.types import FSInputFile
 from pytz import timezone
-import time
 
-config = load_config()
-
-# Кэш для подписок и пользовательских данных
-subscription_cache = {}
-user_topic_cache = {}
-CACHE_TTL = 300  # 5 минут
+logger = logging.getLogger(__name__)
 
 # Флаг для защиты от множественного запуска рассылки
 is_sending_daily_questions = False
@@ -31,47 +37,15 @@ sending_lock = asyncio.Lock()
 
 def cleanup_old_cache():
     """Очищает устаревшие записи в кэшах"""
-    current_time = time.time()
-
-    # Очищаем subscription_cache
-    for user_id in list(subscription_cache.keys()):
-        if current_time - subscription_cache[user_id]['timestamp'] > CACHE_TTL:
-            del subscription_cache[user_id]
-
-    # Очищаем user_topic_cache
-    for user_id in list(user_topic_cache.keys()):
-        if current_time - user_topic_cache[user_id]['timestamp'] > CACHE_TTL:
-            del user_topic_cache[user_id]
-
-
-async def check_subscription(user_id, bot):
-    """Проверяет подписку с кэшированием"""
-    current_time = time.time()
+    cleanup_subscription_cache()
 
-    # Проверяем кэш
-    if user_id in subscription_cache:
-        if current_time - subscription_cache[user_id]['timestamp'] < CACHE_TTL:
-            return subscription_cache[user_id]['subscribed']
 
-    # Если нет в кэше или устарело, проверяем через API
-    try:
-        member = await bot.get_chat_member(chat_id=config.CHANNEL_ID, user_id=user_id)
-        is_subscribed = member.status in ['member', 'administrator', 'creator']
-
-        # Сохраняем в кэш
-        subscription_cache[user_id] = {
-            'subscribed': is_subscribed,
-            'timestamp': current_time
-        }
-
-        return is_subscribed
-    except Exception as e:
-        print(f"Ошибка при проверке подписки: {e}")
-        return False
+async def send_question_to_user(bot, user_id, question_data, caption, strict=False):
+    """Отправляет вопрос пользователю по ID. Возвращает число отправленных сообщений.
 
-
-async def send_question_to_user(bot, user_id, question_data, caption):
-    """Отправляет вопрос пользователю по ID"""
+    strict=True - ошибки не глушатся, а передаются вызывающему (очередь доставки
+    сама решает, повторить задачу или пометить пользователя заблокировавшим бота).
+    """
     # Распаковываем 12 полей вместо 11
     (question_id, category, question_block, image_path,
      option_a, option_b, option_c, option_d,
@@ -101,13 +75,37 @@ async def send_question_to_user(bot, user_id, question_data, caption):
             )
         else:
             await bot.send_message(chat_id=user_id, text=full_question_text, reply_markup=keyboard)
+    except TelegramForbiddenError:
+        if strict:
+            raise
+        # Пользователь заблокировал бота - не пытаемся повторно и пропускаем его в рассылках
+        mark_user_blocked(user_id)
+        return 0
     except Exception as e:
-        print(f"Ошибка отправки вопроса пользователю {user_id}: {e}")
+        if strict and isinstance(e, TelegramRetryAfter):
+            raise
+        logger.warning("Ошибка отправки вопроса пользователю %s: %s", user_id, e, extra={**HOT, 'user_id': user_id})
         # Пытаемся отправить без изображения
         try:
             await bot.send_message(chat_id=user_id, text=full_question_text, reply_markup=keyboard)
         except Exception as e2:
-            print(f"Не удалось отправить вопрос пользователю {user_id}: {e2}")
+            if strict:
+                raise
+            logger.warning("Не удалось отправить вопрос пользователю %s: %s", user_id, e2,
+                           extra={**HOT, 'user_id': user_id})
+            return 0
+    return 1
+
+
+async def send_notice(bot, user_id, text, strict=False):
+    """Отправляет уведомление о теме. Возвращает число отправленных сообщений"""
+    try:
+        await bot.send_message(user_id, text)
+        return 1
+    except Exception:
+        if strict:
+            raise
+        return 0
 
 
 async def send_admin_notification(bot: Bot):
@@ -116,34 +114,40 @@ async def send_admin_notification(bot: Bot):
 
     async with sending_lock:
         if is_sending_admin_notification:
-            print("⚠️ Уведомление администратору уже отправляется, пропускаем...")
+            logger.warning("⚠️ Уведомление администратору уже отправляется, пропускаем...")
             return
 
         is_sending_admin_notification = True
 
     try:
-        await bot.send_message(chat_id=config.ADMIN_ID, text="Всё гуд! ✅")
-        print(f"Уведомление отправлено администратору {config.ADMIN_ID}")
+        await bot.send_message(chat_id=get_config().ADMIN_ID, text="Всё гуд! ✅")
+        logger.info(f"Уведомление отправлено администратору {get_config().ADMIN_ID}")
     except Exception as e:
-        print(f"Ошибка отправки уведомления администратору: {e}")
+        logger.warning(f"Ошибка отправки уведомления администратору: {e}")
     finally:
         async with sending_lock:
             is_sending_admin_notification = False
 
 
-async def process_user_questions(bot, user_id, current_topic):
-    """Обрабатывает отправку вопросов для одного пользователя с проверкой лимита"""
+async def process_user_questions(bot, user_id, current_topic, strict=False):
+    """Обрабатывает отправку вопросов для одного пользователя с проверкой лимита.
+
+    Возвращает (тему пользователя, число отправленных сообщений). strict=True -
+    ошибки отправки передаются вызывающему (см. send_question_to_user).
+    """
+    sent = 0
     # Сначала проверяем дневной лимит
     stats = get_user_stats(user_id)
     if not stats:
-        return current_topic
+        return current_topic, sent
 
     total_correct, current_topic, progress, completed_topics, user_role, daily_progress = stats
 
     # Если уже достигнут лимит, пропускаем пользователя
     if daily_progress >= 5:
-        print(f"Пользователь {user_id} уже достиг дневного лимита ({daily_progress}/5)")
-        return current_topic
+        logger.debug("Пользователь %s уже достиг дневного лимита (%s/5)", user_id, daily_progress,
+                     extra={'user_id': user_id})
+        return current_topic, sent
 
     # Проверяем, завершена ли текущая тема
     total_questions = get_questions_count_by_topic(current_topic)
@@ -157,23 +161,19 @@ async def process_user_questions(bot, user_id, current_topic):
             update_user_topic_progress(user_id, next_topic, 0)
             current_topic = next_topic
             # Отправляем уведомление пользователю
-            try:
-                await bot.send_message(user_id, f"🎉 Тема завершена! Переходим к следующей теме: {next_topic}")
-            except:
-                pass
+            sent += await send_notice(bot, user_id, f"🎉 Тема завершена! Переходим к следующей теме: {next_topic}",
+                                      strict)
         else:
             # Все темы завершены
-            try:
-                await bot.send_message(user_id, "🎉 Поздравляем! Вы завершили все темы!")
-            except:
-                pass
-            return current_topic
+            sent += await send_notice(bot, user_id, "🎉 Поздравляем! Вы завершили все темы!", strict)
+            return current_topic, sent
 
     # Проверяем, есть ли вопросы в теме
     topic_questions_count = get_questions_count_by_topic(current_topic)
     if topic_questions_count == 0:
-        print(f"Нет вопросов по теме {current_topic} для пользователя {user_id}")
-        return current_topic
+        logger.debug("Нет вопросов по теме %s для пользователя %s", current_topic, user_id,
+                     extra={'user_id': user_id})
+        return current_topic, sent
 
     # Получаем вопросы для текущей темы (только те, на которые еще не ответили)
     # Ограничиваем количество вопросов оставшимся лимитом
@@ -194,30 +194,35 @@ async def process_user_questions(bot, user_id, current_topic):
             question_ids = [row[0] for row in question_ids_result] if question_ids_result else []
 
             if not question_ids:
-                print(f"Нет вопросов в теме {current_topic} для пользователя {user_id}")
-                return current_topic
+                logger.debug("Нет вопросов в теме %s для пользователя %s", current_topic, user_id,
+                             extra={'user_id': user_id})
+                return current_topic, sent
         else:
-            print(f"Все темы завершены для пользователя {user_id}")
-            return current_topic
+            logger.debug("Все темы завершены для пользователя %s", user_id, extra={'user_id': user_id})
+            return current_topic, sent
 
     # Отправляем только первый вопрос (остальные будут по мере ответов)
     question_data = get_question(question_ids[0])
     if question_data:
         caption = f"// {current_topic.capitalize()}"
         try:
-            await send_question_to_user(bot, user_id, question_data, caption)
-            print(f"Вопрос отправлен пользователю {user_id}")
+            sent += await send_question_to_user(bot, user_id, question_data, caption, strict)
+            logger.debug("Вопрос отправлен пользователю %s", user_id, extra={'user_id': user_id})
 
             # Помечаем вопрос как отправленный (но не отвеченный)
             # Это нужно, чтобы предотвратить повторную отправку того же вопроса
             add_answered_question(user_id, question_ids[0])
 
         except Exception as e:
-            print(f"Ошибка отправки вопроса пользователю {user_id}: {e}")
+            if strict:
+                raise
+            logger.warning("Ошибка отправки вопроса пользователю %s: %s", user_id, e,
+                           extra={**HOT, 'user_id': user_id})
     else:
-        print(f"Не удалось загрузить данные вопроса для пользователя {user_id}")
+        logger.warning("Не удалось загрузить данные вопроса для пользователя %s", user_id,
+                       extra={**HOT, 'user_id': user_id})
 
-    return current_topic
+    return current_topic, sent
 
 
 async def send_daily_question(bot: Bot):
@@ -227,98 +232,68 @@ async def send_daily_question(bot: Bot):
     # Проверяем и устанавливаем флаг с блокировкой
     async with sending_lock:
         if is_sending_daily_questions:
-            print("⚠️ Рассылка ежедневных вопросов уже выполняется, пропускаем...")
+            logger.warning("⚠️ Рассылка ежедневных вопросов уже выполняется, пропускаем...")
             return
 
         is_sending_daily_questions = True
 
+    # Задача планировщика выполняется в своем контексте, поэтому приоритет
+    # действует только на отправки этой рассылки
+    current_priority.set(DAILY)
+
     try:
         # Очищаем кэш перед началом
         subscription_cache.clear()
-        user_topic_cache.clear()
 
         # Сбрасываем прогресс за предыдущий день
         reset_daily_progress_if_needed()
 
-        users = get_all_users()
-
-        if not users:
-            print("Нет пользователей для отправки ежедневного вопроса")
+        # В режиме очереди только раскладываем задачи, доставляют их воркеры
+        if get_config().DELIVERY_QUEUE_ENABLED:
+            await enqueue_delivery(bot, 'daily', iter_user_chunks(exclude_blocked=True), {'type': 'daily'},
+                                   report_chat_id=get_config().ADMIN_ID)
             return
 
-        # Группируем пользователей по темам для batch обработки
-        users_by_topic = {}
-        for user_id in users:
-            # Используем кэш для тем пользователей
-            current_time = time.time()
-            if user_id in user_topic_cache:
-                if current_time - user_topic_cache[user_id]['timestamp'] < CACHE_TTL:
-                    current_topic = user_topic_cache[user_id]['topic']
-                else:
-                    stats = get_user_stats(user_id)
-                    current_topic = stats[1] if stats else 'typography'
-                    user_topic_cache[user_id] = {
-                        'topic': current_topic,
-                        'timestamp': current_time
-                    }
-            else:
-                stats = get_user_stats(user_id)
-                current_topic = stats[1] if stats else 'typography'
-                user_topic_cache[user_id] = {
-                    'topic': current_topic,
-                    'timestamp': current_time
-                }
-
-            if current_topic not in users_by_topic:
-                users_by_topic[current_topic] = []
-            users_by_topic[current_topic].append(user_id)
-
-        # Обрабатываем пользователей группами по темам
         processed_users = 0
         skipped_users = 0
 
-        for topic, topic_users in users_by_topic.items():
-            # Получаем вопросы для темы один раз
-            question_ids = get_questions_by_topic(None, topic, len(topic_users) * 2)
-
-            for user_id in topic_users:
-                try:
-                    # Проверяем подписку с кэшированием
-                    is_subscribed = await check_subscription(user_id, bot)
-                    if not is_subscribed:
-                        skipped_users += 1
-                        continue
+        # Пользователи читаются из БД порциями по мере отправки,
+        # поэтому первый вопрос уходит сразу, независимо от размера таблицы
+        async for user_id in iter_users(exclude_blocked=True):
+            try:
+                # Проверяем подписку с кэшированием
+                is_subscribed = await check_subscription(user_id, bot)
+                if not is_subscribed:
+                    skipped_users += 1
+                    DELIVERIES.inc('daily', 'skipped')
+                    continue
 
-                    # Обрабатываем вопросы для пользователя
-                    new_topic = await process_user_questions(bot, user_id, topic)
+                # Тема берется из статистики пользователя внутри process_user_questions
+                await process_user_questions(bot, user_id, None)
 
-                    # Обновляем кэш, если тема изменилась
-                    if new_topic != topic:
-                        user_topic_cache[user_id] = {
-                            'topic': new_topic,
-                            'timestamp': time.time()
-                        }
+                processed_users += 1
+                DELIVERIES.inc('daily', 'ok')
 
-                    processed_users += 1
+                # Небольшая пауза между пользователями для снижения нагрузки
+                if processed_users % 10 == 0:
+                    await asyncio.sleep(0.1)
 
-                    # Небольшая пауза между пользователями для снижения нагрузки
-                    if processed_users % 10 == 0:
-                        await asyncio.sleep(0.1)
+            except Exception as e:
+                logger.warning("Ошибка обработки пользователя %s: %s", user_id, e, extra={**HOT, 'user_id': user_id})
+                DELIVERIES.inc('daily', 'failed')
+                continue
 
-                except Exception as e:
-                    print(f"Ошибка обработки пользователя {user_id}: {e}")
-                    continue
+        if not processed_users and not skipped_users:
+            logger.info("Нет пользователей для отправки ежедневного вопроса")
+            return
 
         # Очищаем кэш после обработки
         subscription_cache.clear()
-        user_topic_cache.clear()
 
-        print(f"✅ Ежедневные вопросы отправлены. Обработано: {processed_users}, Пропущено: {skipped_users}")
+        logger.info(f"✅ Ежедневные вопросы отправлены. Обработано: {processed_users}, Пропущено: {skipped_users}")
 
     except Exception as e:
-        print(f"❌ Критическая ошибка при отправке ежедневных вопросов: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"❌ Критическая ошибка при отправке ежедневных вопросов: {e}")
 
     finally:
         # Снимаем флаг независимо от результата
@@ -328,23 +303,36 @@ async def send_daily_question(bot: Bot):
 
 def setup_scheduler(bot: Bot):
     """Настраивает планировщик для ежедневной отправки вопросов"""
+    config = get_config()
     scheduler = AsyncIOScheduler()
 
     # Явно указываем московское время
     moscow_tz = timezone('Europe/Moscow')
 
+    # Пытаемся сразу стать лидером и продлеваем аренду по интервалу,
+    # чтобы при падении лидера задачи подхватил другой экземпляр
+    renew_leadership()
+    scheduler.add_job(
+        renew_leadership,
+        trigger=IntervalTrigger(seconds=config.LEADER_HEARTBEAT_INTERVAL),
+        id='leader_heartbeat'
+    )
+
+    # Массовые отправки идут через отдельный пул соединений
+    bulk_bot = get_bulk_bot(bot)
+
     # Ежедневные вопросы в 14:00 по Омскому времени (или же в 11:00 по МСК)
     scheduler.add_job(
-        send_daily_question,
+        leader_only(send_daily_question),
         trigger=CronTrigger(hour=11, minute=0, timezone=moscow_tz),
-        args=[bot],
+        args=[bulk_bot],
         id='daily_question',
         misfire_grace_time=300  # Разрешаем опоздание до 5 минут
     )
 
     # Уведомление администратору в 13:00 по Омскому времени (или же в 10:00 по МСК)
     scheduler.add_job(
-        send_admin_notification,
+        leader_only(send_admin_notification),
         trigger=CronTrigger(hour=10, minute=0, timezone=moscow_tz),
         args=[bot],
         id='admin_notification',
@@ -353,12 +341,37 @@ def setup_scheduler(bot: Bot):
 
     # Сброс прогресса каждый день в 03:00 по Омскому времени (или же в 00:00 по МСК)
     scheduler.add_job(
-        reset_daily_progress_if_needed,
+        leader_only(reset_daily_progress_if_needed),
         trigger=CronTrigger(hour=0, minute=0, timezone=moscow_tz),
         id='reset_progress',
         misfire_grace_time=300
     )
 
+    # Сводный отчет о прогрессе очереди доставки
+    if config.DELIVERY_QUEUE_ENABLED:
+        scheduler.add_job(
+            leader_only(report_delivery_progress),
+            trigger=IntervalTrigger(seconds=5),
+            args=[bot],
+            id='delivery_progress'
+        )
+
+    # Подхватываем рассылки /letter, брошенные упавшими экземплярами
+    scheduler.add_job(
+        resume_broadcasts,
+        trigger=IntervalTrigger(seconds=60),
+        args=[bulk_bot],
+        id='resume_broadcasts'
+    )
+
+    # Удаление истекших ключей защиты от двойных нажатий
+    if config.IDEMPOTENCY_SHARED:
+        scheduler.add_job(
+            leader_only(cleanup_idempotency_keys),
+            trigger=IntervalTrigger(minutes=10),
+            id='idempotency_cleanup'
+        )
+
     # Очистка кэша каждый час
     scheduler.add_job(
         cleanup_old_cache,
@@ -367,9 +380,9 @@ def setup_scheduler(bot: Bot):
     )
 
     scheduler.start()
-    print("✅ Планировщик запущен с задачами:")
+    logger.info("✅ Планировщик запущен с задачами:")
     for job in scheduler.get_jobs():
-        print(f"   - {job.id}: {job.trigger}")
+        logger.info(f"   - {job.id}: {job.trigger}")
 
     return scheduler
 
@@ -379,4 +392,5 @@ def shutdown_scheduler(scheduler):
     """Останавливает планировщик"""
     if scheduler:
         scheduler.shutdown()
-        print("✅ Планировщик остановлен")
+        resign_leadership()
+        logger.info("✅ Планировщик остановлен")
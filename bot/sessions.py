@@ -0,0 +1,140 @@
+# bot/sessions.py - сессии вопросов пользователей с сохранением в БД
+import logging
+import time
+from array import array
+from bot.config import get_config
+from bot.db.database import (
+    save_quiz_session, delete_quiz_session, get_quiz_sessions, cleanup_quiz_sessions
+)
+
+logger = logging.getLogger(__name__)
+
+
+class QuizSession:
+    """Состояние сессии одного пользователя"""
+    __slots__ = ('active', 'question_ids', 'touched_at')
+
+    def __init__(self, active=False, question_ids=(), touched_at=None):
+        self.active = active
+        # Очередь вопросов: компактный массив 32-битных ID вместо списка int
+        self.question_ids = array('I', question_ids)
+        self.touched_at = touched_at or time.monotonic()
+
+
+class SessionStore:
+    """Сессии вопросов в памяти с записью каждого изменения в таблицу quiz_sessions.
+
+    Сессия живет, пока пользователь активен: каждое изменение продлевает ее
+    на ttl секунд. После перезапуска load() восстанавливает сессии из БД, и
+    пользователь продолжает с того же вопроса без повторного подбора вопросов.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._sessions = {}
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def load(self):
+        """Загружает из БД сессии, активные в пределах ttl"""
+        self._sessions.clear()
+        for user_id, is_active, question_ids in get_quiz_sessions(self.ttl):
+            ids = [int(x) for x in question_ids.split(',') if x] if question_ids else []
+            if not is_active and not ids:
+                continue
+            self._sessions[user_id] = QuizSession(bool(is_active), ids)
+        return len(self._sessions)
+
+    def get(self, user_id):
+        session = self._sessions.get(user_id)
+        if session and time.monotonic() - session.touched_at > self.ttl:
+            self._drop(user_id)
+            return None
+        return session
+
+    def is_active(self, user_id):
+        session = self.get(user_id)
+        return bool(session and session.active)
+
+    def has_questions(self, user_id):
+        session = self.get(user_id)
+        return bool(session and session.question_ids)
+
+    def activate(self, user_id):
+        """Отмечает сессию активной"""
+        session = self.get(user_id) or self._sessions.setdefault(user_id, QuizSession())
+        session.active = True
+        self._save(user_id, session)
+
+    def deactivate(self, user_id):
+        """Снимает отметку об активной сессии, очередь вопросов сохраняется"""
+        session = self.get(user_id)
+        if session:
+            session.active = False
+            self._save(user_id, session)
+
+    def set_questions(self, user_id, question_ids):
+        """Сохраняет очередь следующих вопросов"""
+        session = self.get(user_id) or self._sessions.setdefault(user_id, QuizSession())
+        session.question_ids = array('I', question_ids)
+        self._save(user_id, session)
+
+    def pop_question(self, user_id):
+        """Достает следующий вопрос из очереди. None - очередь пуста"""
+        session = self.get(user_id)
+        if not session or not session.question_ids:
+            return None
+
+        question_id = session.question_ids.pop(0)
+        self._save(user_id, session)
+        return question_id
+
+    def end(self, user_id):
+        """Завершает сессию и удаляет ее"""
+        if user_id in self._sessions:
+            self._drop(user_id)
+
+    def expire(self):
+        """Удаляет сессии без активности дольше ttl"""
+        now = time.monotonic()
+        expired = [user_id for user_id, session in self._sessions.items() if now - session.touched_at > self.ttl]
+        for user_id in expired:
+            del self._sessions[user_id]
+
+        # Записи других процессов и оставшиеся после перезапуска чистим в БД одним запросом
+        cleanup_quiz_sessions(self.ttl)
+        return len(expired)
+
+    def stats(self):
+        return {
+            'sessions': len(self._sessions),
+            'active': sum(1 for session in self._sessions.values() if session.active),
+        }
+
+    def _save(self, user_id, session):
+        session.touched_at = time.monotonic()
+        if not session.active and not session.question_ids:
+            self._drop(user_id)
+            return
+        save_quiz_session(user_id, session.active, ','.join(map(str, session.question_ids)))
+
+    def _drop(self, user_id):
+        self._sessions.pop(user_id, None)
+        delete_quiz_session(user_id)
+
+
+# Общее хранилище сессий вопросов
+session_store = None
+
+
+def get_session_store():
+    """Возвращает хранилище сессий, при первом вызове загружая сессии из БД"""
+    global session_store
+    if session_store is None:
+        config = get_config()
+        session_store = SessionStore(config.QUIZ_SESSION_TTL)
+        restored = session_store.load()
+        if restored:
+            logger.info(f"✅ Восстановлено сессий вопросов: {restored}")
+    return session_store
@@ -0,0 +1,111 @@
+# bot/subscription.py - проверка подписки на канал с общим кэшем
+import logging
+import time
+from aiogram import BaseMiddleware, types
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from bot.config import get_config
+from bot.metrics import cache_lookup
+from bot.logs import HOT
+
+logger = logging.getLogger(__name__)
+
+# Общий кэш подписок для обработчиков, планировщика и воркеров доставки
+subscription_cache = {}
+CACHE_TTL = 300  # 5 минут
+
+# Значения флага subscription у обработчиков
+REQUIRED = 'required'  # неподписанным пользователям обработчик не вызывается (по умолчанию)
+OPTIONAL = 'optional'  # обработчик вызывается всегда и получает is_subscribed
+SKIP = 'skip'          # подписка не проверяется
+
+
+async def check_subscription(user_id, bot, force_check=False):
+    """Проверяет подписку с кэшированием"""
+    current_time = time.time()
+
+    # Если принудительная проверка, игнорируем кэш
+    if not force_check:
+        # Проверяем кэш
+        if user_id in subscription_cache:
+            if current_time - subscription_cache[user_id]['timestamp'] < CACHE_TTL:
+                cache_lookup('subscription', True)
+                return subscription_cache[user_id]['subscribed']
+        cache_lookup('subscription', False)
+
+    # Если нет в кэше или устарело, проверяем через API
+    try:
+        config = get_config()
+        member = await bot.get_chat_member(chat_id=config.CHANNEL_ID, user_id=user_id)
+        is_subscribed = member.status in ['member', 'administrator', 'creator']
+
+        # Сохраняем в кэш
+        subscription_cache[user_id] = {
+            'subscribed': is_subscribed,
+            'timestamp': current_time
+        }
+
+        return is_subscribed
+    except Exception as e:
+        logger.warning("Ошибка при проверке подписки: %s", e, extra={**HOT, 'user_id': user_id})
+        return False
+
+
+def cleanup_subscription_cache():
+    """Удаляет устаревшие записи из кэша подписок"""
+    current_time = time.time()
+    for user_id in list(subscription_cache.keys()):
+        if current_time - subscription_cache[user_id]['timestamp'] > CACHE_TTL:
+            del subscription_cache[user_id]
+
+
+async def ask_for_subscription(message: types.Message):
+    """Просит пользователя подписаться на канал"""
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📢 Подписаться на канал", url="https://t.me/matzar_studio")],
+        [InlineKeyboardButton(text="✅ Проверить подписку", callback_data="check_subscription")]
+    ])
+
+    await message.answer(
+        "⚠️ Для использования бота необходимо подписаться на канал @matzar_studio.\n\n"
+        "После подписки нажмите кнопку 'Проверить подписку' ниже.",
+        reply_markup=keyboard
+    )
+
+
+class SubscriptionMiddleware(BaseMiddleware):
+    """Inner middleware для message и callback_query.
+
+    Проверяет подписку один раз на обновление, до обработчика и любых запросов
+    к БД. Поведение задается флагом обработчика:
+    dp.message.register(..., flags={'subscription': SKIP}).
+    """
+
+    def __init__(self):
+        self.checked = 0
+        self.rejected = 0
+
+    async def __call__(self, handler, event, data):
+        mode = get_flag(data, 'subscription', default=REQUIRED)
+        user = data.get('event_from_user')
+        if mode == SKIP or user is None:
+            return await handler(event, data)
+
+        self.checked += 1
+        is_subscribed = await check_subscription(user.id, data['bot'])
+        data['is_subscribed'] = is_subscribed
+
+        if is_subscribed or mode == OPTIONAL:
+            return await handler(event, data)
+
+        self.rejected += 1
+        if isinstance(event, types.CallbackQuery):
+            await event.answer(
+                "⚠️ Для использования бота необходимо подписаться на канал @matzar_studio.",
+                show_alert=True
+            )
+        else:
+            await ask_for_subscription(event)
+
+    def stats(self):
+        return {'checked': self.checked, 'rejected': self.rejected, 'cached': len(subscription_cache)}
@@ -0,0 +1,147 @@
+# bot/timers.py - единый планировщик отложенных действий
+import logging
+import asyncio
+import heapq
+import itertools
+import time
+from contextvars import copy_context
+from bot.tracing import current_trace, record_span
+
+logger = logging.getLogger(__name__)
+
+
+class DelayedActions:
+    """Куча отложенных действий с одной фоновой задачей.
+
+    Вместо отдельной спящей задачи на каждое действие ("удалить сообщение через
+    10 секунд", "отправить следующий вопрос") все сроки хранятся в одной куче,
+    а фоновая задача просыпается только к ближайшему из них.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._by_key = {}
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self.fired = 0
+        self.cancelled = 0
+
+    def __len__(self):
+        return len(self._by_key)
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            # Event привязывается к циклу событий, поэтому создаем его вместе с задачей
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def schedule(self, delay, action, *args, key=None):
+        """Выполняет action(*args) через delay секунд.
+
+        action может быть обычной функцией или корутиной. Повторное планирование
+        с тем же key заменяет предыдущее действие. Действие выполняется в контексте
+        вызова schedule: логи и трассировка относят его к тому же обновлению.
+        """
+        self._ensure_running()
+
+        if key is None:
+            key = ('anonymous', next(self._counter))
+        self.cancel(key)
+
+        when = asyncio.get_running_loop().time() + delay
+        context = copy_context()
+        trace = context.get(current_trace)
+        if trace is not None:
+            # Сводка трассировки ждет и это действие
+            trace.hold()
+        entry = [when, next(self._counter), action, args, key, True, context, time.monotonic()]
+        self._by_key[key] = entry
+        heapq.heappush(self._heap, entry)
+
+        # Будим фоновую задачу, если новое действие стало ближайшим
+        if self._heap[0] is entry:
+            self._wakeup.set()
+        return key
+
+    def cancel(self, key):
+        """Отменяет запланированное действие. Возвращает True, если оно было"""
+        entry = self._by_key.pop(key, None)
+        if entry is None:
+            return False
+
+        # Из кучи не удаляем - запись просто пропустится при срабатывании
+        entry[5] = False
+        self.cancelled += 1
+        self._done(entry[6])
+        return True
+
+    @staticmethod
+    def _done(context):
+        trace = context.get(current_trace)
+        if trace is not None:
+            trace.release()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            while self._heap and not self._heap[0][5]:
+                heapq.heappop(self._heap)
+
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            delay = self._heap[0][0] - loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            when, _, action, args, key, active, context, scheduled_at = heapq.heappop(self._heap)
+            self._by_key.pop(key, None)
+            self.fired += 1
+            context.run(self._execute, action, args, scheduled_at, context)
+
+    def _execute(self, action, args, scheduled_at, context):
+        # Ожидание до срока - отдельная фаза в трассировке обновления
+        record_span(f"delay {getattr(action, '__name__', 'action')}", 'timer', scheduled_at)
+        try:
+            result = action(*args)
+        except Exception as e:
+            logger.warning(f"Ошибка отложенного действия {getattr(action, '__name__', action)}: {e}")
+            self._done(context)
+            return
+
+        # Корутины выполняем отдельно, чтобы медленное действие не задерживало остальные
+        if asyncio.iscoroutine(result):
+            asyncio.create_task(self._await(action, result, context))
+        else:
+            self._done(context)
+
+    async def _await(self, action, coro, context):
+        try:
+            await coro
+        except Exception as e:
+            logger.warning(f"Ошибка отложенного действия {getattr(action, '__name__', action)}: {e}")
+        finally:
+            self._done(context)
+
+    def reset(self):
+        """Забывает действия и фоновую задачу завершившегося цикла событий"""
+        self._heap.clear()
+        self._by_key.clear()
+        self._wakeup = None
+        self._task = None
+
+    def stats(self):
+        return {'pending': len(self._by_key), 'fired': self.fired, 'cancelled': self.cancelled}
+
+
+# Общий планировщик отложенных действий бота
+delayed_actions = DelayedActions()
@@ -0,0 +1,255 @@
+# bot/tracing.py - трассировка обработки обновлений: фазы и экспорт в Chrome trace
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from bot.config import get_config
+
+logger = logging.getLogger(__name__)
+
+# Трассировка текущего обновления; None - обновление не попало в выборку
+current_trace = ContextVar('current_trace', default=None)
+
+# Сколько событий держать в памяти до записи в файл
+MAX_EVENTS = 20000
+
+trace_ids = itertools.count(1)
+
+
+def now_us():
+    return time.monotonic() * 1_000_000
+
+
+class Trace:
+    """Спаны одного обновления: корневой span и дочерние (БД, Bot API, обработчик, таймер).
+
+    Обновление считается завершенным, когда вернулся обработчик и выполнились
+    все отложенные действия, запланированные из его контекста (например,
+    следующий вопрос через 10 секунд). Только тогда в лог пишется сводка по фазам.
+    """
+
+    def __init__(self, update_id, user_id=None):
+        self.trace_id = next(trace_ids)
+        self.update_id = update_id
+        self.user_id = user_id
+        self.started = now_us()
+        # категория -> [число спанов, суммарная длительность мкс]
+        self.totals = {}
+        # Отложенные действия обновления, которые еще не выполнились
+        self.pending = 0
+        self.finished = False
+
+    def record(self, name, category, start, duration, **args):
+        """Добавляет завершенный span (время в микросекундах)"""
+        totals = self.totals.setdefault(category, [0, 0.0])
+        totals[0] += 1
+        totals[1] += duration
+        get_trace_exporter().add({
+            'name': name, 'cat': category, 'ph': 'X',
+            'ts': round(start, 1), 'dur': round(duration, 1),
+            'pid': os.getpid(), 'tid': self.trace_id,
+            'args': args,
+        })
+
+    def breakdown(self):
+        """Компактная сводка: total=120.5ms handler=1×110.2ms db=3×12.0ms api=2×80.1ms"""
+        parts = [f"total={(now_us() - self.started) / 1000:.1f}ms"]
+        for category, (count, duration) in sorted(self.totals.items(), key=lambda item: -item[1][1]):
+            if category == 'update':
+                continue
+            parts.append(f"{category}={count}×{duration / 1000:.1f}ms")
+        return ' '.join(parts)
+
+    def hold(self):
+        """Из контекста обновления запланировано отложенное действие"""
+        self.pending += 1
+
+    def release(self):
+        """Отложенное действие выполнено или отменено"""
+        self.pending -= 1
+        if self.finished and self.pending <= 0:
+            self.report()
+
+    def finish(self):
+        """Обработчик вернулся; сводка пишется сразу или после последнего отложенного действия"""
+        self.finished = True
+        if self.pending <= 0:
+            self.report()
+
+    def report(self):
+        logger.info("Трассировка обновления %s: %s", self.update_id, self.breakdown(),
+                    extra={'update_id': self.update_id, 'user_id': self.user_id})
+
+
+def record_span(name, category, started, **args):
+    """Span от момента started (time.monotonic()) до текущего момента, если идет трассировка"""
+    trace = current_trace.get()
+    if trace is not None:
+        start = started * 1_000_000
+        trace.record(name, category, start, now_us() - start, **args)
+
+
+@contextmanager
+def span(name, category, **args):
+    """Дочерний span текущей трассировки. Без трассировки ничего не делает"""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    started = now_us()
+    try:
+        yield
+    finally:
+        trace.record(name, category, started, now_us() - started, **args)
+
+
+class TraceExporter:
+    """Буфер событий в формате Chrome trace (chrome://tracing, Perfetto).
+
+    Файл перезаписывается целиком последними max_events событиями; запись
+    выполняется в пуле потоков, чтобы не блокировать цикл событий.
+    """
+
+    def __init__(self, path, max_events=MAX_EVENTS):
+        # {pid} в имени файла - отдельный файл на процесс (воркеры кластера)
+        self.path = path.format(pid=os.getpid()) if path else path
+        self.events = deque(maxlen=max_events)
+        self.dirty = False
+        self.exported = 0
+
+    def add(self, event):
+        self.events.append(event)
+        self.dirty = True
+
+    def write(self, events):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    async def flush(self):
+        """Записывает буфер в файл, если с прошлой записи появились события"""
+        if not self.dirty or not self.path:
+            return
+        self.dirty = False
+        events = list(self.events)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.write, events)
+            self.exported += 1
+        except Exception as e:
+            logger.warning(f"Не удалось записать трассировку в {self.path}: {e}")
+
+
+class Tracer:
+    """Решает, какие обновления трассировать, и ведет статистику выборки"""
+
+    def __init__(self, sample_rate, flush_interval=10):
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.seen = 0
+        self.sampled = 0
+        self._flush_task = None
+
+    def sample(self):
+        self.seen += 1
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return False
+        self.sampled += 1
+        return True
+
+    def ensure_flushing(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await get_trace_exporter().flush()
+
+    def stats(self):
+        return {'seen': self.seen, 'sampled': self.sampled, 'buffered_events': len(get_trace_exporter().events)}
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Outer middleware для dp.update, регистрируется после UpdatePool.
+
+    Для обновлений из выборки открывает трассировку: корневой span обновления,
+    span ожидания в очереди пула и дочерние спаны, которые добавляют
+    execute_query, сессия бота и отложенные действия. Сводка по фазам пишется
+    в лог, когда завершены и обработчик, и его отложенные действия.
+    """
+
+    async def __call__(self, handler, event, data):
+        tracer = get_tracer()
+        if not tracer.sample():
+            return await handler(event, data)
+
+        tracer.ensure_flushing()
+        user = data.get('event_from_user')
+        trace = Trace(event.update_id, user.id if user else None)
+        token = current_trace.set(trace)
+
+        queue_wait = data.get('pool_wait')
+        if queue_wait:
+            trace.record('pool_wait', 'queue', trace.started - queue_wait * 1_000_000, queue_wait * 1_000_000)
+
+        try:
+            return await handler(event, data)
+        finally:
+            current_trace.reset(token)
+            trace.record(f"update {event.event_type}", 'update', trace.started, now_us() - trace.started,
+                         update_id=trace.update_id, user_id=trace.user_id)
+            trace.finish()
+
+
+class HandlerSpanMiddleware(BaseMiddleware):
+    """Inner middleware для message и callback_query: span выбранного обработчика"""
+
+    async def __call__(self, handler, event, data):
+        callback = getattr(data.get('handler'), 'callback', None)
+        with span(getattr(callback, '__name__', 'handler'), 'handler'):
+            return await handler(event, data)
+
+
+class RequestSpanMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: span на каждый запрос к Bot API"""
+
+    async def __call__(self, make_request, bot, method):
+        with span(method.__api_method__, 'api'):
+            return await make_request(bot, method)
+
+
+async def flush_traces():
+    """Записывает накопленные события (при остановке диспетчера)"""
+    if trace_exporter is not None:
+        await trace_exporter.flush()
+
+
+# Общий трассировщик и буфер событий процесса
+tracer = None
+trace_exporter = None
+
+
+def get_tracer():
+    """Возвращает общий трассировщик (доля выборки из TRACE_SAMPLE_RATE)"""
+    global tracer
+    if tracer is None:
+        tracer = Tracer(get_config().TRACE_SAMPLE_RATE)
+    return tracer
+
+
+def get_trace_exporter():
+    """Возвращает общий буфер событий трассировки (файл из TRACE_FILE)"""
+    global trace_exporter
+    if trace_exporter is None:
+        trace_exporter = TraceExporter(get_config().TRACE_FILE)
+    return trace_exporter
@@ -0,0 +1,145 @@
+# bot/update_pool.py - ограниченная обработка обновлений с очередностью по пользователю
+import logging
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from aiogram import BaseMiddleware
+from bot.config import get_config
+
+logger = logging.getLogger(__name__)
+
+
+class UpdatePool(BaseMiddleware):
+    """Внешний middleware для dp.update.
+
+    - не больше max_in_flight обработчиков выполняются одновременно;
+    - обновления одного пользователя обрабатываются строго по очереди;
+    - если принятых, но не завершенных обновлений больше max_pending,
+      middleware ждет освобождения места. При polling с handle_as_tasks=False
+      это останавливает чтение новых обновлений (backpressure).
+
+    Работа пользователя вне обработчика (продолжение через delayed_actions)
+    выполняется под той же блокировкой через user_lock().
+    """
+
+    def __init__(self, max_in_flight=50, max_pending=1000):
+        self.max_in_flight = max_in_flight
+        self.max_pending = max_pending
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._space = asyncio.Condition()
+        self._user_locks = {}
+        self._user_refs = {}
+        self._tasks = set()
+
+        self.pending = 0
+        self.in_flight = 0
+        self.admitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.backpressure_waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def __call__(self, handler, event, data):
+        if self.pending >= self.max_pending:
+            self.backpressure_waits += 1
+            async with self._space:
+                await self._space.wait_for(lambda: self.pending < self.max_pending)
+
+        user = data.get('event_from_user')
+        key = user.id if user else None
+        if key is not None:
+            self._retain(key)
+
+        self.pending += 1
+        self.admitted += 1
+
+        # Задачи запускаются в порядке поступления, а asyncio.Lock отдает
+        # блокировку ожидающим по очереди - так сохраняется порядок обновлений пользователя
+        task = asyncio.create_task(self._run(key, handler, event, data, time.monotonic()))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key, handler, event, data, enqueued_at):
+        lock = self._user_locks.get(key)
+        try:
+            if lock:
+                await lock.acquire()
+            try:
+                async with self._slots:
+                    wait = time.monotonic() - enqueued_at
+                    self.wait_total += wait
+                    self.wait_max = max(self.wait_max, wait)
+                    # Время в очереди пула - для трассировки обновления
+                    data['pool_wait'] = wait
+
+                    self.in_flight += 1
+                    try:
+                        await handler(event, data)
+                    finally:
+                        self.in_flight -= 1
+            finally:
+                if lock:
+                    lock.release()
+            self.completed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"❌ Ошибка обработки обновления {getattr(event, 'update_id', '?')}: {e}")
+        finally:
+            if key is not None:
+                self._forget(key)
+
+            self.pending -= 1
+            async with self._space:
+                self._space.notify()
+
+    def _retain(self, key):
+        self._user_refs[key] = self._user_refs.get(key, 0) + 1
+        if key not in self._user_locks:
+            self._user_locks[key] = asyncio.Lock()
+
+    def _forget(self, key):
+        self._user_refs[key] -= 1
+        if not self._user_refs[key]:
+            del self._user_refs[key]
+            del self._user_locks[key]
+
+    @asynccontextmanager
+    async def user_lock(self, user_id):
+        """Блокировка пользователя вне обработчика: ждет его текущие обновления,
+        а следующие обновления пользователя ждут завершения блока"""
+        self._retain(user_id)
+        try:
+            async with self._user_locks[user_id]:
+                yield
+        finally:
+            self._forget(user_id)
+
+    def stats(self):
+        """Глубина очереди, число выполняющихся обработчиков и время ожидания"""
+        finished = self.completed + self.failed
+        return {
+            'pending': self.pending,
+            'in_flight': self.in_flight,
+            'queue_depth': self.pending - self.in_flight,
+            'users_waiting': len(self._user_locks),
+            'admitted': self.admitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'backpressure_waits': self.backpressure_waits,
+            'wait_avg_ms': round(self.wait_total / finished * 1000, 2) if finished else 0.0,
+            'wait_max_ms': round(self.wait_max * 1000, 2),
+        }
+
+
+# Общий пул обработки обновлений
+update_pool = None
+
+
+def get_update_pool():
+    """Возвращает общий пул обработки обновлений"""
+    global update_pool
+    if update_pool is None:
+        config = get_config()
+        update_pool = UpdatePool(config.UPDATE_MAX_IN_FLIGHT, config.UPDATE_MAX_PENDING)
+    return update_pool
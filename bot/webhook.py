@@ -0,0 +1,125 @@
+# bot/webhook.py - прием обновлений через webhook вместо long polling
+import logging
+import asyncio
+import hmac
+from aiohttp import web
+from aiogram.types import Update
+from bot.config import get_config
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """aiohttp-сервер для обновлений от Telegram.
+
+    Запрос проверяется по секретному токену, обновление кладется в ограниченную
+    очередь, и Telegram сразу получает 200. Если очередь заполнена, сервер отвечает
+    503 - Telegram повторит доставку позже, а память процесса не растет.
+
+    Обновления из очереди передает в диспетчер одна задача: порядок сохраняется, а
+    параллельную обработку выполняет UpdatePool.
+    """
+
+    def __init__(self, bot, dp, path, secret, queue_size=1000):
+        self.bot = bot
+        self.dp = dp
+        self.path = path
+        self.secret = secret
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+        self.received = 0
+        self.rejected = 0
+        self.overflow = 0
+        self.failed = 0
+        self._runner = None
+        self._consumer = None
+
+    async def handle(self, request):
+        # Без секрета запрос не принимается: иначе любой, кто знает адрес, может прислать обновление
+        if not self.secret or not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret):
+            self.rejected += 1
+            return web.Response(status=401)
+
+        try:
+            update = Update.model_validate(await request.json(), context={'bot': self.bot})
+        except Exception as e:
+            logger.error(f"❌ Некорректное обновление webhook: {e}")
+            return web.Response(status=400)
+
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.overflow += 1
+            return web.Response(status=503)
+
+        self.received += 1
+        return web.Response()
+
+    async def consume(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"❌ Ошибка обработки обновления {update.update_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def start(self, host, port):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self._consumer = asyncio.create_task(self.consume())
+
+    async def stop(self):
+        if self._consumer:
+            self._consumer.cancel()
+            self._consumer = None
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'rejected': self.rejected,
+            'overflow': self.overflow,
+            'failed': self.failed,
+            'queue_depth': self.queue.qsize(),
+        }
+
+
+# Сервер webhook этого процесса
+webhook_server = None
+
+
+async def run_webhook(bot, dp):
+    """Запускает прием обновлений через webhook и работает до отмены"""
+    global webhook_server
+    config = get_config()
+
+    webhook_server = WebhookServer(bot, dp, config.WEBHOOK_PATH, config.WEBHOOK_SECRET,
+                                   queue_size=config.WEBHOOK_QUEUE_SIZE)
+    await webhook_server.start(config.WEBHOOK_HOST, config.WEBHOOK_PORT)
+    logger.info(f"✅ Webhook слушает {config.WEBHOOK_HOST}:{config.WEBHOOK_PORT}{config.WEBHOOK_PATH}")
+
+    try:
+        # Все процессы за балансировщиком регистрируют один и тот же адрес - вызов идемпотентен
+        await bot.set_webhook(
+            url=config.WEBHOOK_URL.rstrip('/') + config.WEBHOOK_PATH,
+            secret_token=config.WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        await dp.emit_startup(bot=bot)
+        await asyncio.Event().wait()
+    finally:
+        await webhook_server.stop()
+        await dp.emit_shutdown(bot=bot)
@@ -2,28 +2,51 @@
 import logging
 import asyncio
 import os
-import aiohttp
 import time
-from aiogram import Bot, Dispatcher
-from aiogram.client.session.aiohttp import AiohttpSession
-from bot.config import load_config
+from aiogram import Dispatcher
+from aiogram.client.telegram import TelegramAPIServer, PRODUCTION
+from bot.config import get_config
 from bot.handlers import register_handlers
-from bot.scheduler import setup_scheduler
+from bot.scheduler import setup_scheduler, shutdown_scheduler
+from bot.delivery import start_delivery_workers, stop_delivery_workers
+from bot.update_pool import get_update_pool
+from bot.sessions import get_session_store
+from bot.idempotency import get_answer_guard
+from bot.webhook import run_webhook
+from bot.cluster import Supervisor, poll_updates
+from bot.connection import race_routes
+from bot.client import get_bulk_bot, close_bulk_bot, replace_session
+from bot.deletion import deletion_batcher
+from bot.metrics import start_metrics_server, stop_metrics_server, collectors
+from bot.logs import setup_logging as configure_logging, UpdateContextMiddleware
+from bot.tracing import TracingMiddleware, flush_traces
+from bot.profiling import get_stall_watchdog
+from bot.connectivity import get_connectivity_monitor
+from bot.lifecycle import (
+    RECONNECT, WARM, COLD, restart_state, begin_restart, mark_serving, restart_stats, reset_loop_state
+)
 from bot.db.database import cleanup_old_cache as cleanup_db_cache
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("bot.log", encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
-# Кэш для проверки интернета
-internet_cache = {'last_check': 0, 'available': True, 'cache_time': 30}
+
+def setup_logging():
+    """Настройка логирования (при запуске процесса, а не при импорте).
+
+    Файл и консоль пишет отдельный поток, цикл событий только кладет записи в очередь.
+    """
+    config = get_config()
+    configure_logging(config.LOG_LEVEL, config.LOG_FORMAT, config.LOG_FILE)
+
+
+# Уже инициализированные бот, диспетчер и планировщик - переиспользуются при теплом перезапуске
+app_state = {'bot': None, 'dp': None, 'scheduler': None}
+
+# После стольких неудачных теплых перезапусков подряд выполняется полная инициализация
+MAX_WARM_FAILURES = 5
+
+# Сколько ждать появления сети после ошибки polling, прежде чем все равно переподключиться
+WAIT_ONLINE_TIMEOUT = 60
 
 
 async def cleanup_all_caches():
@@ -39,10 +62,6 @@ async def cleanup_all_caches():
         except ImportError:
             pass  # Если функции нет, пропускаем
 
-        # Очищаем кэш интернета
-        global internet_cache
-        internet_cache = {'last_check': 0, 'available': True, 'cache_time': 30}
-
         logger.info("✅ Все кэши очищены")
     except Exception as e:
         logger.error(f"Ошибка очистки кэшей: {e}")
@@ -55,75 +74,40 @@ async def start_cache_cleanup():
         await cleanup_all_caches()
 
 
-async def test_internet_connection():
-    """Проверяем доступность интернета с кэшированием"""
-    current_time = time.time()
-
-    # Используем кэшированный результат, если проверяли недавно
-    if current_time - internet_cache['last_check'] < internet_cache['cache_time']:
-        return internet_cache['available']
-
-    test_urls = [
-        "https://api.telegram.org",
-        "https://google.com",
-        "https://cloudflare.com"
-    ]
-
-    for url in test_urls:
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, timeout=5) as response:
-                    if response.status == 200:
-                        logger.info(f"Интернет доступен через {url}")
-                        internet_cache['available'] = True
-                        internet_cache['last_check'] = current_time
-                        return True
-        except Exception:
-            continue
-
-    internet_cache['available'] = False
-    internet_cache['last_check'] = current_time
-    return False
-
-
 async def create_bot_session():
-    """Создает сессию бота с автоматическим выбором прокси"""
-    config = load_config()
+    """Создает сессию бота, выбирая маршрут (прямой или через прокси) параллельной гонкой"""
+    config = get_config()
 
-    # Список прокси для перебора (с приоритетом прямого подключения)
-    proxy_options = [
-        None,  # Прямое подключение (первый вариант)
-        "http://proxy.server:3128",  # Ваш текущий прокси
-    ]
+    # Адрес Bot API можно переопределить, например, на локальную заглушку
+    api = TelegramAPIServer.from_base(config.TELEGRAM_API_URL) if config.TELEGRAM_API_URL else PRODUCTION
 
-    # Перебираем все варианты подключения
-    for proxy_url in proxy_options:
-        try:
-            if proxy_url:
-                logger.info(f"Пробуем подключиться через прокси: {proxy_url}")
-                session = AiohttpSession(proxy=proxy_url)
-            else:
-                logger.info("Пробуем прямое подключение")
-                session = AiohttpSession()
+    bot, route = await race_routes(config.TOKEN, api)
+    # Проверки сети идут тем же маршрутом: на хосте, где интернет доступен
+    # только через прокси, прямые запросы никогда не проходят
+    get_connectivity_monitor().use_route(bot.session.proxy)
+    logger.info(f"✅ Подключение к Telegram API успешно! Маршрут: {route}")
+    return bot
 
-            bot = Bot(token=config.TOKEN, session=session)
 
-            # Проверяем подключение к Telegram API с коротким таймаутом
-            await asyncio.wait_for(bot.get_me(), timeout=5)
-            logger.info("✅ Подключение к Telegram API успешно!")
-            return bot
+async def reconnect_bot(bot):
+    """Пересоздает только сессию Telegram.
 
-        except Exception as e:
-            logger.error(f"Ошибка подключения через {proxy_url or 'прямое подключение'}: {e}")
-            continue
+    Объект Bot остается прежним: на него ссылаются диспетчер, задачи планировщика
+    и воркеры доставки, поэтому им не нужно ничего перенастраивать.
+    """
+    fresh_bot = await create_bot_session()
+    await replace_session(bot, fresh_bot.session)
+    # Бот рассылок переходит на тот же маршрут
+    get_bulk_bot(bot)
+    logger.info("Сессия бота успешно обновлена")
 
-    # Если ни один способ не сработал
-    raise Exception("Не удалось подключиться ни через один из методов")
 
+async def initialize_bot(load_questions=True):
+    """Инициализирует бота и базу данных.
 
-async def initialize_bot():
-    """Инициализирует бота и базу данных"""
-    config = load_config()
+    load_questions=False - вопросы уже загрузил супервизор кластера.
+    """
+    config = get_config()
 
     # Создаем сессию бота
     bot = await create_bot_session()
@@ -133,14 +117,40 @@ async def initialize_bot():
     # Регистрация обработчиков
     register_handlers(dp)
 
+    # update_id и user_id в записях лога; до пула, чтобы контекст попал в задачу обработки
+    dp.update.outer_middleware(UpdateContextMiddleware())
+
+    # Ограничиваем число одновременно обрабатываемых обновлений
+    dp.update.outer_middleware(get_update_pool())
+
+    # Трассировка выборки обновлений; после пула - выполняется в задаче обработки
+    dp.update.outer_middleware(TracingMiddleware())
+
+    # Момент, когда бот снова принимает обновления, - конец перезапуска
+    dp.startup.register(mark_serving)
+
+    # Отложенные удаления отправляем до закрытия сессии
+    dp.shutdown.register(deletion_batcher.flush_all)
+    dp.shutdown.register(flush_traces)
+
     # Инициализация базы данных
     from bot.db.database import create_tables, load_questions_from_fs
     create_tables()
-    load_questions_from_fs()
+    if load_questions:
+        load_questions_from_fs()
+
+    # Сервисы создаются лениво; здесь инициализируем их явно, до первого обновления.
+    # Восстанавливаем незавершенные сессии вопросов после перезапуска
+    get_session_store()
+    get_answer_guard()
 
     # Настройка планировщика для ежедневных вопросов
     scheduler = setup_scheduler(bot)
 
+    # Воркеры распределенной очереди доставки (если включена) работают через
+    # отдельный пул соединений, чтобы не мешать ответам пользователям
+    start_delivery_workers(get_bulk_bot(bot))
+
     return bot, dp, scheduler
 
 
@@ -153,66 +163,196 @@ async def resilient_polling(bot, dp):
     for attempt in range(max_retries):
         try:
             logger.info(f"Запуск polling (попытка {attempt + 1}/{max_retries})")
-            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+            # Обновления сразу передаются в пул обработки (UpdatePool), а когда пул
+            # переполнен, polling ждет - так нагрузка не копится в памяти
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types(), handle_as_tasks=False)
 
         except Exception as e:
             delay = min(base_delay + attempt, max_delay)
+            begin_restart(RECONNECT)
 
             logger.error(f"Ошибка polling (попытка {attempt + 1}/{max_retries}): {e}")
-            logger.info(f"Повторная попытка через {delay} секунд...")
-
-            # Ждем перед повторной попыткой
-            await asyncio.sleep(delay)
 
-            # Проверяем доступность интернета (с кэшированием)
-            internet_available = await test_internet_connection()
-            if not internet_available:
+            monitor = get_connectivity_monitor()
+            if await monitor.check_now():
+                # Сеть есть - ошибка на стороне Telegram, делаем паузу перед повтором
+                logger.info(f"Повторная попытка через {delay} секунд...")
+                await asyncio.sleep(delay)
+            else:
+                # Переподключаемся сразу, как только монитор увидит сеть, но не позже
+                # чем через WAIT_ONLINE_TIMEOUT: подключение к Telegram проверит связь само
                 logger.warning("Интернет недоступен, ждем восстановления соединения...")
-                await asyncio.sleep(2)
-                continue
+                if await monitor.wait_online(WAIT_ONLINE_TIMEOUT):
+                    logger.info("Соединение восстановлено, переподключаемся")
+                else:
+                    logger.warning("Сеть не появилась, пробуем переподключиться")
 
-            # Пытаемся пересоздать сессию бота
+            # Пересоздаем только сессию Telegram, остальное состояние бота сохраняется
             try:
-                new_bot = await create_bot_session()
-                # Обновляем бота в диспетчере
-                dp["bot"] = new_bot
-                bot = new_bot
-                logger.info("Сессия бота успешно обновлена")
+                await reconnect_bot(bot)
             except Exception as bot_error:
                 logger.error(f"Не удалось обновить сессию бота: {bot_error}")
                 continue
 
 
+async def serve_worker(channel):
+    """Процесс-воркер кластера: обрабатывает обновления своей доли пользователей"""
+    setup_logging()
+    get_stall_watchdog().start()
+    # Метрики обработчиков, БД и Bot API собираются в воркере - у него свой порт
+    await start_metrics_server(port_offset=channel.index + 1)
+    bot, dp, scheduler = await initialize_bot(load_questions=False)
+    cleanup_task = asyncio.create_task(start_cache_cleanup())
+    logger.info(f"✅ Воркер {channel.index} готов к работе")
+    try:
+        await channel.serve(bot, dp)
+    finally:
+        cleanup_task.cancel()
+        shutdown_scheduler(scheduler)
+
+
+async def run_cluster(workers):
+    """Супервизор: один поток обновлений, раздаваемый воркерам по user_id"""
+    from bot.db.database import create_tables, load_questions_from_fs
+    create_tables()
+    load_questions_from_fs()
+
+    bot = await create_bot_session()
+    dp = Dispatcher()
+    register_handlers(dp)
+
+    supervisor = Supervisor(serve_worker, workers)
+    await supervisor.start()
+    collectors.append(supervisor.metrics)
+
+    try:
+        try:
+            await bot.delete_webhook()
+        except Exception as e:
+            logger.warning(f"Не удалось снять webhook: {e}")
+
+        while True:
+            try:
+                await poll_updates(bot, supervisor, dp.resolve_used_update_types())
+            except Exception as e:
+                logger.error(f"Ошибка получения обновлений: {e}")
+                await asyncio.sleep(2)
+                await reconnect_bot(bot)
+    finally:
+        collectors.remove(supervisor.metrics)
+        await supervisor.stop()
+
+
+async def cold_start():
+    """Полная инициализация. Предыдущие планировщик, воркеры доставки и сессии останавливаются"""
+    # Воркеры работают через бота рассылок, который закрывается ниже
+    await stop_delivery_workers()
+    if app_state['scheduler']:
+        try:
+            shutdown_scheduler(app_state['scheduler'])
+        except Exception as e:
+            logger.warning(f"Не удалось остановить прежний планировщик: {e}")
+    if app_state['bot']:
+        try:
+            await app_state['bot'].session.close()
+        except Exception:
+            pass
+    await close_bulk_bot()
+
+    bot, dp, scheduler = await initialize_bot()
+    app_state.update(bot=bot, dp=dp, scheduler=scheduler)
+
+    logger.info("✅ Бот инициализирован и готов к работе")
+    logger.info("Ежедневные вопросы будут отправляться в 14:00 по Москве")
+
+
+async def warm_start():
+    """Теплый перезапуск: переиспользуем бота, БД, планировщик и кэши"""
+    bot = app_state['bot']
+    try:
+        await asyncio.wait_for(bot.get_me(), timeout=5)
+    except Exception as e:
+        logger.warning(f"Сессия Telegram недоступна ({e}), переподключаемся")
+        await reconnect_bot(bot)
+
+
 async def main():
     """Основная функция с быстрым восстановлением"""
     logger.info("Запуск автономного бота UXUI_insight_bot")
 
+    config = get_config()
+
+    # Наблюдение за зависаниями цикла событий
+    get_stall_watchdog().start()
+
+    # Метрики и проверки живости/готовности (если включены)
+    await start_metrics_server()
+    try:
+        await serve(config)
+    finally:
+        # Порт освобождается, пока цикл событий еще работает
+        await stop_metrics_server()
+
+
+async def serve(config):
+    """Получение и обработка обновлений с перезапусками нужного уровня"""
+    if config.BOT_MODE != 'webhook' and config.BOT_WORKERS > 1:
+        # Несколько процессов: супервизор получает обновления и раздает их воркерам
+        await run_cluster(config.BOT_WORKERS)
+        return
+
     # Запускаем задачу очистки кэшей
     cleanup_task = asyncio.create_task(start_cache_cleanup())
 
+    warm_failures = 0
     while True:
         try:
-            # Инициализируем бота
-            bot, dp, scheduler = await initialize_bot()
+            if (app_state['dp'] is None or restart_state['cold_requested']
+                    or warm_failures >= MAX_WARM_FAILURES):
+                # Полная инициализация: при запуске, по запросу или если теплые перезапуски не помогают
+                if app_state['dp'] is not None:
+                    begin_restart(COLD)
+                restart_state['cold_requested'] = False
+                warm_failures = 0
+                await cold_start()
+            else:
+                await warm_start()
+
+            bot, dp = app_state['bot'], app_state['dp']
 
-            logger.info("✅ Бот инициализирован и готов к работе")
-            logger.info("Ежедневные вопросы будут отправляться в 14:00 по Москве")
+            if config.BOT_MODE == 'webhook':
+                # Обновления приходят от Telegram на наш сервер
+                await run_webhook(bot, dp)
+            else:
+                # Снимаем webhook, если он остался от запуска в режиме webhook
+                try:
+                    await bot.delete_webhook()
+                except Exception as e:
+                    logger.warning(f"Не удалось снять webhook: {e}")
 
-            # Запускаем устойчивый polling
-            await resilient_polling(bot, dp)
+                # Запускаем устойчивый polling
+                await resilient_polling(bot, dp)
 
         except Exception as e:
+            warm_failures += 1
             logger.critical(f"Критическая ошибка в основном цикле: {e}")
-            logger.info("Перезапуск бота через 2 секунды...")
+            logger.info(f"Теплый перезапуск бота через 2 секунды... ({restart_stats()})")
             await asyncio.sleep(2)
+            begin_restart(WARM)
 
 
 if __name__ == "__main__":
-    # Бесконечный цикл с быстрым перезапуском
+    setup_logging()
+
+    # Последний уровень восстановления: если упал сам цикл событий,
+    # процесс начинает заново с полной инициализации
     while True:
         try:
             asyncio.run(main())
         except Exception as e:
             logger.critical(f"Фатальная ошибка: {e}")
             logger.info("Полный перезапуск бота через 1 секунду...")
+            # Объекты старого цикла событий непригодны: пулы и очереди создаются
+            # заново, а main() выполняет холодный старт
+            reset_loop_state()
             time.sleep(1)